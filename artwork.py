@@ -0,0 +1,252 @@
+"""
+    Cover art embedding.
+
+    The art of a track is the FLAC PICTURE block of its source,
+    otherwise a cover image in its album directory. It is scaled down,
+    recompressed and kept in an LRU cache: by a digest of the picture
+    for embedded pictures, which can differ between tracks, and by
+    album directory for cover images, so the other tracks sharing the
+    art reuse the prepared image.
+
+    Scaling needs Pillow. Without it JPEG and PNG images are embedded
+    unchanged and other formats are skipped.
+"""
+import os
+import io
+import base64
+import hashlib
+import logging
+import threading
+import collections
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+logger = logging.getLogger(__name__)
+
+# Cover image names in the album directory, most preferred first
+cover_names = ('cover', 'folder', 'front', 'album')
+
+image_mimes = {'.jpg': 'image/jpeg',
+               '.jpeg': 'image/jpeg',
+               '.png': 'image/png',
+               '.bmp': 'image/bmp'}
+
+# Image types every supported tag format can hold without conversion
+embeddable_mimes = ('image/jpeg', 'image/png')
+
+# APIC/PICTURE picture type
+FRONT_COVER = 3
+
+
+class Artwork(collections.namedtuple('Artwork', 'data mime width height')):
+    """
+        Image data ready to embed. width and height are 0 when unknown.
+    """
+
+
+def read_flac_picture(path):
+    """
+        Returns (data, mime) of the front cover (or first picture)
+        embedded in a FLAC file, or None
+    """
+    try:
+        from mutagen.flac import FLAC, error
+    except ImportError:
+        return None
+
+    try:
+        pictures = FLAC(path).pictures
+    except (IOError, OSError, error):
+        return None
+
+    if not pictures:
+        return None
+
+    picture = sorted(pictures, key=lambda p: p.type != FRONT_COVER)[0]
+    return picture.data, picture.mime
+
+
+def find_cover_image(album_dir):
+    """
+        Returns the path of the preferred cover image in album_dir, or
+        None. Known cover names win, then the first image by name.
+    """
+    try:
+        names = sorted(n for n in os.listdir(album_dir)
+                       if os.path.splitext(n)[1].lower() in image_mimes)
+    except OSError:
+        return None
+
+    if not names:
+        return None
+
+    def rank(name):
+        stem = os.path.splitext(name)[0].lower()
+        return cover_names.index(stem) if stem in cover_names else len(cover_names)
+
+    return os.path.join(album_dir, min(names, key=rank))
+
+
+def find_cover(album_dir):
+    """
+        Returns (data, mime) of the cover image in album_dir, or None
+    """
+    image = find_cover_image(album_dir)
+    if image is None:
+        return None
+
+    with open(image, 'rb') as f:
+        return f.read(), image_mimes[os.path.splitext(image)[1].lower()]
+
+
+def prepare(data, mime, max_size):
+    """
+        Scales an image down to fit max_size x max_size pixels and
+        recompresses it as JPEG. Images that already fit and are JPEG
+        or PNG are kept as they are.
+
+        Returns an Artwork, or None for an image that can't be embedded
+        (not JPEG or PNG, and Pillow is missing or can't read it)
+    """
+    if Image is None:
+        if mime not in embeddable_mimes:
+            logger.warning('Skipping {} cover image: converting it needs Pillow'.format(mime))
+            return None
+        return Artwork(data, mime, 0, 0)
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (IOError, OSError) as e:
+        logger.warning('Could not read cover image: {}'.format(e))
+        return Artwork(data, mime, 0, 0) if mime in embeddable_mimes else None
+
+    if (not max_size or max(image.size) <= max_size) and image.format in ('JPEG', 'PNG'):
+        return Artwork(data, Image.MIME[image.format], image.size[0], image.size[1])
+
+    if max_size:
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+
+    out = io.BytesIO()
+    image.convert('RGB').save(out, 'JPEG', quality=90)
+    return Artwork(out.getvalue(), 'image/jpeg', image.size[0], image.size[1])
+
+
+class ArtworkCache(object):
+    """
+        LRU cache of prepared Artwork (or None for no art), by SHA-1 of
+        the picture for pictures embedded in a FLAC file and by album
+        directory for cover images.
+
+        Tracks converted at the same time wait for the first one to
+        prepare shared art instead of preparing it again.
+    """
+
+    def __init__(self, max_size=500, max_entries=32):
+        self.max_size = max_size        # Largest width/height in pixels (0 = keep)
+        self.max_entries = max_entries
+        self._cache = collections.OrderedDict()
+        self._loading = {}              # Picture digest or album directory -> Event set when prepared
+        self._lock = threading.Lock()
+
+    def get(self, lossless_file):
+        """
+            Returns the Artwork for lossless_file, or None
+        """
+        picture = None
+        if lossless_file.lower().endswith('.flac'):
+            picture = read_flac_picture(lossless_file)
+
+        if picture is not None:
+            key = 'embedded:' + hashlib.sha1(picture[0]).hexdigest()
+            return self._get(key, lambda: picture)
+
+        album = os.path.dirname(lossless_file)
+        return self._get(album, lambda: find_cover(album))
+
+    def _get(self, key, find):
+        """
+            Returns the cached Artwork for key, preparing the image
+            returned by find() if it isn't cached yet
+        """
+        while True:
+            with self._lock:
+                if key in self._cache:
+                    art = self._cache.pop(key)
+                    self._cache[key] = art      # Most recently used
+                    return art
+
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+
+            loading.wait()
+
+        art = None
+        try:
+            found = find()
+            if found is not None:
+                art = prepare(found[0], found[1], self.max_size)
+            logger.debug('Prepared artwork for {}'.format(key))
+        except (IOError, OSError) as e:
+            logger.warning('Could not read artwork for {}: {}'.format(key, e))
+
+        finally:
+            with self._lock:
+                self._cache[key] = art
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+                del self._loading[key]
+            loading.set()
+
+        return art
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cache)
+
+
+def embed(lossy_file, art):
+    """
+        Embeds art as the front cover of an MP3, MP4/M4A or Ogg file,
+        replacing any embedded cover
+    """
+    import mutagen
+    from mutagen.id3 import APIC
+    from mutagen.mp3 import MP3
+    from mutagen.mp4 import MP4, MP4Cover
+    from mutagen.flac import Picture
+    from mutagen.ogg import OggFileType
+
+    f = mutagen.File(lossy_file)
+
+    if isinstance(f, MP3):
+        if f.tags is None:
+            f.add_tags()
+        f.tags.delall('APIC')
+        f.tags.add(APIC(encoding=3, mime=art.mime, type=FRONT_COVER, desc=u'Cover', data=art.data))
+
+    elif isinstance(f, MP4):
+        if f.tags is None:
+            f.add_tags()
+        image_format = MP4Cover.FORMAT_PNG if art.mime == 'image/png' else MP4Cover.FORMAT_JPEG
+        f.tags['covr'] = [MP4Cover(art.data, imageformat=image_format)]
+
+    elif isinstance(f, OggFileType):
+        picture = Picture()
+        picture.type = FRONT_COVER
+        picture.mime = art.mime
+        picture.width = art.width
+        picture.height = art.height
+        picture.data = art.data
+        f['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+
+    else:
+        raise ValueError('Cannot embed artwork in {}'.format(lossy_file))
+
+    f.save()
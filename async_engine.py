@@ -0,0 +1,488 @@
+"""
+    asyncio execution engine (--engine asyncio).
+
+    Runs the same jobs as LosslessToLossyConverter.start() as coroutines
+    on one event loop instead of one thread per worker. Decoders and
+    encoders are fed and supervised from the loop, and their exits are
+    awaited on pidfds so their resource usage is kept for the metrics,
+    so a high job count (e.g. for network storage, where jobs mostly
+    wait on I/O) costs little more than the processes themselves. The
+    source scan, tagging, retagging, artwork copies and in-process
+    decoders run in thread pools.
+
+    Requires Python 3.7 or later.
+"""
+import os
+import time
+import asyncio
+import logging
+import functools
+import threading
+import subprocess
+from concurrent import futures
+
+import concurrency
+import conversion_metrics
+import pipeline_watchdog
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncEngine(object):
+    """
+        Converts with asyncio on behalf of a LosslessToLossyConverter,
+        which keeps the results, manifest and metrics as usual
+    """
+
+    # Bytes copied from the decoder to the encoders at a time
+    chunk_size = 1 << 18
+
+    def __init__(self, converter):
+        self.converter = converter
+        self.executor = None
+        self.work_queue = None
+        self.stop_markers = 0
+        self.limiter_changed = None     # Set when the limiter may have a free place
+
+    def run(self):
+        """ Converts everything scan_source() finds, like start() """
+        asyncio.run(self.main())
+
+    async def main(self):
+        conv = self.converter
+        loop = asyncio.get_running_loop()
+
+        if conv.schedule == 'fifo':
+            # Same key for every job: taken in sequence
+            work_queue = asyncio.PriorityQueue(conv.queue_size)
+        else:
+            work_queue = asyncio.PriorityQueue()
+        self.work_queue = work_queue
+        conv.limiter = concurrency.WorkerLimiter(conv.threads)
+        self.watch_limiter(loop)
+
+        # Blocking steps: tagging, directory creation, in-process decoding
+        self.executor = futures.ThreadPoolExecutor(conv.threads)
+        copy_executor = futures.ThreadPoolExecutor(conv.copy_threads)
+        scan_done = loop.create_future()
+
+        def finish_scan(result=None, error=None):
+            if not scan_done.done():
+                if error is not None:
+                    scan_done.set_exception(error)
+                else:
+                    scan_done.set_result(result)
+
+        def scan():
+            # Runs in its own thread, blocking while the queue is full
+            queued = 0
+            try:
+                for kind, rel_path, key, needed in conv.planned_jobs():
+                    if kind == conv.SCAN_ARTWORK:
+                        conv.to_copy.append((rel_path, needed))
+                        copy_executor.submit(conv.copy_artwork_file, rel_path, needed)
+                        continue
+
+                    if kind == conv.SCAN_CONVERT:
+                        conv.prefetch_file(rel_path, key, queued)
+
+                    item = (0, key, queued, (kind, rel_path, needed, time.time()))
+                    asyncio.run_coroutine_threadsafe(work_queue.put(item), loop).result()
+                    queued += 1
+            except Exception as e:
+                loop.call_soon_threadsafe(finish_scan, None, e)
+            else:
+                loop.call_soon_threadsafe(finish_scan, queued)
+
+        if conv.prefetcher is not None:
+            conv.prefetcher.start()
+
+        scanner = threading.Thread(target=scan)
+        scanner.daemon = True
+        scanner.start()
+
+        workers = [asyncio.ensure_future(self.worker(work_queue)) for i in range(conv.threads)]
+
+        try:
+            try:
+                queued = await scan_done
+            except Exception as ex:
+                conv.logger.exception(ex)
+                raise SystemExit
+
+            conv.logger.debug('Number of items queued for conversion: ' + str(queued))
+
+            # One stop marker per worker, sorted after every job
+            for i in range(len(workers)):
+                await work_queue.put((1, (), queued + i, None))
+                self.stop_markers += 1
+
+            await asyncio.gather(*workers)
+            copy_executor.shutdown(wait=True)
+            if conv.journal is not None:
+                conv.journal.finish()
+
+        finally:
+            for w in workers:
+                w.cancel()
+            copy_executor.shutdown(wait=True)
+            self.executor.shutdown(wait=True)
+            conv.limiter.listeners = []
+            conv.close()
+
+    async def worker(self, work_queue):
+        conv = self.converter
+
+        while True:
+            # Jobs wait in the queue, not in workers (see waiting_jobs())
+            await self.wait_for_place()
+            item = await work_queue.get()
+            job = item[-1]
+            if job is not None and not conv.limiter.try_acquire():
+                # A split encode took the place first (see segment_count()):
+                # put the job back where it was in the queue
+                await work_queue.put(item)
+                work_queue.task_done()
+                continue
+
+            try:
+                if job is None:
+                    return
+
+                await self.run_job(*job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                conv.logger.exception('Worker failed on {}'.format(job[1]))
+                conv.record_error(conv.error_conv, os.path.join(conv.source_dir, job[1]))
+            finally:
+                if job is not None:
+                    conv.limiter.release()
+                work_queue.task_done()
+
+    def watch_limiter(self, loop):
+        """ Has the converter's limiter set limiter_changed on loop """
+        self.limiter_changed = asyncio.Event()
+        self.converter.limiter.listeners.append(
+            lambda: loop.call_soon_threadsafe(self.limiter_changed.set))
+
+    async def wait_for_place(self):
+        """ Waits until the converter's limiter has a free place, without taking it """
+        limiter = self.converter.limiter
+        while True:
+            self.limiter_changed.clear()
+            if limiter.active < limiter.limit:
+                return
+            await self.limiter_changed.wait()
+
+    def in_thread(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def run_job(self, kind, rel_path, needed, queued_at=None):
+        """ Coroutine version of LosslessToLossyConverter.run_job() """
+        conv = self.converter
+
+        if kind != conv.SCAN_CONVERT or conv.noop:
+            # Retagging and noop runs start no codec processes
+            return await self.in_thread(conv.run_job, kind, rel_path, needed, queued_at)
+
+        lossless_file = os.path.join(conv.source_dir, rel_path)
+        needed = conv.configured_outputs(rel_path, needed)
+        if not needed:
+            return ()
+
+        targets = await self.in_thread(conv.job_targets, lossless_file, needed)
+        metrics = conv.job_metrics(kind, rel_path, queued_at)
+        started = time.time()
+        conv.prefetch_started(lossless_file, metrics)
+        if conv.journal is not None:
+            conv.journal.started(kind, rel_path)
+
+        # Stat before encoding so changes made during the encode
+        # are picked up on the next run
+        stat = None
+        if conv.manifest is not None:
+            stat = await self.in_thread(os.stat, lossless_file)
+
+        if metrics is not None:
+            await self.in_thread(conv.source_metrics, lossless_file, metrics)
+
+        stage = await self.in_thread(conv.stage_job, lossless_file, targets)
+        try:
+            results = await self.convert_to_lossy(lossless_file, targets, metrics, stage)
+            if metrics is not None and metrics.get('duration'):
+                metrics['realtime_factor'] = metrics['duration'] / (time.time() - started)
+
+            await self.in_thread(conv.tag_outputs, lossless_file, targets, results, stat, metrics,
+                                 stage is not None)
+        finally:
+            if stage is not None:
+                await self.in_thread(conv.scratch.release, stage)
+
+        conv.record_job_metrics(metrics, started, results)
+        if conv.journal is not None:
+            conv.journal.finished(kind, rel_path, results)
+
+        return results
+
+    async def convert_to_lossy(self, lossless_file, targets, metrics=None, stage=None):
+        """ Coroutine version of LosslessToLossyConverter.convert_to_lossy() """
+        conv = self.converter
+        results = [1] * len(targets)
+        pending = await self.in_thread(conv.fetch_cached, lossless_file, targets, results, metrics, stage)
+        waiting = max(0, self.work_queue.qsize() - self.stop_markers)
+        pending = await self.in_thread(conv.encode_segmented, lossless_file, targets, pending, results,
+                                       waiting, metrics, stage)
+        attempts = 0
+
+        while pending and attempts <= conv.retries:
+            if attempts:
+                conv.logger.info('Retrying {} (attempt {} of {})'.format(
+                    lossless_file, attempts + 1, conv.retries + 1))
+                await asyncio.sleep(conv.retry_delay)
+
+            attempt_results, expired = await self.run_pipeline(lossless_file, [targets[i] for i in pending],
+                                                               metrics, stage)
+            for i, result in zip(pending, attempt_results):
+                results[i] = result
+
+            pending = [i for i in pending if results[i]]
+            attempts += 1
+            if expired:
+                break
+
+        if metrics is not None:
+            metrics['attempts'] = attempts
+
+        conv.record_results(lossless_file, targets, results)
+
+        return results
+
+    async def run_pipeline(self, lossless_file, targets, metrics=None, stage=None):
+        """
+            One attempt of convert_to_lossy(). The decoder is connected
+            straight to a single encoder; with several encoders its
+            output is copied to each one from the loop.
+
+            Returns a list of results (0 = success) matching targets,
+            and whether the watchdog killed the pipeline
+        """
+        conv = self.converter
+        loop = asyncio.get_running_loop()
+        encoders = [conv.encoder_command(output, lossy_file, stage) for output, lossy_file in targets]
+        watchdog = pipeline_watchdog.PipelineWatchdog(conv.job_timeout(lossless_file), conv.stall_timeout)
+        for args, lossy_file_tmp in encoders:
+            watchdog.watch_file(lossy_file_tmp)
+
+        decoder = None
+        procs = []
+        stopped_reading = [False] * len(targets)
+        supervisor = None
+        started = time.time()
+
+        try:
+            if not conv.Decoder.in_process and len(encoders) == 1:
+                # Single output: connect the processes directly
+                decoder = subprocess.Popen(conv.decoder_command(lossless_file), stdout=subprocess.PIPE)
+                conv.limit_process(conv.Decoder, decoder)
+                watchdog.watch(decoder)
+                try:
+                    procs.append(subprocess.Popen(encoders[0][0], stdin=decoder.stdout))
+                finally:
+                    decoder.stdout.close()
+                conv.limit_process(targets[0][0].encoder, procs[0])
+                watchdog.watch(procs[0])
+                supervisor = self.supervise(watchdog)
+
+            elif not conv.Decoder.in_process:
+                decoder = subprocess.Popen(conv.decoder_command(lossless_file), stdout=subprocess.PIPE)
+                conv.limit_process(conv.Decoder, decoder)
+                watchdog.watch(decoder)
+                reader = await self.read_pipe(decoder.stdout)
+                writers = []
+                try:
+                    for (args, tmp), (output, lossy_file) in zip(encoders, targets):
+                        procs.append(subprocess.Popen(args, stdin=subprocess.PIPE))
+                        conv.limit_process(output.encoder, procs[-1])
+                        watchdog.watch(procs[-1])
+                        writers.append(await self.write_pipe(procs[-1].stdin))
+                except BaseException:
+                    for p in procs[len(writers):]:
+                        p.stdin.close()
+                    for writer in writers:
+                        writer.close()
+                    raise
+                supervisor = self.supervise(watchdog)
+
+                stopped_reading = await self.fan_out(reader, writers)
+                if all(stopped_reading):
+                    conv.logger.debug('Every encoder stopped reading {}'.format(lossless_file))
+                    # Nothing reads the decoder any more
+                    watchdog.kill('failed: every encoder stopped reading')
+
+            else:
+                # In-process decoder: decode in a thread into the encoders' pipes
+                pipes = []
+                try:
+                    for (args, tmp), (output, lossy_file) in zip(encoders, targets):
+                        read_end, write_end = os.pipe()
+                        pipes.append(os.fdopen(write_end, 'wb'))
+                        try:
+                            procs.append(subprocess.Popen(args, stdin=read_end))
+                            conv.limit_process(output.encoder, procs[-1])
+                        finally:
+                            os.close(read_end)
+                        watchdog.watch(procs[-1])
+                    supervisor = self.supervise(watchdog)
+
+                    stopped_reading = await self.in_thread(conv.decode_to_pipes, lossless_file, pipes)
+                finally:
+                    for pipe in pipes:
+                        try:
+                            pipe.close()
+                        except (IOError, OSError):
+                            pass
+
+            # The decoder finishes first (or gets SIGPIPE if its encoder died)
+            decode_usage = None
+            if decoder is not None:
+                decode_usage = await self.wait_process(decoder)
+            decode_wall = time.time() - started
+
+            encode_usage = []   # (rusage, wall time) for each encoder
+            for p in procs:
+                encode_usage.append((await self.wait_process(p), time.time() - started))
+
+        except BaseException as ex:
+            # Includes cancellation: never leave processes or tmp files behind
+            if not isinstance(ex, asyncio.CancelledError):
+                conv.logger.exception('Could not encode')
+            watchdog.kill('failed')
+            for p in [decoder] + procs:
+                if p is not None:
+                    await self.wait_process(p)
+            for args, lossy_file_tmp in encoders:
+                conv.remove_tmp(lossy_file_tmp)
+
+            if isinstance(ex, Exception):
+                return [1] * len(targets), False
+            raise
+
+        finally:
+            if supervisor is not None:
+                supervisor.cancel()
+
+        decoder_exit = decoder.returncode if decoder is not None else None
+        conv.log_pipeline_failure(lossless_file, watchdog.reason, decoder_exit)
+
+        output_metrics = [None] * len(targets)
+        if metrics is not None:
+            conv.pipeline_metrics(metrics, decode_wall, decoder_exit, watchdog.reason)
+            if decode_usage is not None:
+                metrics['decode_user_cpu'] = metrics.get('decode_user_cpu', 0.0) + decode_usage.ru_utime
+                metrics['decode_sys_cpu'] = metrics.get('decode_sys_cpu', 0.0) + decode_usage.ru_stime
+
+            output_metrics = []
+            for (output, lossy_file), p, (usage, wall) in zip(targets, procs, encode_usage):
+                output_metrics.append(conv.output_metrics(metrics, output, lossy_file, p.returncode, wall))
+                if usage is not None:
+                    output_metrics[-1]['user_cpu'] = usage.ru_utime
+                    output_metrics[-1]['sys_cpu'] = usage.ru_stime
+
+        results = []
+        for i, (output, lossy_file) in enumerate(targets):
+            failure = conv.pipeline_failure(watchdog.reason, decoder_exit, procs[i].returncode,
+                                            stopped_reading[i])
+            result = await self.in_thread(conv.finish_output, encoders[i][1], lossy_file, failure,
+                                          output_metrics[i], lossless_file, stage, output)
+            results.append(result)
+
+        return results, watchdog.expired
+
+    async def wait_process(self, p):
+        """
+            Waits for a subprocess.Popen from the loop like
+            conversion_metrics.wait_process(), returning its resource
+            usage or None. The exit is awaited on a pidfd (Linux 5.3+,
+            Python 3.9+), otherwise the process is waited for in a
+            thread.
+        """
+        if p.returncode is not None:
+            return None
+
+        try:
+            pidfd = os.pidfd_open(p.pid)
+        except (AttributeError, OSError):
+            return await asyncio.get_running_loop().run_in_executor(
+                None, conversion_metrics.wait_process, p)
+
+        loop = asyncio.get_running_loop()
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+
+        # Exited: reaping it doesn't block
+        return conversion_metrics.wait_process(p)
+
+    @staticmethod
+    async def read_pipe(pipe):
+        """ Returns an asyncio.StreamReader reading a subprocess pipe """
+        reader = asyncio.StreamReader()
+        await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        return reader
+
+    @staticmethod
+    async def write_pipe(pipe):
+        """ Returns an asyncio.StreamWriter writing to a subprocess pipe """
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, pipe)
+        return asyncio.StreamWriter(transport, protocol, None, loop)
+
+    def supervise(self, watchdog):
+        """ Starts checking watchdog from the loop. Returns the task, or None. """
+        if watchdog.timeout is None and watchdog.stall_timeout is None:
+            return None
+
+        async def check():
+            while True:
+                await asyncio.sleep(watchdog.interval)
+                reason = watchdog.check(time.time())
+                if reason is not None:
+                    watchdog.expire(reason)
+                    return
+
+        return asyncio.ensure_future(check())
+
+    async def fan_out(self, reader, writers):
+        """
+            Copies reader to every writer until EOF. Returns which
+            writers stopped reading.
+        """
+        failed = [False] * len(writers)
+
+        while not all(failed):
+            data = await reader.read(self.chunk_size)
+            if not data:
+                break
+
+            for i, writer in enumerate(writers):
+                if failed[i]:
+                    continue
+                try:
+                    writer.write(data)
+                    await writer.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    failed[i] = True
+
+        for writer in writers:
+            try:
+                writer.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        return failed
@@ -1,12 +1,216 @@
 import os
+import json
+import hashlib
 import logging
 import sys
+import struct
+import inspect
+import tempfile
 import subprocess
+import collections
 
 
 logger = logging.getLogger(__name__)
 
 
+class StreamInfo(collections.namedtuple('StreamInfo', 'sample_rate channels bits_per_sample '
+                                                        'total_samples md5')):
+    """
+        Basic audio stream properties read from a file header.
+
+        md5 is the MD5 of the decoded audio (FLAC only, otherwise None)
+    """
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        """
+            Length in seconds (None if unknown)
+        """
+        if not self.sample_rate or not self.total_samples:
+            return None
+
+        return float(self.total_samples) / self.sample_rate
+
+
+def read_flac_streaminfo(path):
+    """
+        Reads the STREAMINFO metadata block at the start of a FLAC file
+        without decoding any audio.
+
+        Returns a StreamInfo, or None if the file isn't a FLAC file
+    """
+    with open(path, 'rb') as f:
+        header = f.read(4 + 4 + 34)
+
+    # "fLaC" marker, then the mandatory STREAMINFO block (type 0)
+    if len(header) < 42 or header[:4] != b'fLaC' or (bytearray(header[4:5])[0] & 0x7f) != 0:
+        return None
+
+    block = header[8:]
+
+    # 20 bits sample rate, 3 bits channels-1, 5 bits bps-1, 36 bits samples
+    packed = struct.unpack('>Q', block[10:18])[0]
+    sample_rate = packed >> 44
+    channels = ((packed >> 41) & 0x07) + 1
+    bits_per_sample = ((packed >> 36) & 0x1f) + 1
+    total_samples = packed & 0xfffffffff
+
+    md5 = block[18:34]
+    if md5 == b'\x00' * 16:
+        # Encoder didn't compute the signature
+        md5 = None
+    else:
+        md5 = ''.join('{:02x}'.format(b) for b in bytearray(md5))
+
+    return StreamInfo(sample_rate, channels, bits_per_sample, total_samples, md5)
+
+
+def read_flac_tags_hash(path):
+    """
+        Hashes the VORBIS_COMMENT and PICTURE metadata blocks of a FLAC
+        file, skipping over everything else. The hash changes when tags
+        or embedded art change but not when only padding is used up.
+
+        Returns a hex digest, or None if the file isn't a FLAC file
+    """
+    h = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        if f.read(4) != b'fLaC':
+            return None
+
+        while True:
+            header = bytearray(f.read(4))
+            if len(header) < 4:
+                return None
+
+            last = header[0] & 0x80
+            block_type = header[0] & 0x7f
+            size = (header[1] << 16) | (header[2] << 8) | header[3]
+
+            if block_type in (4, 6):
+                header[0] = block_type  # Ignore which block is last
+                h.update(bytes(header))
+                h.update(f.read(size))
+            else:
+                f.seek(size, os.SEEK_CUR)
+
+            if last:
+                break
+
+    return h.hexdigest()
+
+
+def read_wav_streaminfo(path):
+    """
+        Reads the fmt and data chunk headers of a RIFF WAVE file.
+
+        Returns a StreamInfo, or None if the file isn't a WAV file or
+        its headers are truncated
+    """
+    with open(path, 'rb') as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            return None
+
+        fmt = None
+
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+
+            chunk_id, size = struct.unpack('<4sI', chunk)
+
+            if chunk_id == b'fmt ':
+                data = f.read(16)
+                if size < 16 or len(data) < 16:
+                    return None
+                fmt = struct.unpack('<HHIIHH', data)
+                f.seek(size - 16 + (size & 1), os.SEEK_CUR)
+            elif chunk_id == b'data':
+                break
+            else:
+                # Chunks are word aligned
+                f.seek(size + (size & 1), os.SEEK_CUR)
+
+    if fmt is None:
+        return None
+
+    channels, sample_rate, block_align, bits_per_sample = fmt[1], fmt[2], fmt[4], fmt[5]
+    total_samples = size // block_align if block_align else None
+
+    return StreamInfo(sample_rate, channels, bits_per_sample, total_samples, None)
+
+
+class CodecProbeCache(object):
+    """
+        On-disk cache of codec probe results (version and codec support)
+        so executables aren't run on every start.
+
+        Entries are keyed by codec name and executable path, and are
+        only used while the executable's mtime and size are unchanged.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or \
+                os.path.join(os.path.expanduser('~'), '.cache')
+            path = os.path.join(cache_home, 'flacthis', 'codecs.json')
+
+        self.path = path
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._entries = {}
+
+        return self._entries
+
+    @staticmethod
+    def _key(codec, exe):
+        return "{}:{}".format(codec.name, exe)
+
+    def get(self, codec, exe):
+        """
+            Returns the cached {"version", "supported"} entry for a
+            codec's executable, or None if missing or stale
+        """
+        entry = self._load().get(self._key(codec, exe))
+        if entry is None:
+            return None
+
+        st = os.stat(exe)
+        if entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+            return None
+
+        return entry
+
+    def put(self, codec, exe, version, supported):
+        st = os.stat(exe)
+        self._load()[self._key(codec, exe)] = {'mtime': st.st_mtime,
+                                               'size': st.st_size,
+                                               'version': version,
+                                               'supported': supported}
+        try:
+            d = os.path.dirname(self.path)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+            # Write a temp file and rename so readers never see half a file
+            fd, tmp = tempfile.mkstemp(dir=d)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._entries, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            logger.debug("Could not write codec cache {}: {}".format(self.path, e))
+
+
 class Codec(object):
     """
         Superclass for all encoders and decoders
@@ -21,6 +225,17 @@ class Codec(object):
         Must run .find_exe() to initiate the locate
     """
 
+    # True for codecs running inside the Python process (no cmd_seq)
+    in_process = False
+
+    # CPUs one running instance keeps busy, used to size the worker pool
+    threads_per_job = 1
+
+    # Encoder flags making its output splittable between any two frames,
+    # None if segments of its output can't be joined. They apply to the
+    # whole split encode (see mp3_segments).
+    segment_flags = None
+
     def __init__(self, name, exec_file, ext, cmd_seq, flags):
         self.name = name
         self.exec_file = exec_file
@@ -131,11 +346,27 @@ class Codec(object):
         """
         pass
 
-    def find_exe(self):
+    @classmethod
+    def default_name(cls):
+        """
+            Returns the codec name without creating an instance
+        """
+        try:
+            params = inspect.signature(cls.__init__).parameters
+            return params['name'].default
+        except AttributeError:
+            # Python 2
+            spec = inspect.getargspec(cls.__init__)
+            return spec.defaults[spec.args.index('name') - len(spec.args)]
+
+    def find_exe(self, cache=None):
         """
             Attempts to locate executable for codec starting with the
             current directory, then looks in the default path
 
+            If a CodecProbeCache is given, the version and codec support
+            checks are taken from it when the executable is unchanged.
+
             Raises CodecNotFound if file was not found
             Raises CodecNotExecutable if file not executable
 
@@ -150,13 +381,58 @@ class Codec(object):
         if not self._is_exe_executable():
             raise CodecNotExecutable
 
+        cached = cache.get(self, self.found_exe) if cache is not None else None
+
+        if cached is not None:
+            logger.debug("Using cached probe of {}".format(self.found_exe))
+            if not cached['supported']:
+                raise NotCompiledWithCodecSupport
+            self.version = cached['version']
+            return
+
         # Won't do anything unless subclass creates a function for it
-        self._check_exe_codec_support()
+        try:
+            self._check_exe_codec_support()
+        except NotCompiledWithCodecSupport:
+            if cache is not None:
+                cache.put(self, self.found_exe, None, False)
+            raise
+
         self._find_exe_version()
 
+        if cache is not None:
+            cache.put(self, self.found_exe, self.version, True)
+
     def override_codec_flags(self, flags):
         self.flags = flags
 
+    def read_stream_info(self, input_file):
+        """
+            Returns a StreamInfo for input_file, read from its header.
+
+            Decoders override this. None means the properties can't be
+            found without decoding.
+        """
+        return None
+
+    def read_tags_hash(self, input_file):
+        """
+            Returns a hash of input_file's tags, read without decoding.
+
+            Decoders override this. None means the format has no tags
+            (or they can't be read), so tag changes can't be detected.
+        """
+        return None
+
+    def range_flags(self, skip, until=None):
+        """
+            Returns decoder flags for decoding only samples skip to
+            until (to the end if None).
+
+            Decoders override this. None means the decoder can't seek.
+        """
+        return None
+
 
 #### DECODERS ####
 
@@ -175,6 +451,19 @@ class FLACDecoder(Codec):
         if len(version) > 0:
             self.version = version.decode('utf8').strip()
 
+    def read_stream_info(self, input_file):
+        return read_flac_streaminfo(input_file)
+
+    def read_tags_hash(self, input_file):
+        return read_flac_tags_hash(input_file)
+
+    def range_flags(self, skip, until=None):
+        flags = '--skip={}'.format(skip)
+        if until is not None:
+            flags += ' --until={}'.format(until)
+
+        return flags
+
 
 class WAVDecoder(Codec):
     def __init__(self,
@@ -185,6 +474,9 @@ class WAVDecoder(Codec):
                  cmd_seq="""{exe} "{input_file}" {flags}"""):
         Codec.__init__(self, name, exec_file, ext, cmd_seq, flags)
 
+    def read_stream_info(self, input_file):
+        return read_wav_streaminfo(input_file)
+
 
 # Wave file support for windows (UNTESTED)
 class WINWAVDecoder(Codec):
@@ -196,6 +488,141 @@ class WINWAVDecoder(Codec):
                  cmd_seq="""{exe} "{input_file}" {flags}"""):
         Codec.__init__(self, name, exec_file, ext, cmd_seq, flags)
 
+    def read_stream_info(self, input_file):
+        return read_wav_streaminfo(input_file)
+
+
+def wav_header(channels, sample_rate, bits_per_sample, total_samples):
+    """
+        Returns a 44 byte RIFF WAVE header for PCM audio
+    """
+    block_align = channels * bits_per_sample // 8
+    data_size = total_samples * block_align
+
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       b'RIFF', 36 + data_size, b'WAVE',
+                       b'fmt ', 16, 1, channels, sample_rate,
+                       sample_rate * block_align, block_align, bits_per_sample,
+                       b'data', data_size)
+
+
+class InProcessDecoder(Codec):
+    """
+        Superclass for decoders that run inside the Python process
+        instead of as a separate decoder process.
+
+        Subclasses implement decode(), which writes the source as a
+        WAV stream to a file object (the encoder's stdin). module is the
+        Python module the decoder needs; found_exe is the running
+        interpreter once that module has been imported.
+    """
+    in_process = True
+    module = None
+
+    # Bytes handed to the encoder per write
+    buffer_size = 1 << 18
+
+    def __init__(self, name, ext):
+        Codec.__init__(self, name, os.path.basename(sys.executable), ext, None, "")
+
+    def __str__(self, *args, **kwargs):
+        if self.found_exe:
+            return "{name} : in-process".format(name=self.name)
+
+        return Codec.__str__(self)
+
+    def find_exe(self, cache=None):
+        """
+            Imports the module this decoder needs
+
+            Raises CodecNotFound if the module isn't installed
+        """
+        if self.module is not None:
+            try:
+                mod = __import__(self.module)
+            except ImportError:
+                logger.debug("Python module {} not found".format(self.module))
+                raise CodecNotFound
+
+            self.version = "{} {}".format(self.module, getattr(mod, '__version__', ''))
+        else:
+            self.version = "python {}".format(sys.version.split()[0])
+
+        self.found_exe = sys.executable
+
+    def decode(self, input_file, output):
+        """
+            Must be implemented at the subclass level
+        """
+        raise NotImplementedError
+
+
+class SoundFileFLACDecoder(InProcessDecoder):
+    """
+        Decodes FLAC with libsndfile through the soundfile module
+    """
+    module = "soundfile"
+
+    def __init__(self, name="pyflac", ext=".flac"):
+        InProcessDecoder.__init__(self, name, ext)
+
+    def read_stream_info(self, input_file):
+        return read_flac_streaminfo(input_file)
+
+    def read_tags_hash(self, input_file):
+        return read_flac_tags_hash(input_file)
+
+    def decode(self, input_file, output):
+        import soundfile
+
+        with soundfile.SoundFile(input_file) as f:
+            if f.subtype in ('PCM_S8', 'PCM_U8', 'PCM_16'):
+                bits = 16
+                dtype = 'int16'
+            else:
+                # Carry 24 (and 32) bit sources as 24 bit PCM
+                bits = 24
+                dtype = 'int32'
+
+            output.write(wav_header(f.channels, f.samplerate, bits, f.frames))
+
+            frames = self.buffer_size // (f.channels * bits // 8)
+
+            for block in f.blocks(blocksize=frames, dtype=dtype, always_2d=True):
+                if bits == 16:
+                    output.write(block.astype('<i2').tobytes())
+                else:
+                    # Top three bytes of each little-endian int32 sample
+                    samples = block.astype('<i4').view('u1').reshape(-1, 4)
+                    output.write(samples[:, 1:].tobytes())
+
+
+class PyWAVDecoder(InProcessDecoder):
+    """
+        Streams WAV files (already PCM) straight from a memory map
+    """
+    def __init__(self, name="pywav", ext=".wav"):
+        InProcessDecoder.__init__(self, name, ext)
+
+    def read_stream_info(self, input_file):
+        return read_wav_streaminfo(input_file)
+
+    def decode(self, input_file, output):
+        import mmap
+
+        with open(input_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(m)
+                for offset in range(0, len(m), self.buffer_size):
+                    output.write(view[offset:offset + self.buffer_size])
+                view.release()
+            finally:
+                m.close()
+
 
 #### ENCODERS ####
 
@@ -218,6 +645,9 @@ class FdkAACEncoder(Codec):
         Codec.__init__(self, name, exec_file, ext, cmd_seq, flags)
 
 class AVConvLibFdkAACEncoder(Codec):
+    # Demuxing, resampling and encoding run on their own threads
+    threads_per_job = 2
+
     def __init__(self,
                  name="avconv-fdkaac",
                  exec_file="avconv",
@@ -227,6 +657,9 @@ class AVConvLibFdkAACEncoder(Codec):
         Codec.__init__(self, name, exec_file, ext, cmd_seq, flags)
 
 class FfmpegLibFdkEncoder(Codec):
+    # Demuxing, resampling and encoding run on their own threads
+    threads_per_job = 2
+
     def __init__(self,
                  name="ffmpeg-fdkaac",
                  exec_file="ffmpeg",
@@ -254,6 +687,10 @@ class FfmpegLibFdkEncoder(Codec):
 
 
 class MP3Encoder(Codec):
+    # No bit reservoir: no frame's audio starts in the frame before it.
+    # Costs some quality at a given bitrate.
+    segment_flags = "--nores"
+
     def __init__(self,
                  name="mp3",
                  exec_file="lame",
@@ -293,11 +730,20 @@ class CodecManager(object):
         Manager for all supported codecs.
 
         discover_codecs() must be run before trying to select a codec
+        with get_decoder()/get_encoder(). find_decoder()/find_encoder()
+        instead only probe the codecs matching the requested name.
+
+        probe_cache is an optional CodecProbeCache
 
     """
     __decoders__ = (FLACDecoder,
                     WAVDecoder,
-                    WINWAVDecoder)
+                    WINWAVDecoder,
+                    SoundFileFLACDecoder,
+                    PyWAVDecoder)
+
+    # Decoders tried in order by find_decoder() when none is named
+    default_decoders = ('flac', 'pyflac')
 
     __encoders__ = (MP3Encoder,
                     OGGEncoder,
@@ -306,9 +752,10 @@ class CodecManager(object):
                     AVConvLibFdkAACEncoder,
                     FfmpegLibFdkEncoder,)
 
-    def __init__(self):
+    def __init__(self, probe_cache=None):
         self._avail_decoders = []
         self._avail_encoders = []
+        self.probe_cache = probe_cache
 
     def discover_codecs(self):
         """
@@ -321,7 +768,7 @@ class CodecManager(object):
         for codec in self.__decoders__:
             t_obj = codec()
             try:
-                t_obj.find_exe()
+                t_obj.find_exe(self.probe_cache)
 
             except CodecNotFound:
                 # Don't add to list
@@ -336,7 +783,7 @@ class CodecManager(object):
         for codec in self.__encoders__:
             t_obj = codec()
             try:
-                t_obj.find_exe()
+                t_obj.find_exe(self.probe_cache)
 
             except CodecNotFound:
                 # Don't add to list
@@ -387,6 +834,55 @@ class CodecManager(object):
         logger.debug("Returning {}".format(str(encoder)))
         return encoder
 
+    def _find_codec(self, codec_name, classes, avail):
+        """
+            Probes only the codec class named codec_name, adding it to
+            avail if found
+        """
+        for c in avail:
+            if c.name == codec_name:
+                return c
+
+        for codec in classes:
+            if codec.default_name() != codec_name:
+                continue
+
+            t_obj = codec()
+            try:
+                t_obj.find_exe(self.probe_cache)
+            except (CodecNotFound, CodecNotExecutable, NotCompiledWithCodecSupport) as e:
+                logger.debug("Codec {} not usable: {}".format(t_obj.name, type(e).__name__))
+            else:
+                avail.append(t_obj)
+                logger.debug("Returning {}".format(str(t_obj)))
+                return t_obj
+
+        raise SelectedCodecNotValid
+
+    def find_decoder(self, codec_name=None):
+        """
+            Accepts a name of a codec, and returns codec object,
+            probing only the matching decoder. Without a name, the
+            first of default_decoders found is returned.
+        """
+        if codec_name is not None:
+            return self._find_codec(codec_name, self.__decoders__, self._avail_decoders)
+
+        for name in self.default_decoders:
+            try:
+                return self._find_codec(name, self.__decoders__, self._avail_decoders)
+            except SelectedCodecNotValid:
+                pass
+
+        raise SelectedCodecNotValid
+
+    def find_encoder(self, codec_name):
+        """
+            Accepts a name of a codec, and returns codec object,
+            probing only the matching encoder
+        """
+        return self._find_codec(codec_name, self.__encoders__, self._avail_encoders)
+
     def list_all_decoders(self):
         """
             Returns list of all decoder names
@@ -396,7 +892,7 @@ class CodecManager(object):
 
         # Go through full list and get names
         for c in self.__decoders__:
-            d.append(c().name)
+            d.append(c.default_name())
 
         return d
 
@@ -408,7 +904,7 @@ class CodecManager(object):
         d = []
 
         for c in self.__encoders__:
-            d.append(c().name)
+            d.append(c.default_name())
 
         return d
 
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""
+    Benchmarks for flacthis that don't need real codecs.
+
+    Generates a synthetic library (header-only FLAC files with tags and
+    a cover per album) and stand-in flac/lame executables with a set
+    delay and failure rate, then times:
+
+        scan        get_convert_list() over the whole tree
+        dispatch    start() with a no-op encode, i.e. the worker pool overhead
+        tagging     update_lossy_tags() (needs mutagen)
+        end_to_end  start() with the stand-in codecs, for each thread count
+
+    Each run is appended to a JSON Lines results file along with the
+    flacthis version and git revision, and compared with the last run
+    of a different revision so regressions stand out.
+
+    usage: python benchmarks/bench_flacthis.py [--files 10000,100000] [--threads 1,2,4,8]
+"""
+import os
+import sys
+import json
+import time
+import struct
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import flacthis
+import audio_codecs
+
+
+tracks_per_album = 12
+albums_per_artist = 10
+
+
+def flac_bytes(track, album, artist, samples=44100 * 180):
+    ''' STREAMINFO (with an audio MD5) and VORBIS_COMMENT blocks, no audio frames '''
+    packed = (44100 << 44) | (1 << 41) | (15 << 36) | samples
+    streaminfo = struct.pack('>HH', 4096, 4096) + b'\x00' * 6 + struct.pack('>Q', packed) + \
+        struct.pack('>4I', track, album, artist, 1)
+
+    comments = [u'TITLE=Track {}'.format(track), u'ALBUM=Album {}'.format(album),
+                u'ARTIST=Artist {}'.format(artist), u'TRACKNUMBER={}'.format(track)]
+    vendor = b'flacthis-bench'
+    comment = struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(comments))
+    for c in comments:
+        c = c.encode('utf8')
+        comment += struct.pack('<I', len(c)) + c
+
+    return b'fLaC' + b'\x00' + struct.pack('>I', len(streaminfo))[1:] + streaminfo + \
+        b'\x84' + struct.pack('>I', len(comment))[1:] + comment
+
+
+def make_tree(root, files, covers=True):
+    '''
+        Creates files tracks as artist/album/NN.flac under root, with a
+        cover.jpg in every album directory
+    '''
+    created = 0
+    artist = 0
+    while created < files:
+        for album in range(albums_per_artist):
+            album_dir = os.path.join(root, 'artist{:05d}'.format(artist), 'album{:02d}'.format(album))
+            os.makedirs(album_dir)
+            if covers:
+                with open(os.path.join(album_dir, 'cover.jpg'), 'wb') as f:
+                    f.write(b'\xff\xd8\xff\xe0' + b'\x00' * 1024)
+
+            for track in range(1, tracks_per_album + 1):
+                with open(os.path.join(album_dir, '{:02d}.flac'.format(track)), 'wb') as f:
+                    f.write(flac_bytes(track, album, artist))
+                created += 1
+                if created == files:
+                    return
+        artist += 1
+
+
+def make_codecs(bin_dir, delay, failure_rate):
+    '''
+        Writes stand-in flac and lame executables. Each run sleeps delay
+        seconds and the encoder fails with probability failure_rate.
+    '''
+    flac = '''#!/bin/sh
+if [ "$1" = "-v" ]; then echo "flac 1.3.2 (stand-in)"; exit 0; fi
+for a in "$@"; do case "$a" in -*) ;; *) f="$a";; esac; done
+sleep {delay}
+cat "$f"
+'''.format(delay=delay)
+
+    lame = '''#!/bin/sh
+if [ "$1" = "--version" ]; then echo "LAME 3.100 (stand-in)"; exit 0; fi
+sleep {delay}
+if [ "$(od -An -N2 -tu2 /dev/urandom)" -lt {threshold} ]; then cat > /dev/null; exit 1; fi
+cat > "$2"
+'''.format(delay=delay, threshold=int(failure_rate * 65536))
+
+    for name, script in (('flac', flac), ('lame', lame)):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+
+
+def make_converter(src, dest, threads, decoder, encoder, no_artwork=False, disable_id3=True):
+    config = flacthis.ConverterConfig()
+    config.source_dir = src
+    config.dest_dir = dest
+    config.threads = threads
+    config.decoder = decoder
+    config.encoder = encoder
+    config.no_artwork = no_artwork
+    config.disable_id3 = disable_id3
+    config.retries = 0      # Count every stand-in failure
+    return flacthis.LosslessToLossyConverter(config)
+
+
+def timed(func):
+    started = time.time()
+    func()
+    return time.time() - started
+
+
+def bench_scan(work, src, files, threads, decoder, encoder):
+    dest = os.path.join(work, 'dest-scan')
+    os.makedirs(dest)
+    conv = make_converter(src, dest, threads, decoder, encoder)
+
+    seconds = timed(conv.get_convert_list)
+    assert len(conv.to_convert) == files
+    return {'seconds': seconds, 'files_per_second': files / seconds}
+
+
+def bench_dispatch(work, src, files, threads, decoder, encoder):
+    dest = os.path.join(work, 'dest-dispatch')
+    os.makedirs(dest)
+    conv = make_converter(src, dest, threads, decoder, encoder, no_artwork=True)
+
+    def no_encode(lossless_file, targets, metrics=None):
+        conv.record_success()
+        return [0] * len(targets)
+
+    conv.encode_and_tagging = no_encode
+    seconds = timed(conv.start)
+    assert conv.success == files
+    return {'seconds': seconds, 'jobs_per_second': files / seconds}
+
+
+def bench_tagging(work, src, decoder, encoder, count=500):
+    try:
+        import mutagen
+    except ImportError:
+        return None
+
+    dest = os.path.join(work, 'dest-tagging')
+    os.makedirs(dest)
+    conv = make_converter(src, dest, 1, decoder, encoder, disable_id3=False)
+
+    conv.get_convert_list()
+    pairs = []
+    for i, (rel_path, needed) in enumerate(sorted(conv.to_convert)[:count]):
+        mp3 = os.path.join(dest, '{}.mp3'.format(i))
+        with open(mp3, 'wb') as f:
+            f.write((b'\xff\xfb\x90\x00' + b'\x00' * 413) * 10)
+        pairs.append((os.path.join(src, rel_path), mp3))
+
+    def tag_all():
+        for lossless_file, lossy_file in pairs:
+            conv.update_lossy_tags(lossless_file, lossy_file)
+
+    seconds = timed(tag_all)
+    assert not conv.error_id3, conv.error_id3
+    return {'seconds': seconds, 'files_per_second': len(pairs) / seconds}
+
+
+def bench_end_to_end(work, files, thread_counts, decoder, encoder):
+    src = os.path.join(work, 'src-e2e')
+    make_tree(src, files)
+
+    results = {}
+    for threads in thread_counts:
+        dest = os.path.join(work, 'dest-e2e-{}'.format(threads))
+        os.makedirs(dest)
+        conv = make_converter(src, dest, threads, decoder, encoder)
+
+        seconds = timed(conv.start)
+        results[str(threads)] = {'seconds': seconds,
+                                 'files_per_second': files / seconds,
+                                 'failed': len(conv.error_conv)}
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    ''' {'a': {'b': 1}} -> {'a.b': 1} '''
+    flat = {}
+    for k, v in results.items():
+        if isinstance(v, dict):
+            flat.update(flatten(v, prefix + k + '.'))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+
+def compare(run, results_file):
+    ''' Prints the change of every result since the last run of another revision '''
+    previous = None
+    if os.path.exists(results_file):
+        with open(results_file) as f:
+            for line in f:
+                record = json.loads(line)
+                if (record['version'], record['revision']) != (run['version'], run['revision']) \
+                        and record['params'] == run['params']:
+                    previous = record
+
+    if previous is None:
+        print('No earlier run with the same parameters to compare with')
+        return
+
+    print('Compared with {} ({}):'.format(previous['version'], previous['revision']))
+    old = flatten(previous['results'])
+    for name, value in sorted(flatten(run['results']).items()):
+        if name in old and old[name] and isinstance(value, float):
+            print('  {:45} {:12.3f} {:+7.1f}%'.format(name, value, 100.0 * (value - old[name]) / old[name]))
+
+
+def parse_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark flacthis with stand-in codecs')
+    parser.add_argument('--files', type=parse_list, default=[10000],
+                        help='Comma separated library sizes for the scan and dispatch '
+                             'benchmarks (default: 10000)')
+    parser.add_argument('--threads', type=parse_list, default=[1, 2, 4, 8],
+                        help='Comma separated thread counts for the end to end benchmark '
+                             '(default: 1,2,4,8)')
+    parser.add_argument('--e2e-files', type=int, default=200,
+                        help='Library size for the end to end benchmark (default: 200)')
+    parser.add_argument('--codec-delay', type=float, default=0.01,
+                        help='Seconds each stand-in codec process takes (default: 0.01)')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Probability of a stand-in encode failing (default: 0)')
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(__file__), 'results.jsonl'),
+                        help='JSON Lines file runs are appended to (default: benchmarks/results.jsonl)')
+    parser.add_argument('--workdir', help='Directory for the synthetic trees (default: a temporary directory)')
+    args = parser.parse_args(args)
+
+    work = tempfile.mkdtemp(prefix='flacthis-bench-', dir=args.workdir)
+    bin_dir = os.path.join(work, 'bin')
+    os.makedirs(bin_dir)
+    make_codecs(bin_dir, args.codec_delay, args.failure_rate)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    decoder = audio_codecs.FLACDecoder()
+    encoder = audio_codecs.MP3Encoder()
+    decoder.find_exe()
+    encoder.find_exe()
+
+    params = {'files': args.files, 'threads': args.threads, 'e2e_files': args.e2e_files,
+              'codec_delay': args.codec_delay, 'failure_rate': args.failure_rate}
+    results = {}
+
+    try:
+        for files in args.files:
+            src = os.path.join(work, 'src-{}'.format(files))
+            print('Generating {} files'.format(files))
+            make_tree(src, files)
+
+            results['scan.{}'.format(files)] = bench_scan(work, src, files, max(args.threads),
+                                                          decoder, encoder)
+            results['dispatch.{}'.format(files)] = bench_dispatch(work, src, files, max(args.threads),
+                                                                  decoder, encoder)
+            shutil.rmtree(os.path.join(work, 'dest-scan'))
+            shutil.rmtree(os.path.join(work, 'dest-dispatch'))
+
+        tagging = bench_tagging(work, src, decoder, encoder)
+        if tagging is not None:
+            results['tagging'] = tagging
+
+        results['end_to_end'] = bench_end_to_end(work, args.e2e_files, args.threads, decoder, encoder)
+
+    finally:
+        shutil.rmtree(work)
+
+    run = {'version': flacthis.__version__,
+           'revision': git_revision(),
+           'python': sys.version.split()[0],
+           'host': socket.gethostname(),
+           'time': time.time(),
+           'params': params,
+           'results': results}
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    compare(run, args.results)
+
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(run, sort_keys=True) + '\n')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,324 @@
+"""
+    CPU detection and load-adaptive worker limits.
+
+    available_cpus() counts the CPUs this process may actually use: its
+    scheduler affinity, capped by a cgroup CPU quota (cpu.max on cgroup
+    v2, cpu.cfs_quota_us on v1) such as a container's --cpus.
+
+    While converting, an AdaptiveController samples CPU use and iowait
+    and raises or lowers the number of workers allowed to run jobs at
+    once (a WorkerLimiter) between a minimum and a maximum.
+"""
+import os
+import math
+import time
+import logging
+import threading
+import multiprocessing
+
+
+logger = logging.getLogger(__name__)
+
+cgroup_root = '/sys/fs/cgroup'
+
+
+def affinity_cpus():
+    """ Number of CPUs this process is allowed to run on """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not Linux, or Python 2
+        return multiprocessing.cpu_count()
+
+
+def read_quota(quota_file, period_file=None):
+    """
+        Reads a CPU quota as a number of CPUs from a cgroup v2 cpu.max
+        ("max 100000" or "200000 100000") or, with period_file, from
+        cgroup v1 cpu.cfs_quota_us/cpu.cfs_period_us.
+
+        Returns None if there's no quota (or no such file)
+    """
+    try:
+        with open(quota_file) as f:
+            fields = f.read().split()
+        if period_file is not None:
+            with open(period_file) as f:
+                fields.append(f.read().strip())
+    except (IOError, OSError):
+        return None
+
+    if len(fields) < 2 or fields[0] in ('max', '-1'):
+        return None
+
+    try:
+        quota, period = int(fields[0]), int(fields[1])
+    except ValueError:
+        return None
+
+    if quota <= 0 or period <= 0:
+        return None
+
+    return float(quota) / period
+
+
+def cgroup_v2_dir(root=None, proc_cgroup='/proc/self/cgroup'):
+    """
+        Returns the directory of this process' cgroup v2 group, or None
+        if cgroup v2 isn't in use
+    """
+    root = root or cgroup_root
+    try:
+        with open(proc_cgroup) as f:
+            for line in f:
+                hierarchy, controllers, path = line.rstrip('\n').split(':', 2)
+                if hierarchy == '0' and controllers == '':
+                    d = os.path.join(root, path.lstrip('/'))
+                    if os.path.exists(os.path.join(d, 'cgroup.controllers')):
+                        return d
+                    # Namespaced container: our group is mounted at the root
+                    return root if os.path.exists(os.path.join(root, 'cgroup.controllers')) else None
+    except (IOError, OSError, ValueError):
+        pass
+
+    return None
+
+
+def cgroup_cpu_limit(root=None, proc_cgroup='/proc/self/cgroup'):
+    """
+        Returns the tightest CPU quota of this process' cgroup and its
+        ancestors as a number of CPUs (may be fractional), or None
+    """
+    root = root or cgroup_root
+    limits = []
+
+    d = cgroup_v2_dir(root, proc_cgroup)
+    if d is not None:
+        while True:
+            limits.append(read_quota(os.path.join(d, 'cpu.max')))
+            if os.path.normpath(d) == os.path.normpath(root):
+                break
+            d = os.path.dirname(d)
+    else:
+        for name in ('cpu', 'cpu,cpuacct', 'cpuacct,cpu'):
+            d = os.path.join(root, name)
+            limits.append(read_quota(os.path.join(d, 'cpu.cfs_quota_us'),
+                                     os.path.join(d, 'cpu.cfs_period_us')))
+
+    limits = [l for l in limits if l is not None]
+    return min(limits) if limits else None
+
+
+def available_cpus():
+    """
+        Number of CPUs available to this process: its affinity mask,
+        capped by any cgroup CPU quota (rounded up). At least 1.
+    """
+    cpus = affinity_cpus()
+    limit = cgroup_cpu_limit()
+
+    if limit is not None:
+        logger.debug('cgroup CPU quota: {} CPUs'.format(limit))
+        cpus = min(cpus, int(math.ceil(limit)))
+
+    return max(1, cpus)
+
+
+class CpuSampler(object):
+    """
+        Measures CPU use and iowait between calls to sample().
+
+        CPU use is a fraction of the CPUs available to us, from the
+        cgroup's cpu.stat when there is a quota (so other containers
+        on the host don't count) and from /proc/stat otherwise. iowait
+        always comes from /proc/stat.
+    """
+
+    def __init__(self, cpus, cgroup_dir=None):
+        self.cpus = cpus
+        self.cgroup_stat = None
+        if cgroup_dir is not None and cgroup_cpu_limit() is not None:
+            self.cgroup_stat = os.path.join(cgroup_dir, 'cpu.stat')
+        self._last = self.read()
+
+    @staticmethod
+    def read_proc_stat():
+        """ Returns (busy, iowait, total) jiffies over all CPUs """
+        with open('/proc/stat') as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+
+        # user nice system idle iowait irq softirq steal (guest is in user)
+        idle, iowait = fields[3], fields[4]
+        total = sum(fields[:8])
+        return total - idle - iowait, iowait, total
+
+    def read_cgroup_usage(self):
+        """ Returns the cgroup's CPU time in seconds """
+        with open(self.cgroup_stat) as f:
+            for line in f:
+                name, value = line.split()
+                if name == 'usage_usec':
+                    return int(value) / 1e6
+        return None
+
+    def read(self):
+        usage = None
+        if self.cgroup_stat is not None:
+            try:
+                usage = self.read_cgroup_usage()
+            except (IOError, OSError, ValueError):
+                self.cgroup_stat = None
+        return time.time(), usage, self.read_proc_stat()
+
+    def sample(self):
+        """
+            Returns (cpu use, iowait) as fractions since the previous call
+        """
+        now = self.read()
+        (t0, usage0, (busy0, iowait0, total0)), (t1, usage1, (busy1, iowait1, total1)) = self._last, now
+        self._last = now
+
+        total = float(total1 - total0) or 1.0
+        iowait = (iowait1 - iowait0) / total
+
+        if usage0 is not None and usage1 is not None and t1 > t0:
+            cpu_use = (usage1 - usage0) / ((t1 - t0) * self.cpus)
+        else:
+            cpu_use = (busy1 - busy0) / total
+
+        return cpu_use, iowait
+
+
+class WorkerLimiter(object):
+    """
+        Lets at most limit workers run jobs at once. The limit can be
+        changed at any time; workers above a lowered limit finish their
+        current job first.
+
+        listeners are called without arguments whenever places are
+        released or the limit changes, for workers that don't block in
+        acquire() (the asyncio engine).
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0        # Workers blocked in acquire() or wait()
+        self.listeners = []
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            self.waiting += 1
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.waiting -= 1
+            self.active += 1
+
+    def wait(self):
+        """
+            Waits until a place is free without taking it, e.g. before
+            taking a job that try_acquire() then runs
+        """
+        with self._cond:
+            self.waiting += 1
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.waiting -= 1
+
+    def try_acquire(self, count=1):
+        """
+            Takes up to count free places without waiting, e.g. for the
+            extra processes of one job. Returns how many it took.
+        """
+        with self._cond:
+            taken = max(0, min(count, self.limit - self.active))
+            self.active += taken
+            return taken
+
+    def release(self, count=1):
+        with self._cond:
+            self.active -= count
+            self._cond.notify(count)
+        self.notify_listeners()
+
+    def set_limit(self, limit):
+        with self._cond:
+            self.limit = limit
+            self._cond.notify_all()
+        self.notify_listeners()
+
+    def notify_listeners(self):
+        for listener in self.listeners:
+            listener()
+
+
+class AdaptiveController(object):
+    """
+        Adjusts a WorkerLimiter every interval seconds:
+
+        - one more worker while CPU use is low and jobs are waiting
+          (e.g. encoders waiting on a network filesystem)
+        - one less while iowait is high, or while the CPUs are saturated
+          with more workers than CPUs
+    """
+
+    interval = 5.0          # Seconds between adjustments
+    low_cpu = 0.80          # Grow below this CPU use
+    high_cpu = 0.98         # Shrink above this, when there are more workers than CPUs
+    high_iowait = 0.25      # Shrink above this iowait
+
+    def __init__(self, limiter, min_workers, max_workers, cpus, sampler=None):
+        self.limiter = limiter
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.cpus = cpus
+        self.sampler = sampler
+        self._stop = threading.Event()
+        self._thread = None
+
+    def adjust(self, cpu_use, iowait, jobs_waiting):
+        """
+            Applies one measurement. Returns the new limit.
+        """
+        limit = self.limiter.limit
+
+        if iowait > self.high_iowait or (cpu_use > self.high_cpu and limit > self.cpus):
+            limit -= 1
+        elif cpu_use < self.low_cpu and jobs_waiting:
+            limit += 1
+
+        limit = max(self.min_workers, min(self.max_workers, limit))
+
+        if limit != self.limiter.limit:
+            logger.debug('CPU use {:.0%}, iowait {:.0%}: {} workers'.format(cpu_use, iowait, limit))
+            self.limiter.set_limit(limit)
+
+        return limit
+
+    def run(self, jobs_waiting):
+        """
+            Adjusts the limit until stop(). jobs_waiting is a callable
+            returning True while jobs are queued.
+        """
+        if self.sampler is None:
+            self.sampler = CpuSampler(self.cpus, cgroup_v2_dir())
+
+        while not self._stop.wait(self.interval):
+            try:
+                cpu_use, iowait = self.sampler.sample()
+            except (IOError, OSError) as e:
+                logger.debug('Could not sample CPU use: {}'.format(e))
+                return
+
+            self.adjust(cpu_use, iowait, jobs_waiting())
+
+    def start(self, jobs_waiting):
+        self._thread = threading.Thread(target=self.run, args=(jobs_waiting,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
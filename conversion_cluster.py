@@ -0,0 +1,417 @@
+"""
+    Coordinator/worker mode.
+
+    The coordinator scans the source directory and hands jobs to worker
+    processes over TCP. Workers (possibly on other hosts sharing the same
+    source and destination mounts) convert them with their own
+    LosslessToLossyConverter and report the results back.
+
+    The protocol is one JSON object per line:
+
+        worker -> coordinator   {"hello": hostname}
+        coordinator -> worker   {"job": id, "kind": SCAN_CONVERT|SCAN_RETAG|SCAN_MOVE,
+                                 "path": relative path, "outputs": [index, ...]}
+                                {"done": true}
+        worker -> coordinator   {"result": id, "results": [0|1, ...], "success": n,
+                                 "retagged": n, "moved": n, "error_conv": [...],
+                                 "error_id3": [...]}
+
+    Output indexes refer to LosslessToLossyConverter.outputs(), so the
+    coordinator and workers must be started with the same -o options.
+    A job whose worker disconnects before replying is queued again.
+
+    There is no authentication, so the coordinator listens on localhost
+    unless given a host. Workers only accept jobs for paths inside their
+    source directory, and hang up on any other job.
+"""
+import os
+import copy
+import json
+import socket
+import logging
+import threading
+
+import conversion_metrics
+import scratch
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver  # Python 2
+
+try:
+    text_types = (str, unicode)  # Python 2: json returns unicode
+except NameError:
+    text_types = (str,)
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_address(address):
+    """
+        Splits HOST:PORT into a (host, port) tuple
+    """
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError('Address must be HOST:PORT, got {}'.format(address))
+
+    return host or 'localhost', int(port)
+
+
+def send_message(f, message):
+    f.write(json.dumps(message).encode('utf8') + b'\n')
+    f.flush()
+
+
+def read_message(f):
+    """
+        Returns the next message, or None if the connection closed
+    """
+    line = f.readline()
+    if not line:
+        return None
+
+    return json.loads(line.decode('utf8'))
+
+
+def check_job(message, kinds, output_count):
+    """
+        Raises ValueError unless a job message is for a path inside the
+        source directory, a known kind and existing outputs
+    """
+    path = message.get('path')
+    if not isinstance(path, text_types) or not path or '\0' in path or os.path.isabs(path):
+        raise ValueError('Invalid job path {!r}'.format(path))
+
+    normalized = os.path.normpath(path)
+    if normalized == os.pardir or normalized.startswith(os.pardir + os.sep):
+        raise ValueError('Job path outside the source directory: {!r}'.format(path))
+
+    if message.get('kind') not in kinds:
+        raise ValueError('Invalid job kind {!r}'.format(message.get('kind')))
+
+    outputs = message.get('outputs')
+    if not isinstance(outputs, list) or \
+            not all(isinstance(i, int) and 0 <= i < output_count for i in outputs):
+        raise ValueError('Invalid job outputs {!r}'.format(outputs))
+
+
+def enable_keepalive(sock):
+    """
+        Detects dead peers (e.g. a crashed host) within a couple of
+        minutes instead of the system default of hours
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for opt, value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 6)):
+        if hasattr(socket, opt):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+
+
+class ClusterJob(object):
+    __slots__ = ('id', 'kind', 'rel_path', 'key', 'outputs', 'stat', 'attempts')
+
+    def __init__(self, id, kind, rel_path, key, outputs, stat):
+        self.id = id
+        self.kind = kind
+        self.rel_path = rel_path
+        self.key = key
+        self.outputs = outputs
+        self.stat = stat
+        self.attempts = 0
+
+
+class ClusterCoordinator(object):
+    """
+        Runs the source scan and serves jobs to workers until every
+        job has been converted (or given up on).
+
+        Results are recorded on the converter, so print_results()
+        works the same as for a local run.
+    """
+
+    # Attempts before a job that keeps losing its worker is given up on
+    max_attempts = 3
+
+    # Seconds between checks for the end of the run while idle
+    poll_interval = 1.0
+
+    def __init__(self, converter, address):
+        self.converter = converter
+        self.address = parse_address(address)
+
+        # Items are (schedule key, job id, job)
+        self.jobs = queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.outstanding = 0        # Jobs queued or running
+        self.job_count = 0          # Jobs created (used for ids)
+        self.scan_finished = False
+        self.finished = threading.Event()
+        self.listening = threading.Event()
+        self.server_address = None
+
+    def next_job(self):
+        """
+            Blocks until a job is available. Returns None once the run
+            is finished.
+        """
+        while not self.finished.is_set():
+            try:
+                return self.jobs.get(timeout=self.poll_interval)[-1]
+            except queue.Empty:
+                pass
+
+        return None
+
+    def job_done(self):
+        with self.lock:
+            self.outstanding -= 1
+            if self.scan_finished and self.outstanding == 0:
+                self.finished.set()
+
+    def requeue(self, job):
+        """
+            Puts back a job whose worker went away
+        """
+        job.attempts += 1
+
+        if job.attempts >= self.max_attempts:
+            logger.error('Giving up on {} after {} attempts'.format(job.rel_path, job.attempts))
+            lossless_file = os.path.join(self.converter.source_dir, job.rel_path)
+            outputs = self.converter.outputs()
+            for i in job.outputs:
+                self.converter.record_conv_error(lossless_file, outputs[i])
+            self.job_done()
+        else:
+            logger.warning('Worker lost while converting {}, re-queuing'.format(job.rel_path))
+            self.jobs.put((job.key, job.id, job))
+
+    def record_result(self, job, reply):
+        conv = self.converter
+
+        with conv.results_lock:
+            conv.success += reply['success']
+            conv.retagged += reply.get('retagged', 0)
+            conv.moved += reply.get('moved', 0)
+            conv.error_conv.extend(reply['error_conv'])
+            conv.error_id3.extend(reply['error_id3'])
+
+        if conv.manifest is not None and job.stat is not None:
+            outputs = conv.outputs()
+            lossless_file = os.path.join(conv.source_dir, job.rel_path)
+            for i, result in zip(job.outputs, reply['results']):
+                if result == 0:
+                    conv.record_manifest(lossless_file, job.stat, outputs[i],
+                                         conv.translate_src_to_dest(lossless_file, outputs[i]))
+
+        self.job_done()
+
+    def handle_worker(self, sock):
+        """
+            Serves jobs to one connected worker until the run finishes
+            or the worker disconnects
+        """
+        enable_keepalive(sock)
+        f = sock.makefile('rwb')
+        job = None
+
+        try:
+            hello = read_message(f)
+            if hello is None:
+                return
+            logger.info('Worker connected: {}'.format(hello.get('hello')))
+
+            while True:
+                job = self.next_job()
+                if job is None:
+                    send_message(f, {'done': True})
+                    return
+
+                send_message(f, {'job': job.id, 'kind': job.kind, 'path': job.rel_path,
+                                 'outputs': list(job.outputs)})
+                reply = read_message(f)
+
+                if reply is None or reply.get('result') != job.id:
+                    break
+
+                self.record_result(job, reply)
+                job = None
+
+        except (IOError, OSError, ValueError) as e:
+            logger.debug('Worker connection error: {}'.format(e))
+
+        finally:
+            if job is not None:
+                self.requeue(job)
+            f.close()
+
+    def run(self):
+        coordinator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                coordinator.handle_worker(self.request)
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        server = Server(self.address, Handler)
+        serve_thread = threading.Thread(target=server.serve_forever)
+        serve_thread.daemon = True
+        serve_thread.start()
+        self.server_address = server.server_address
+        self.listening.set()
+        logger.info('Coordinator listening on {}:{}'.format(*server.server_address))
+
+        conv = self.converter
+
+        try:
+            for kind, rel_path, key, needed in conv.scan_source():
+                if kind != conv.SCAN_ARTWORK:
+                    stat = None
+                    if conv.manifest is not None:
+                        stat = os.stat(os.path.join(conv.source_dir, rel_path))
+
+                    with self.lock:
+                        self.outstanding += 1
+                    self.job_count += 1
+                    job = ClusterJob(self.job_count, kind, rel_path, key, needed, stat)
+                    self.jobs.put((key, job.id, job))
+                else:
+                    conv.to_copy.append((rel_path, needed))
+
+            if not conv.no_artwork:
+                conv.copy_artwork()
+
+            with self.lock:
+                self.scan_finished = True
+                if self.outstanding == 0:
+                    self.finished.set()
+
+            self.finished.wait()
+
+        finally:
+            self.finished.set()
+            server.shutdown()
+            server.server_close()
+            conv.close()
+
+
+class ClusterWorker(object):
+    """
+        Connects to a coordinator and converts the jobs it hands out.
+
+        Each of the threads runs its own connection and its own
+        converter built from config, so the results of a job can be
+        read off that converter without locking. The converters share
+        one metrics recorder and scratch space.
+    """
+
+    # Seconds between attempts to reach the coordinator
+    retry_interval = 2.0
+    connect_attempts = 30
+
+    def __init__(self, config, address, converter_class):
+        self.config = config
+        self.address = parse_address(address)
+        self.converter_class = converter_class
+        self.metrics = None
+        self.scratch = None
+
+    def connect(self):
+        for attempt in range(self.connect_attempts):
+            try:
+                return socket.create_connection(self.address)
+            except (IOError, OSError) as e:
+                logger.debug('Could not reach coordinator: {}'.format(e))
+                threading.Event().wait(self.retry_interval)
+
+        raise IOError('Could not connect to coordinator at {}:{}'.format(*self.address))
+
+    def run_connection(self):
+        config = copy.copy(self.config)
+        config.metrics = config.metrics_textfile = None
+        config.scratch_dir = None
+        conv = self.converter_class(config)
+        conv.metrics = self.metrics
+        conv.scratch = self.scratch
+
+        try:
+            sock = self.connect()
+        except IOError as e:
+            logger.error(str(e))
+            return
+
+        enable_keepalive(sock)
+        f = sock.makefile('rwb')
+
+        try:
+            send_message(f, {'hello': socket.gethostname()})
+            outputs = conv.outputs()
+            kinds = (conv.SCAN_CONVERT, conv.SCAN_RETAG, conv.SCAN_MOVE)
+
+            while True:
+                message = read_message(f)
+                if message is None or message.get('done'):
+                    return
+
+                try:
+                    check_job(message, kinds, len(outputs))
+                except ValueError as e:
+                    logger.error('Refusing job from {}:{}: {}'.format(self.address[0], self.address[1], e))
+                    return
+
+                success = conv.success
+                retagged = conv.retagged
+                moved = conv.moved
+                n_conv = len(conv.error_conv)
+                n_id3 = len(conv.error_id3)
+
+                try:
+                    results = conv.run_job(message['kind'], message['path'], message['outputs'])
+                except Exception:
+                    lossless_file = os.path.join(conv.source_dir, message['path'])
+                    logger.exception('Worker failed on {}'.format(lossless_file))
+                    for i in message['outputs']:
+                        conv.record_conv_error(lossless_file, outputs[i])
+                    results = [1] * len(message['outputs'])
+
+                send_message(f, {'result': message['job'],
+                                 'results': results,
+                                 'success': conv.success - success,
+                                 'retagged': conv.retagged - retagged,
+                                 'moved': conv.moved - moved,
+                                 'error_conv': conv.error_conv[n_conv:],
+                                 'error_id3': conv.error_id3[n_id3:]})
+        finally:
+            f.close()
+            sock.close()
+
+    def run(self, threads):
+        if self.config.metrics or self.config.metrics_textfile:
+            self.metrics = conversion_metrics.MetricsRecorder(self.config.metrics,
+                                                              self.config.metrics_textfile)
+        if self.config.scratch_dir and not self.config.noop:
+            self.scratch = scratch.ScratchSpace(self.config.scratch_dir, self.config.scratch_size)
+
+        workers = []
+        for i in range(threads):
+            t = threading.Thread(target=self.run_connection)
+            t.daemon = True
+            t.start()
+            workers.append(t)
+
+        for t in workers:
+            t.join()
+
+        if self.metrics is not None:
+            self.metrics.close()
+
+        if self.scratch is not None:
+            self.scratch.close()
@@ -0,0 +1,149 @@
+import os
+import logging
+import sqlite3
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionManifest(object):
+    """
+        Persistent record of finished conversions, stored in SQLite.
+
+        Each row ties a source file (path relative to the source
+        directory) and the output path it was converted to with the
+        source size/mtime and the encoder name and flags at the time it
+        was converted. The source's audio MD5 and a hash of its tags are
+        kept too, so a source whose tags alone changed can be retagged
+        instead of re-encoded, and with its duration a moved source can
+        be matched to its earlier output. Later runs check sources
+        against the manifest instead of stat'ing every output on the
+        destination.
+
+        The manifest is shared by all converter threads, so every
+        access goes through a single lock.
+    """
+
+    UNKNOWN = 0     # No record for this source/output
+    CURRENT = 1     # Recorded and source unchanged
+    CHANGED = 2     # Recorded but source, encoder or encoder flags changed
+
+    # Commit after this many new records (and on close)
+    commit_interval = 500
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = 0
+
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        logger.debug("Opening conversion manifest {}".format(path))
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS conversions (
+                                source TEXT NOT NULL,
+                                output TEXT NOT NULL,
+                                encoder TEXT NOT NULL,
+                                flags TEXT NOT NULL,
+                                size INTEGER NOT NULL,
+                                mtime REAL NOT NULL,
+                                audio_md5 TEXT,
+                                tags_hash TEXT,
+                                duration REAL,
+                                PRIMARY KEY (source, output))""")
+
+        # Manifests written before audio_md5/tags_hash/duration existed
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(conversions)")]
+        for column, column_type in (('audio_md5', 'TEXT'), ('tags_hash', 'TEXT'), ('duration', 'REAL')):
+            if column not in columns:
+                self._db.execute("ALTER TABLE conversions ADD COLUMN {} {}".format(column, column_type))
+
+        self._db.execute("CREATE INDEX IF NOT EXISTS conversions_audio_md5 ON conversions (audio_md5)")
+
+        self._db.commit()
+
+    def check(self, source, stat, encoder, output):
+        """
+            Compares a source file's os.stat() result and the selected
+            encoder against the manifest entry for output.
+
+            Returns UNKNOWN, CURRENT or CHANGED
+        """
+        with self._lock:
+            row = self._db.execute("SELECT encoder, flags, size, mtime FROM conversions "
+                                   "WHERE source = ? AND output = ?",
+                                   (source, output)).fetchone()
+        if row is None:
+            return self.UNKNOWN
+
+        if row != (encoder.name, encoder.flags, stat.st_size, stat.st_mtime):
+            return self.CHANGED
+
+        return self.CURRENT
+
+    def get(self, source, output):
+        """
+            Returns the entry for source and output as a dict, or None
+        """
+        with self._lock:
+            cursor = self._db.execute("SELECT encoder, flags, size, mtime, audio_md5, tags_hash "
+                                      "FROM conversions WHERE source = ? AND output = ?",
+                                      (source, output))
+            row = cursor.fetchone()
+
+        if row is None:
+            return None
+
+        return dict(zip([d[0] for d in cursor.description], row))
+
+    def find_audio(self, audio_md5, encoder):
+        """
+            Returns the entries (as dicts) of outputs encoded by encoder,
+            with its current flags, from sources with this audio MD5
+        """
+        with self._lock:
+            cursor = self._db.execute("SELECT source, output, size, duration FROM conversions "
+                                      "WHERE audio_md5 = ? AND encoder = ? AND flags = ?",
+                                      (audio_md5, encoder.name, encoder.flags))
+            rows = cursor.fetchall()
+
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in rows]
+
+    def record(self, source, stat, encoder, output, audio_md5=None, tags_hash=None, duration=None):
+        """
+            Records (or replaces) a finished conversion
+        """
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO conversions "
+                             "(source, output, encoder, flags, size, mtime, audio_md5, tags_hash, duration) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (source, output, encoder.name, encoder.flags,
+                              stat.st_size, stat.st_mtime, audio_md5, tags_hash, duration))
+            self._pending += 1
+
+            if self._pending >= self.commit_interval:
+                self._db.commit()
+                self._pending = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM conversions").fetchone()[0]
+
+    def commit(self):
+        """
+            Commits pending records now, e.g. when a long-running
+            process goes idle
+        """
+        with self._lock:
+            if self._pending:
+                self._db.commit()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
@@ -0,0 +1,197 @@
+"""
+    Per-job performance metrics.
+
+    Every finished job is written as one JSON object per line. At the
+    end of the run a summary is written in the Prometheus text format,
+    for node_exporter's textfile collector.
+"""
+import os
+import json
+import time
+import errno
+import logging
+import threading
+import collections
+
+
+logger = logging.getLogger(__name__)
+
+
+def exit_code(status):
+    """
+        Converts a wait() status to a Popen style return code
+        (negative signal number if the process was killed)
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+
+    return os.WEXITSTATUS(status)
+
+
+def wait_process(p):
+    """
+        Waits for a subprocess.Popen like p.wait() and returns its
+        resource usage from os.wait4(), or None where that isn't
+        available
+    """
+    if not hasattr(os, 'wait4') or p.returncode is not None:
+        p.wait()
+        return None
+
+    try:
+        pid, status, usage = os.wait4(p.pid, 0)
+    except OSError as e:
+        if e.errno != errno.ECHILD:
+            raise
+        p.wait()
+        return None
+
+    p.returncode = exit_code(status)
+    return usage
+
+
+class EncoderTotals(object):
+    __slots__ = ('jobs', 'failures', 'wall', 'user_cpu', 'sys_cpu', 'bytes_written')
+
+    def __init__(self):
+        self.jobs = 0
+        self.failures = 0
+        self.wall = 0.0
+        self.user_cpu = 0.0
+        self.sys_cpu = 0.0
+        self.bytes_written = 0
+
+
+class MetricsRecorder(object):
+    """
+        Writes job records to a JSON Lines file (path) and keeps the
+        totals written to a Prometheus textfile (textfile) by close().
+        Either can be None. Shared by all converter threads.
+    """
+
+    def __init__(self, path=None, textfile=None):
+        self.path = path
+        self.textfile = textfile
+        self._lock = threading.Lock()
+        self._file = open(path, 'a') if path else None
+        self.started = time.time()
+
+        self.jobs = collections.Counter()           # (kind, result) -> count
+        self.encoders = collections.defaultdict(EncoderTotals)
+        self.decode_user_cpu = 0.0
+        self.decode_sys_cpu = 0.0
+        self.audio_seconds = 0.0
+        self.bytes_read = 0
+        self.queue_seconds = 0.0
+        self.queue_seconds_max = 0.0
+        self.prefetch = collections.Counter()       # Read-ahead state at job start -> count
+
+    def record(self, entry):
+        """
+            Writes a job record (dict) and adds it to the totals
+        """
+        entry['time'] = round(time.time(), 3)
+        line = json.dumps(entry, sort_keys=True) + '\n'
+
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+                self._file.flush()
+
+            failed = any(entry.get('results', ()))
+            self.jobs[(entry.get('kind', 'encode'), 'failure' if failed else 'success')] += 1
+            self.decode_user_cpu += entry.get('decode_user_cpu') or 0.0
+            self.decode_sys_cpu += entry.get('decode_sys_cpu') or 0.0
+            self.bytes_read += entry.get('bytes_read') or 0
+            if not failed:
+                self.audio_seconds += entry.get('duration') or 0.0
+
+            queue_time = entry.get('queue_time') or 0.0
+            self.queue_seconds += queue_time
+            self.queue_seconds_max = max(self.queue_seconds_max, queue_time)
+            if entry.get('prefetch'):
+                self.prefetch[entry['prefetch']] += 1
+
+            for output in entry.get('outputs', ()):
+                totals = self.encoders[output['encoder']]
+                totals.jobs += 1
+                totals.failures += 1 if output.get('result') else 0
+                totals.wall += output.get('encode_wall') or 0.0
+                totals.user_cpu += output.get('user_cpu') or 0.0
+                totals.sys_cpu += output.get('sys_cpu') or 0.0
+                totals.bytes_written += output.get('bytes_written') or 0
+
+    def prometheus_text(self):
+        """
+            Returns the run totals in the Prometheus text format
+        """
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP flacthis_{} {}'.format(name, help))
+            lines.append('# TYPE flacthis_{} {}'.format(name, kind))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+                lines.append('flacthis_{}{} {}'.format(name, '{' + label_text + '}' if labels else '',
+                                                       repr(float(value))))
+
+        with self._lock:
+            run_seconds = time.time() - self.started
+            encoders = sorted(self.encoders.items())
+
+            metric('jobs_total', 'counter', 'Jobs finished by kind and result.',
+                   [((('kind', k), ('result', r)), n) for (k, r), n in sorted(self.jobs.items())])
+            metric('encoder_jobs_total', 'counter', 'Outputs encoded by encoder and result.',
+                   [((('encoder', e), ('result', 'success')), t.jobs - t.failures) for e, t in encoders] +
+                   [((('encoder', e), ('result', 'failure')), t.failures) for e, t in encoders])
+            metric('encoder_wall_seconds_total', 'counter', 'Wall time of encoder processes.',
+                   [((('encoder', e),), t.wall) for e, t in encoders])
+            metric('cpu_seconds_total', 'counter', 'CPU time of decoder and encoder processes.',
+                   [((('process', 'decoder'), ('mode', 'user')), self.decode_user_cpu),
+                    ((('process', 'decoder'), ('mode', 'system')), self.decode_sys_cpu)] +
+                   [((('process', e), ('mode', 'user')), t.user_cpu) for e, t in encoders] +
+                   [((('process', e), ('mode', 'system')), t.sys_cpu) for e, t in encoders])
+            metric('read_bytes_total', 'counter', 'Bytes of source files read.',
+                   [((), self.bytes_read)])
+            metric('written_bytes_total', 'counter', 'Bytes of output files written.',
+                   [((('encoder', e),), t.bytes_written) for e, t in encoders])
+            metric('audio_seconds_total', 'counter', 'Seconds of audio converted.',
+                   [((), self.audio_seconds)])
+            metric('queue_seconds_total', 'counter', 'Time jobs waited in the queue.',
+                   [((), self.queue_seconds)])
+            metric('queue_seconds_max', 'gauge', 'Longest time a job waited in the queue.',
+                   [((), self.queue_seconds_max)])
+            if self.prefetch:
+                metric('prefetch_jobs_total', 'counter',
+                       'Encodes by how much of their source was read ahead (warm, partial, cold).',
+                       [((('state', s),), n) for s, n in sorted(self.prefetch.items())])
+            metric('run_seconds', 'gauge', 'Duration of the run.',
+                   [((), run_seconds)])
+            metric('realtime_factor', 'gauge', 'Seconds of audio converted per second of run.',
+                   [((), self.audio_seconds / run_seconds if run_seconds else 0)])
+            metric('last_run_timestamp_seconds', 'gauge', 'End time of the run.',
+                   [((), time.time())])
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self):
+        """
+            Writes the textfile atomically so the collector never reads
+            half of it
+        """
+        tmp = '{}.{}.tmp'.format(self.textfile, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus_text())
+        os.rename(tmp, self.textfile)
+
+    def close(self):
+        if self.textfile:
+            try:
+                self.write_textfile()
+            except (IOError, OSError) as e:
+                logger.error('Could not write metrics textfile {}: {}'.format(self.textfile, e))
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,106 @@
+"""
+    Content-addressed cache of encoded audio (--encode-cache).
+
+    Encoded files are kept untagged under a key made of the source's
+    audio MD5 and stream format (from the FLAC STREAMINFO header, so no
+    decoding is needed to look it up) and the encoder's name, flags and
+    version.
+    Identical audio found elsewhere in the library, e.g. on a
+    compilation, is then cloned from the cache and only tagged instead
+    of being decoded and encoded again.
+"""
+import os
+import hashlib
+import logging
+import threading
+
+import file_ops
+
+
+logger = logging.getLogger(__name__)
+
+
+class EncodeCache(object):
+    """
+        A cache directory of encoded files, two levels deep like
+        path/ab/abcdef....mp3. Entries are written under a temporary
+        name and renamed, so concurrent runs can share the directory.
+
+        Shared by all converter threads.
+    """
+
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.hits = 0
+        self.stored = 0
+        self._lock = threading.Lock()
+
+    def entry(self, info, encoder, flags=None):
+        """
+            Path of the entry for the source with StreamInfo info encoded
+            with encoder, using flags instead of the encoder's own if given.
+
+            The MD5 only covers the decoded samples, so the stream format
+            is part of the key too.
+        """
+        if flags is None:
+            flags = encoder.flags
+        key = '\0'.join([info.md5, str(info.sample_rate), str(info.channels), str(info.bits_per_sample),
+                          encoder.name, flags or '', encoder.version or ''])
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+        return os.path.join(self.path, digest[:2], digest + encoder.ext)
+
+    def fetch(self, info, encoder, dst, link=False, flags=None):
+        """
+            Clones the cached encode of the source with StreamInfo info to dst, as a hardlink
+            if link (only safe if dst is never modified in place).
+
+            Returns True on a hit, False if there's no usable entry
+        """
+        src = self.entry(info, encoder, flags)
+        if not os.path.isfile(src):
+            return False
+
+        try:
+            file_ops.clone_file(src, dst, 'hardlink' if link else 'auto')
+        except (IOError, OSError) as e:
+            logger.warning('Could not use cached encode {}: {}'.format(src, e))
+            return False
+
+        with self._lock:
+            self.hits += 1
+
+        return True
+
+    def store(self, info, encoder, encoded_file, flags=None):
+        """ Adds an untagged encoded_file to the cache, unless it's there already """
+        dst = self.entry(info, encoder, flags)
+        if os.path.isfile(dst):
+            return
+
+        tmp = '{}.{}-{}.tmp'.format(dst, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(dst)):
+                try:
+                    os.makedirs(os.path.dirname(dst))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(dst)):
+                        raise
+            file_ops.clone_file(encoded_file, tmp, 'auto')
+            os.rename(tmp, dst)
+        except (IOError, OSError) as e:
+            logger.warning('Could not cache {}: {}'.format(encoded_file, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+
+        with self._lock:
+            self.stored += 1
+
+    def close(self):
+        if self.hits or self.stored:
+            logger.info('Encode cache: {} hits, {} new entries'.format(self.hits, self.stored))
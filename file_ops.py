@@ -0,0 +1,98 @@
+"""
+    File copies that avoid moving the data through Python where the
+    filesystem allows it: hardlinks, reflinks (FICLONE) and in-kernel
+    copy_file_range(). Each falls back to a streamed copy when source
+    and destination are on different filesystems or the filesystem
+    doesn't support it.
+"""
+import os
+import errno
+import shutil
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
+
+logger = logging.getLogger(__name__)
+
+# ioctl number of FICLONE (_IOW(0x94, 9, int)) on Linux
+FICLONE = 0x40049409
+
+copy_modes = ('auto', 'copy', 'hardlink', 'reflink', 'copy_file_range')
+
+# Errors meaning the method can't be used for this source/destination
+fallback_errnos = frozenset(getattr(errno, name) for name in
+                            ('EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EINVAL',
+                             'ENOSYS', 'EBADF', 'EPERM', 'EMLINK')
+                            if hasattr(errno, name))
+
+
+def reflink(src, dst):
+    """
+        Creates dst sharing src's data blocks (btrfs, XFS, ...)
+    """
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, 'Reflinks are not supported on this platform')
+
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def copy_range(src, dst):
+    """
+        Copies src to dst with copy_file_range(), which lets the kernel
+        (or a network filesystem's server) copy without a round trip
+        through user space
+    """
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            remaining = os.fstat(s.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+
+
+# Methods tried for each mode, in order, before falling back to a streamed copy
+mode_methods = {'auto': (reflink, copy_range),
+                'copy': (),
+                'hardlink': (os.link,),
+                'reflink': (reflink,),
+                'copy_file_range': (copy_range,)}
+
+
+def clone_file(src, dst, mode='auto'):
+    """
+        Copies src to dst using mode (see copy_modes). 'auto' tries a
+        reflink then copy_file_range. Copies keep src's timestamps and
+        permissions like shutil.copy2.
+
+        Returns the name of the method that was used
+    """
+    for method in mode_methods[mode]:
+        try:
+            method(src, dst)
+        except OSError as e:
+            if e.errno not in fallback_errnos:
+                raise
+
+            logger.debug('{} failed for {}: {}'.format(method.__name__, dst, e))
+            if method is not os.link and os.path.exists(dst):
+                os.remove(dst)  # Partial file we created
+            continue
+
+        if method is not os.link:
+            shutil.copystat(src, dst)
+
+        return method.__name__
+
+    shutil.copy2(src, dst)
+    return 'copy'
@@ -6,23 +6,61 @@ __author_email__ = 'andrewklaus@gmail.com'
 __copyright__ = '2018'
 
 import os
-import time
+import re
+import math
 import shutil
 import shlex
 import sys
 import subprocess
 import threading
-import multiprocessing  # for cpu count
+import time
 import argparse
 import errno
+import signal
+import hashlib
+import collections
+from concurrent import futures
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir  # Python 2
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
 
 try:
     import mutagen  # ID3 Tags, Imported if selected from command line
 except ImportError:
     pass
 import audio_codecs
+import artwork
+import concurrency
+import file_ops
+import process_limits
+import conversion_cluster
+import conversion_manifest
+import conversion_metrics
+import pipeline_watchdog
+import scratch
+import prefetch
+import job_journal
+import encode_cache
+import mp3_segments
+import watcher
+try:
+    import async_engine
+except SyntaxError:
+    async_engine = None  # Python 2
 import logging
 
+
+# One encoder and the destination root it writes to
+Output = collections.namedtuple('Output', 'encoder dest_dir')
+
+
 class ConverterConfig(object):
     def __init__(self):
         self.logger = logging.getLogger('config')
@@ -31,10 +69,38 @@ class ConverterConfig(object):
         self.encoder = None
         self.decoder = None
         self._threads = 1
+        self.auto_threads = False   # threads was detected, not given
+        self.adaptive_threads = False   # Adjust the running workers to the load
+        self.min_threads = None     # Bounds for adaptive_threads (None = 1 and 2 x threads)
+        self.max_threads = None
         self.no_artwork = False
+        self.artwork_copy = 'auto'  # How artwork is copied (see file_ops.copy_modes)
         self.disable_id3 = False
         self.noop = False
         self.debug = False
+        self.manifest = None    # Path to conversion manifest (None = disabled)
+        self.metrics = None     # Path to JSON Lines job metrics (None = disabled)
+        self.metrics_textfile = None    # Path to Prometheus textfile (None = disabled)
+        self.schedule = 'fifo'  # Job scheduling policy
+        self.sync_tags = False  # Retag outputs whose source only had tag changes
+        self.detect_moves = False   # Copy the outputs of moved sources instead of encoding
+        self.embed_artwork = False  # Embed album art in outputs when tagging
+        self.artwork_size = 500     # Max embedded art width/height (0 = original)
+        self.extra_outputs = [] # Outputs beyond encoder/dest_dir
+        self.governor = None    # process_limits.ResourceGovernor for codec processes
+        self.timeout_factor = 4.0   # Job timeout in audio durations, past a minute (0 = none)
+        self.stall_timeout = 120    # Seconds without I/O before a job is killed (0 = none)
+        self.retries = 1        # Extra attempts for a failed encode
+        self.engine = 'threads'     # Execution engine (threads or asyncio)
+        self.scratch_dir = None     # Local directory to encode and tag in (None = destination)
+        self.scratch_size = None    # Byte budget of scratch_dir (None = half its free space)
+        self.prefetch = None        # Bytes of sources to read ahead of the workers (None = off)
+        self.shard = None           # (K, N): only convert shard K (1-based) of N (None = all)
+        self.shard_by = 'album'     # Hash each album directory or each file into a shard
+        self.journal = None         # Journal of planned/started/finished jobs (None = off)
+        self.resume = False         # Continue the journal's unfinished run instead of scanning
+        self.encode_cache = None    # Directory of encodes by audio MD5 and encoder (None = off)
+        self.split_long = None      # Seconds above which an MP3 is encoded in parallel segments (None = off)
 
     @property
     def dest_dir(self):
@@ -42,6 +108,18 @@ class ConverterConfig(object):
 
     @dest_dir.setter
     def dest_dir(self, dir):
+        self._dest_dir = self.check_dest_dir(dir)
+
+    def add_output(self, encoder, dest_dir):
+        ''' Adds another encoder writing to its own destination directory '''
+        self.extra_outputs.append(Output(encoder, self.check_dest_dir(dest_dir)))
+
+    def check_dest_dir(self, dir):
+        '''
+            Checks a destination directory is (or can be created) writable.
+
+            Returns the normalized path.
+        '''
         d = os.path.normpath(dir)
         d_ok = False    # See if all dir checks pass
 
@@ -75,7 +153,7 @@ class ConverterConfig(object):
             par = os.path.abspath(os.path.join(child, os.pardir))
 
         # Remove trailing slashes from path
-        self._dest_dir = d
+        return d
 
 
     @property
@@ -100,38 +178,122 @@ class ConverterConfig(object):
 
     @threads.setter
     def threads(self, t):
-        ''' Set CPU threads to use. 0 = auto-detect '''
+        '''
+            Set CPU threads to use. 0 = auto-detect the CPUs available
+            to the process (affinity and cgroup CPU quota)
+        '''
         if t < 0:
             raise OSError('Cannot set thread count to less than 0')
         elif t == 0:
-            cpu = multiprocessing.cpu_count()
+            cpu = concurrency.available_cpus()
             self.logger.debug('Setting cpu count to {}'.format(cpu))
             self._threads = cpu
+            self.auto_threads = True
         else:
             self.logger.debug('Setting CPU count to {}'.format(t))
             self._threads = t
+            self.auto_threads = False
 
     def __str__(self):
         return '''Source Directory: {}
                     Dest Directory: {}
                     Decoder: {}
                     Encoder: {}
+                    Extra outputs: {}
                     Threads: {}
+                    Adaptive threads: {}
+                    Process limits: {}
+                    Timeouts: {}
+                    Retries: {}
+                    Engine: {}
+                    Scratch directory: {}
+                    Prefetch: {}
+                    Shard: {}
+                    Journal: {}
+                    Encode cache: {}
+                    Split long sources: {}
                     Skip artwork: {}
+                    Artwork copy: {}
                     Noop: {}
                     Disable ID3 tags: {}
+                    Manifest: {}
+                    Metrics: {}
+                    Metrics textfile: {}
+                    Schedule: {}
+                    Sync tags: {}
+                    Detect moves: {}
+                    Embed artwork: {}
                 '''.format(self.source_dir,
                            self.dest_dir,
                            str(self.decoder),
                            str(self.encoder),
+                           ', '.join('{} -> {}'.format(o.encoder, o.dest_dir)
+                                     for o in self.extra_outputs),
                            self.threads,
+                           '{}-{}'.format(self.min_threads or 1, self.max_threads or 'auto')
+                           if self.adaptive_threads else False,
+                           self.governor,
+                           '{} x duration, {}s stall'.format(self.timeout_factor, self.stall_timeout),
+                           self.retries,
+                           self.engine,
+                           '{} ({} bytes)'.format(self.scratch_dir, self.scratch_size or 'auto')
+                           if self.scratch_dir else None,
+                           '{} bytes'.format(self.prefetch) if self.prefetch else None,
+                           '{}/{} by {}'.format(self.shard[0], self.shard[1], self.shard_by)
+                           if self.shard else None,
+                           '{} (resume)'.format(self.journal) if self.resume else self.journal,
+                           self.encode_cache,
+                           '{}s'.format(self.split_long) if self.split_long else None,
                            self.no_artwork,
+                           self.artwork_copy,
                            self.noop,
-                           self.disable_id3)
+                           self.disable_id3,
+                           self.manifest,
+                           self.metrics,
+                           self.metrics_textfile,
+                           self.schedule,
+                           self.sync_tags,
+                           self.detect_moves,
+                           self.artwork_size if self.embed_artwork else False)
 
 class LosslessToLossyConverter(object):
     artwork_ext = ['jpg','JPG','jpeg','JPEG','bmp','BMP']
 
+    # Kinds of results yielded by scan_source()
+    SCAN_CONVERT = 0
+    SCAN_ARTWORK = 1
+    SCAN_RETAG = 2      # Only the source's tags changed (see sync_tags)
+    SCAN_MOVE = 3       # The source was moved from a converted path (see detect_moves)
+
+    # Threads listing source directories concurrently
+    scan_threads = 8
+
+    # Threads copying artwork while the workers encode
+    copy_threads = 4
+
+    # Seconds every job may take on top of timeout_factor x its duration
+    timeout_base = 60
+
+    # Seconds to wait before retrying a failed encode
+    retry_delay = 2
+
+    # Seconds a temporary output must be left unchanged before the
+    # startup scan removes it. Encoders write theirs continuously, so
+    # older ones were left by dead runs, not by other hosts encoding
+    # into the same destination.
+    stale_tmp_age = 3600
+
+    # Max queued jobs. The scan pauses when the workers fall this far behind.
+    # Only used by the fifo schedule, the others need to see every job.
+    queue_size = 10000
+
+    # Job scheduling policies (see schedule_key())
+    schedule_policies = ('fifo', 'longest', 'newest', 'album')
+    shard_modes = ('album', 'file')
+
+    # Execution engines: a pool of worker threads, or async_engine
+    engines = ('threads', 'asyncio')
+
     def __init__(self, config):
         self.config = config
         self.logger = logging.getLogger('audio_converter')
@@ -141,223 +303,1533 @@ class LosslessToLossyConverter(object):
 
         self.Decoder = config.decoder
         self.Encoder = config.encoder
-        self.threads = config.threads
+        self.extra_outputs = list(config.extra_outputs)
+        self.threads = self.job_slots(config)
+
+        self.adaptive_threads = config.adaptive_threads
+        self.min_threads = config.min_threads or 1
+        self.max_threads = config.max_threads or 2 * self.threads
+        self.threads = max(self.min_threads, min(self.max_threads, self.threads))
+
+        self.governor = config.governor
+
+        self.timeout_factor = config.timeout_factor
+        self.stall_timeout = config.stall_timeout or None
+        self.retries = config.retries
+        self.split_long = config.split_long
+
+        # Set by start_workers(), used to see how many jobs are waiting
+        # and how many workers are busy
+        self.work_queue = None
+        self.stop_markers = 0
+        self.limiter = None
 
+        self.engine = config.engine
+        assert self.engine in self.engines
+
+        # All hold (path relative to source_dir, output indexes) tuples
         self.to_convert = []    # Music to convert
+        self.to_retag = []      # Music to retag only
+        self.to_move = []       # Music moved since its conversion
         self.to_copy = []       # Artwork to copy
 
+        self.dest_dirs = set()  # Destination directories already created
+        self.dest_dirs_lock = threading.Lock()
+
+        # Sources queued or being converted, in watch mode only
+        self.in_flight = None
+        self.in_flight_lock = threading.Lock()
+
         self.success = 0        # Successful conversions
+        self.retagged = 0       # Outputs retagged without re-encoding
+        self.moved = 0          # Outputs copied from the old path of a moved source
         self.error_conv = []    # List of error conversions
         self.error_id3 = []     # List of error id3 tags
+        self.results_lock = threading.Lock()   # Guards the five results above
 
         self.noop = config.noop
         self.disable_id3 = config.disable_id3
         self.no_artwork = config.no_artwork
+        self.artwork_copy = config.artwork_copy
         self.debug = config.debug
 
+        self.schedule = config.schedule
+        assert self.schedule in self.schedule_policies
+
+        self.sync_tags = config.sync_tags
+        self.detect_moves = config.detect_moves
+
+        self.shard = config.shard
+        self.shard_by = config.shard_by
+        assert self.shard_by in self.shard_modes
+
+        # Prepared album art, shared by the workers
+        self.artwork_cache = None
+        if config.embed_artwork:
+            self.artwork_cache = artwork.ArtworkCache(config.artwork_size)
+
+        self.manifest = None
+        if config.manifest:
+            self.manifest = conversion_manifest.ConversionManifest(config.manifest)
+
+        self.metrics = None
+        if config.metrics or config.metrics_textfile:
+            self.metrics = conversion_metrics.MetricsRecorder(config.metrics,
+                                                              config.metrics_textfile)
+
+        self.scratch = None
+        if config.scratch_dir and not self.noop:
+            self.scratch = scratch.ScratchSpace(config.scratch_dir, config.scratch_size)
+
+        self.prefetcher = None
+        if config.prefetch and not self.noop:
+            self.prefetcher = prefetch.Prefetcher(config.prefetch)
+
+        self.encode_cache = None
+        if config.encode_cache and not self.noop:
+            self.encode_cache = encode_cache.EncodeCache(config.encode_cache)
+
+        self.journal = None
+        self.resume = config.resume
+        if config.journal and not self.noop:
+            self.journal = job_journal.JobJournal(config.journal)
+
+    def scan_directory(self, rel_dir, sweep=False):
+        '''
+            Lists one source directory (relative to source_dir), and
+            with sweep removes the stale temporary outputs in its
+            destination directories.
+
+            Returns a tuple of lists: (subdirectories, jobs)
+            Subdirectories are relative paths. Jobs are
+            (kind, relative path, schedule key, output indexes) as
+            yielded by scan_source().
+        '''
+        subdirs = []
+        jobs = []
+        outputs = self.outputs()
+
+        if sweep and not self.noop:
+            self.remove_stale_tmp(rel_dir)
+
+        for entry in scandir(os.path.join(self.source_dir, rel_dir)):
+            rel_path = os.path.join(rel_dir, entry.name)
+
+            if entry.is_dir():
+                # Same as os.walk(): don't descend into symlinked dirs
+                if not entry.is_symlink():
+                    subdirs.append(rel_path)
+                continue
+
+            if not self.in_shard(rel_path):
+                continue
+
+            ext = os.path.splitext(entry.name)[1]
+
+            # Find artwork
+            if not self.no_artwork and ext[1:] in self.artwork_ext:
+                self.logger.debug('Found artwork file: {}'.format(rel_path))
+
+                # Check if file already exists on dest
+                missing = tuple(i for i, o in enumerate(outputs)
+                                if not os.path.isfile(os.path.join(o.dest_dir, rel_path)))
+                if missing:
+                    self.logger.debug('Artwork file {} doesn\'t exist at dest'.format(rel_path))
+                    jobs.append((self.SCAN_ARTWORK, rel_path, None, missing))
+
+            # Find files to convert
+            if ext in self.Decoder.ext and ext != '':
+                source_file = os.path.join(self.source_dir, rel_path)
+                checks = [self.check_source(source_file, o) for o in outputs]
+                key = None
+
+                for kind, name in ((self.SCAN_CONVERT, 'to_convert'), (self.SCAN_RETAG, 'to_retag'),
+                                   (self.SCAN_MOVE, 'to_move')):
+                    needed = tuple(i for i, check in enumerate(checks) if check == kind)
+                    if needed:
+                        if key is None:
+                            key = self.schedule_key(rel_path, entry)
+                        self.logger.debug('***Adding {}: {}'.format(name, rel_path))
+                        jobs.append((kind, rel_path, key, needed))
+
+        return subdirs, jobs
+
+    def remove_stale_tmp(self, rel_dir):
+        '''
+            Removes the temporary outputs (name.tmp.ext, and name.tmp.N.ext
+            from split encodes) of the destination directories of rel_dir
+            left unchanged for stale_tmp_age seconds, by runs that died
+            with or without a journal
+        '''
+        outputs = self.outputs()
+        pattern = re.compile(r'\.tmp(\.\d+)?({})$'.format('|'.join(re.escape(o.encoder.ext) for o in outputs)))
+        cutoff = time.time() - self.stale_tmp_age
+
+        for dest_dir in set(o.dest_dir for o in outputs):
+            try:
+                entries = list(scandir(os.path.join(dest_dir, rel_dir)))
+            except OSError:
+                continue    # Not created yet
+
+            for entry in entries:
+                try:
+                    if not pattern.search(entry.name) or not entry.is_file() or \
+                            entry.stat().st_mtime > cutoff:
+                        continue
+                except OSError:
+                    continue
+
+                self.logger.info('Removing {} left by a dead run'.format(entry.path))
+                self.remove_tmp(entry.path)
+
+    def in_shard(self, rel_path):
+        '''
+            True if the file at rel_path (relative to source_dir) is in
+            this run's shard. Shards come from an MD5 of the file's
+            directory (shard_by album) or of its path (shard_by file),
+            so hosts sharing a library split it the same way without
+            talking to each other.
+        '''
+        if self.shard is None:
+            return True
+
+        if self.shard_by == 'album':
+            rel_path = os.path.dirname(rel_path)
+        rel_path = rel_path.replace(os.sep, '/')
+        if not isinstance(rel_path, bytes):
+            rel_path = rel_path.encode('utf-8', 'surrogateescape')
+
+        k, n = self.shard
+        return int(hashlib.md5(rel_path).hexdigest(), 16) % n == k - 1
+
+    def scan_source(self, sweep=False):
+        '''
+            Generator walking source_dir. Subdirectories are listed
+            concurrently by scan_threads threads, and results are yielded
+            as soon as each directory is done, as
+            (kind, relative path, key, output indexes) where kind is
+            SCAN_CONVERT, SCAN_RETAG, SCAN_MOVE or SCAN_ARTWORK and key is the
+            schedule key of files to convert (None for artwork).
+
+            With sweep, stale temporary outputs are removed on the way
+            (see remove_stale_tmp()).
+        '''
+        executor = futures.ThreadPoolExecutor(self.scan_threads)
+
+        try:
+            pending = set([executor.submit(self.scan_directory, '', sweep)])
+
+            while pending:
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+
+                for f in done:
+                    subdirs, jobs = f.result()
+
+                    for d in subdirs:
+                        pending.add(executor.submit(self.scan_directory, d, sweep))
+
+                    for job in jobs:
+                        yield job
+        finally:
+            executor.shutdown(wait=False)
+
+    def planned_jobs(self):
+        '''
+            Generator of the jobs to run, like scan_source(). With a
+            journal, the jobs are recorded as they're found, after
+            removing the temporary files of an interrupted previous run.
+            With resume, the jobs that run didn't finish are replayed
+            instead of scanning, if its scan had completed. A scan also
+            removes stale temporary files, journaled or not.
+        '''
+        if self.journal is None:
+            for job in self.scan_source(sweep=True):
+                yield job
+            return
+
+        self.remove_interrupted()
+
+        if self.resume and self.journal.resumable():
+            pending = self.journal.pending()
+            self.logger.info('Resuming from {}: {} jobs left'.format(self.journal.path, len(pending)))
+            self.journal.begin(resumed=True)
+            for job in pending:
+                yield job
+            return
+
+        if self.resume:
+            self.logger.info('Nothing to resume in {}, scanning'.format(self.journal.path))
+
+        self.journal.begin()
+        for job in self.scan_source(sweep=True):
+            self.journal.planned(*job)
+            yield job
+        self.journal.scan_done()
+
+    def remove_interrupted(self):
+        '''
+            Removes the temporary files left by the encodes that were
+            running when the journal's previous run was killed
+        '''
+        outputs = self.outputs()
+
+        for kind, rel_path, key, needed in self.journal.interrupted():
+            if kind != self.SCAN_CONVERT:
+                continue
+
+            lossless_file = os.path.join(self.source_dir, rel_path)
+            for i in needed:
+                if i >= len(outputs):
+                    continue
+                lossy_file = self.translate_src_to_dest(lossless_file, outputs[i])
+                tmps = [self.tmp_file(lossy_file, outputs[i].encoder)]
+                tmps += self.segment_files(lossy_file, outputs[i].encoder)
+                for tmp in tmps:
+                    if os.path.isfile(tmp):
+                        self.logger.info('Removing {} left by an interrupted run'.format(tmp))
+                        self.remove_tmp(tmp)
+
     def get_convert_list(self):
-        '''Populates list with files needing conversion.'''
+        '''
+            Populates to_convert, to_retag, to_move and to_copy with
+            files needing conversion, retagging, copying from a moved
+            source's output or copying.
+        '''
 
         assert(self.source_dir)
         assert(self.dest_dir)
         self.logger.debug('Get convert list starting')
 
         try:
-            for dirpath, dirnames, filenames in os.walk(self.source_dir):
-                # Flag to create directory after all files checked
-                found_file = False
-
-                for filename in filenames:
-
-                    # Find artwork
-                    if not self.no_artwork and \
-                      os.path.splitext(filename)[1][1:] in self.artwork_ext:
-                        self.logger.debug('Found artwork file: {}'.format(\
-                                                      os.path.join(dirpath, filename)))
-                        f_path_src = os.path.join(dirpath, filename)
-
-                        f_path_dest = os.path.normpath(self.dest_dir + \
-                                              f_path_src[len(self.source_dir):])
-
-                        # Check if file already exists on dest
-                        try:
-                            f_exists = os.path.isfile(f_path_dest)
-                        except OSError as e:
-                            self.logger.exception(e)
-
-                        if not f_exists:
-                            self.logger.debug('Artwork file {} doesn\'t exist at dest'.format(f_path_src))
-                            found_file = True
-                            self.to_copy.append(f_path_src)
-
-                    # Find files to convert
-                    if os.path.splitext(filename)[1] in self.Decoder.ext \
-                            and os.path.splitext(filename)[1] != '':
-                        # self.logger.debug('filename extension: ' + os.path.splitext(filename)[1])
-                        # self.logger.debug('comparing extension: ' + self.source_ext)
-                        if not self.does_lossy_file_exist(os.path.join(dirpath, filename)):
-                            self.logger.debug('***Adding to_convert: ' + os.path.join(dirpath, filename))
-                            # Lossy song does not exist
-                            self.to_convert.append(os.path.join(dirpath, filename))
-
-                            found_file = True
-
-                if found_file:
-                    # Create destination directory
-                    d = os.path.normpath(self.dest_dir + dirpath[len(self.source_dir):])
-                    self.logger.debug('Creating directory {}'.format(d))
-                    try:
-                        if not self.noop:
-                            os.makedirs(d)
-                        else:
-                            self.logger.info("(noop) Would create dir: {}".format(d))
-
-                    except OSError as e:
-                        if e.errno == errno.EEXIST:
-                            # Ignore file already exists exception
-                            pass
+            for kind, rel_path, key, needed in self.scan_source():
+                if kind == self.SCAN_CONVERT:
+                    self.to_convert.append((rel_path, needed))
+                elif kind == self.SCAN_RETAG:
+                    self.to_retag.append((rel_path, needed))
+                elif kind == self.SCAN_MOVE:
+                    self.to_move.append((rel_path, needed))
+                else:
+                    self.to_copy.append((rel_path, needed))
 
         except Exception as ex:
             self.logger.exception(ex)
             raise SystemExit
 
-    def copy_artwork(self):
-        ''' Copy artwork to destination directory '''
-        assert(not self.no_artwork)
-        for c in self.to_copy:
-            d = os.path.normpath(self.dest_dir + c[len(self.source_dir):])
-            self.logger.debug('Copying {} to {}'.format(c, d))
+    def schedule_key(self, rel_path, entry):
+        '''
+            Returns the sort key placing a job in the work queue for the
+            selected schedule. Lower keys run first.
+
+            fifo:    scan order
+            longest: longest audio first (from the stream header), so
+                     long tracks don't finish alone at the end of a run
+            newest:  most recently modified source first
+            album:   tracks of the same directory run together
+        '''
+        if self.schedule == 'longest':
+            try:
+                info = self.Decoder.read_stream_info(entry.path)
+            except (IOError, OSError, ValueError):
+                info = None
+
+            duration = info.duration if info is not None else None
+            return (-(duration or 0),)
+        elif self.schedule == 'newest':
+            return (-entry.stat().st_mtime,)
+        elif self.schedule == 'album':
+            return os.path.split(rel_path)
+
+        return ()
+
+    def make_dest_dir(self, d):
+        ''' Creates a destination directory the first time it is needed '''
+        with self.dest_dirs_lock:
+            if d in self.dest_dirs:
+                return
+
+        self.logger.debug('Creating directory {}'.format(d))
+        try:
             if not self.noop:
-                shutil.copy2(c, d)
+                os.makedirs(d)
             else:
-                self.logger.info('(noop) Would copy {} to {}'.format(c,d))
+                self.logger.info("(noop) Would create dir: {}".format(d))
+
+        except OSError as e:
+            # Another worker may have created it first
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Only cached once it exists, so no worker writes into it too early
+        with self.dest_dirs_lock:
+            self.dest_dirs.add(d)
+
+    def copy_artwork(self):
+        ''' Copy artwork in to_copy to destination directory '''
+        assert(not self.no_artwork)
+        with futures.ThreadPoolExecutor(self.copy_threads) as executor:
+            for c, needed in self.to_copy:
+                executor.submit(self.copy_artwork_file, c, needed)
+
+    def copy_artwork_file(self, rel_path, needed):
+        '''
+            Copies one artwork file (relative to source_dir) to the
+            outputs at indexes needed, using the artwork_copy mode
+        '''
+        outputs = self.outputs()
+        s = os.path.join(self.source_dir, rel_path)
+        for i in needed:
+            d = os.path.join(outputs[i].dest_dir, rel_path)
+            self.make_dest_dir(os.path.dirname(d))
+            self.logger.debug('Copying {} to {}'.format(s, d))
+            if self.noop:
+                self.logger.info('(noop) Would copy {} to {}'.format(s, d))
+                continue
+
+            try:
+                file_ops.clone_file(s, d, self.artwork_copy)
+            except (IOError, OSError):
+                self.logger.exception('Could not copy artwork {}'.format(d))
 
-    def translate_src_to_dest(self, lossless_file_path):
-        '''Provides translation between the source file and destination file'''
+        if self.journal is not None:
+            self.journal.finished(self.SCAN_ARTWORK, rel_path, ())
+
+    @staticmethod
+    def job_slots(config):
+        '''
+            Jobs to run at once for config: its threads, divided by the
+            threads each job's encoders run when the count is automatic
+        '''
+        if not config.auto_threads:
+            return config.threads
+
+        # Leave room for encoders running several threads each
+        encoders = [config.encoder] + [o.encoder for o in config.extra_outputs]
+        return max(1, config.threads // sum(e.threads_per_job for e in encoders))
+
+    def outputs(self):
+        '''
+            Returns the list of outputs to produce. The first one is
+            Encoder writing to dest_dir.
+        '''
+        return [Output(self.Encoder, self.dest_dir)] + self.extra_outputs
+
+    def translate_src_to_dest(self, lossless_file_path, output=None):
+        '''
+            Provides translation between the source file and destination
+            file of an output (default: Encoder in dest_dir)
+        '''
+        if output is None:
+            output = self.outputs()[0]
 
         # Remove "src_path" from path
         self.logger.debug('translate got: ' + lossless_file_path)
-        self.logger.debug('Dest_dir: {}'.format(self.dest_dir))
+        self.logger.debug('Dest_dir: {}'.format(output.dest_dir))
         self.logger.debug('{}'.format(lossless_file_path[len(self.source_dir):]))
-        dest = os.path.normpath(self.dest_dir + lossless_file_path[len(self.source_dir):])
+        dest = os.path.normpath(output.dest_dir + lossless_file_path[len(self.source_dir):])
 
         # Add extension
-        dest = os.path.splitext(dest)[0] + self.Encoder.ext
+        dest = os.path.splitext(dest)[0] + output.encoder.ext
         self.logger.debug('translate changed dest to: ' + dest)
 
         return dest
 
-    def does_lossy_file_exist(self, source_file_path):
+    def does_lossy_file_exist(self, source_file_path, output=None):
         ''' Checks if .lossless -> .lossy file already exists '''
         # self.logger.debug('does_lossy_file_exist received: '+ source_file_path)
-        dest = self.translate_src_to_dest(source_file_path)
-
-        # Remove ext and add .mp3 extension
-        dest = os.path.splitext(dest)[0] + self.Encoder.ext
+        dest = self.translate_src_to_dest(source_file_path, output)
 
         # self.logger.debug('does_lossy_file_exist dest: '+ dest)
         return os.path.exists(dest)
 
-    def get_running_thread_count(self):
-        ''' Returns number of non-main Python threads '''
+    def relative_source_path(self, lossless_file_path):
+        ''' Returns the path of a source file relative to source_dir '''
+        return lossless_file_path[len(self.source_dir):].lstrip(os.sep)
+
+    def needs_conversion(self, source_file_path, output=None):
+        '''
+            Checks if a source file needs to be (re-)encoded for an
+            output (default: Encoder in dest_dir).
+        '''
+        return self.check_source(source_file_path, output) == self.SCAN_CONVERT
+
+    def check_source(self, source_file_path, output=None):
+        '''
+            Checks what a source file needs for an output (default:
+            Encoder in dest_dir).
+
+            Without a manifest only the existence of the lossy file is
+            checked. With one, the source size/mtime and encoder flags
+            are compared to the last conversion and the destination is
+            only stat'ed for sources the manifest has never seen.
+
+            Returns SCAN_CONVERT, SCAN_RETAG, SCAN_MOVE or None if the
+            output is up to date
+        '''
+        if output is None:
+            output = self.outputs()[0]
+
+        if self.manifest is None:
+            if self.does_lossy_file_exist(source_file_path, output):
+                return None
+            return self.SCAN_CONVERT
+
+        source = self.relative_source_path(source_file_path)
+        lossy_file = self.translate_src_to_dest(source_file_path, output)
+        stat = os.stat(source_file_path)
+        status = self.manifest.check(source, stat, output.encoder, lossy_file)
+
+        if status == conversion_manifest.ConversionManifest.CURRENT:
+            return None
+        elif status == conversion_manifest.ConversionManifest.CHANGED:
+            if self.sync_tags and self.is_tags_only_change(source_file_path, stat, output, lossy_file):
+                if self.disable_id3 or self.tags_hash(source_file_path) == \
+                        self.manifest.get(source, lossy_file)['tags_hash']:
+                    # Touched but nothing to write; refresh the entry
+                    if not self.noop:
+                        self.record_manifest(source_file_path, stat, output, lossy_file)
+                    return None
+
+                self.logger.debug('Source tags changed since last conversion: {}'.format(source_file_path))
+                return self.SCAN_RETAG
+
+            self.logger.debug('Source changed since last conversion: {}'.format(source_file_path))
+            return self.SCAN_CONVERT
+
+        # Not in the manifest yet. Adopt outputs from earlier runs
+        # so they aren't checked on the destination again.
+        if os.path.exists(lossy_file):
+            if not self.noop:
+                self.record_manifest(source_file_path, stat, output, lossy_file)
+            return None
+
+        if self.detect_moves and self.find_moved_output(source_file_path, output) is not None:
+            self.logger.debug('Source moved since last conversion: {}'.format(source_file_path))
+            return self.SCAN_MOVE
+
+        return self.SCAN_CONVERT
+
+    def find_moved_output(self, source_file_path, output):
+        '''
+            Looks in the manifest for an output encoded with the same
+            encoder and flags from a source that no longer exists and
+            had the same audio MD5 and duration, i.e. this source before
+            it was moved or renamed. Entries whose size matches too are
+            preferred, since retitling an album changes the sizes.
+
+            Returns the path of that output, or None
+        '''
+        try:
+            info = self.Decoder.read_stream_info(source_file_path)
+        except (IOError, OSError):
+            return None
 
-        main_thread = threading.currentThread()
+        if info is None or info.md5 is None:
+            return None
 
-        count = 0
+        size = os.path.getsize(source_file_path)
+        found = None
 
-        # Count all threads except the main thread
-        for t in threading.enumerate():
-            if t is main_thread:
+        for entry in self.manifest.find_audio(info.md5, output.encoder):
+            if entry['duration'] is None or info.duration is None or \
+                    abs(entry['duration'] - info.duration) > 0.001:
+                continue
+            if not entry['output'].startswith(os.path.join(output.dest_dir, '')):
+                continue
+            if os.path.exists(os.path.join(self.source_dir, entry['source'])) or \
+                    not os.path.isfile(entry['output']):
                 continue
-            count += 1
 
-        return count
+            if entry['size'] == size:
+                return entry['output']
+            if found is None:
+                found = entry['output']
 
-    def encode_and_tagging(self, lossless_file, lossy_file):
-        self.logger.debug('Starting encode_and_tagging. Received: ' + ' ' + lossless_file + ' ' + lossy_file)
+        return found
 
-        if not self.noop:
-            conv_result = self.convert_to_lossy(lossless_file, lossy_file)
+    def is_tags_only_change(self, source_file_path, stat, output, lossy_file):
+        '''
+            Checks whether a source the manifest reports as changed
+            still has the audio the output was encoded from, using the
+            audio MD5 stored in the stream header. Sources without one
+            are always treated as changed.
+        '''
+        entry = self.manifest.get(self.relative_source_path(source_file_path), lossy_file)
+
+        if entry['audio_md5'] is None or \
+                (entry['encoder'], entry['flags']) != (output.encoder.name, output.encoder.flags):
+            return False
+
+        try:
+            info = self.Decoder.read_stream_info(source_file_path)
+        except (IOError, OSError):
+            return False
+
+        if info is None or info.md5 != entry['audio_md5']:
+            return False
+
+        return os.path.exists(lossy_file)
+
+    def tags_hash(self, source_file_path):
+        ''' Hash of the source's tags, or None if they can't be read '''
+        try:
+            return self.Decoder.read_tags_hash(source_file_path)
+        except (IOError, OSError):
+            return None
+
+    def record_manifest(self, lossless_file, stat, output, lossy_file):
+        '''
+            Records lossy_file as up to date in the manifest, along with
+            the source's audio MD5 and tags hash when the decoder can
+            read them
+        '''
+        try:
+            info = self.Decoder.read_stream_info(lossless_file)
+        except (IOError, OSError):
+            info = None
+
+        self.manifest.record(self.relative_source_path(lossless_file), stat, output.encoder,
+                             lossy_file,
+                             audio_md5=info.md5 if info is not None else None,
+                             tags_hash=self.tags_hash(lossless_file),
+                             duration=info.duration if info is not None else None)
+
+    def record_success(self):
+        ''' Thread-safe increment of the successful conversion count '''
+        with self.results_lock:
+            self.success += 1
+
+    def record_retagged(self):
+        ''' Thread-safe increment of the retagged output count '''
+        with self.results_lock:
+            self.retagged += 1
+
+    def record_moved(self):
+        ''' Thread-safe increment of the moved output count '''
+        with self.results_lock:
+            self.moved += 1
+
+    def record_conv_error(self, lossless_file, output):
+        ''' Records a failed conversion, naming the encoder if there are several '''
+        if self.extra_outputs:
+            lossless_file = '{} ({})'.format(lossless_file, output.encoder.name)
+
+        self.record_error(self.error_conv, lossless_file)
+
+    def record_error(self, error_list, path):
+        ''' Thread-safe append to one of the error lists '''
+        with self.results_lock:
+            error_list.append(path)
+
+    def worker(self, work_queue, limiter=None):
+        '''
+            Long-lived conversion worker. Pulls jobs from work_queue
+            until it receives None. With a concurrency.WorkerLimiter it
+            waits for a free place before taking each job, so jobs wait
+            in the queue rather than in blocked workers (see
+            waiting_jobs()), and idle workers hold no place.
+        '''
+        while True:
+            if limiter is not None:
+                limiter.wait()
+
+            item = work_queue.get()
+            job = item[-1]
+            if job is not None and limiter is not None and not limiter.try_acquire():
+                # Another worker or a split encode took the place first:
+                # put the job back where it was in the queue
+                work_queue.put(item)
+                work_queue.task_done()
+                continue
+
+            try:
+                if job is None:
+                    return
+
+                self.run_job(*job)
+            except Exception:
+                self.logger.exception('Worker failed on {}'.format(job[1]))
+                self.record_error(self.error_conv, os.path.join(self.source_dir, job[1]))
+            finally:
+                if job is not None and self.in_flight is not None:
+                    with self.in_flight_lock:
+                        self.in_flight.discard(job[1])
+                work_queue.task_done()
+                if job is not None and limiter is not None:
+                    limiter.release()
+
+    def run_job(self, kind, rel_path, needed, queued_at=None):
+        '''
+            Encodes (SCAN_CONVERT), retags (SCAN_RETAG) or copies the
+            outputs of the moved (SCAN_MOVE) source for the outputs at
+            indexes needed. queued_at is the time.time()
+            the job was queued at, for the metrics.
+
+            Returns the results (0 = success) matching needed
+        '''
+        lossless_file = os.path.join(self.source_dir, rel_path)
+        needed = self.configured_outputs(rel_path, needed)
+        if not needed:
+            return ()
+
+        targets = self.job_targets(lossless_file, needed)
+        metrics = self.job_metrics(kind, rel_path, queued_at)
+        started = time.time()
+        if kind == self.SCAN_CONVERT:
+            self.prefetch_started(lossless_file, metrics)
+        if self.journal is not None:
+            self.journal.started(kind, rel_path)
+
+        if kind == self.SCAN_RETAG:
+            results = self.retag(lossless_file, targets)
+        elif kind == self.SCAN_MOVE:
+            results = self.copy_moved(lossless_file, targets, metrics)
         else:
-            self.logger.info('(noop) Would convert {} to {}'.format(lossless_file, lossy_file))
-            conv_result = 0
+            results = self.encode_and_tagging(lossless_file, targets, metrics)
+
+        self.record_job_metrics(metrics, started, results)
+        if self.journal is not None:
+            self.journal.finished(kind, rel_path, results)
+
+        return results
+
+    def configured_outputs(self, rel_path, needed):
+        '''
+            Returns the output indexes needed that are still configured:
+            jobs resumed from a journal may be for outputs dropped since
+        '''
+        count = len(self.outputs())
+        if all(i < count for i in needed):
+            return needed
+
+        self.logger.warning('Skipping outputs of {} that are no longer configured'.format(rel_path))
+        return tuple(i for i in needed if i < count)
+
+    def job_targets(self, lossless_file, needed):
+        '''
+            Returns the (output, lossy file) targets for the output
+            indexes needed, creating their directories
+        '''
+        outputs = self.outputs()
+        targets = []
+
+        for i in needed:
+            lossy_file = self.translate_src_to_dest(lossless_file, outputs[i])
+            self.make_dest_dir(os.path.dirname(lossy_file))
+            targets.append((outputs[i], lossy_file))
+
+        return targets
+
+    def job_metrics(self, kind, rel_path, queued_at=None):
+        ''' Returns a new metrics dict for a job, or None without --metrics '''
+        if self.metrics is None:
+            return None
+
+        metrics = {'source': rel_path,
+                   'kind': {self.SCAN_RETAG: 'retag', self.SCAN_MOVE: 'move'}.get(kind, 'encode')}
+        if queued_at is not None:
+            metrics['queue_time'] = time.time() - queued_at
+
+        return metrics
+
+    def prefetch_file(self, rel_path, key, seq):
+        ''' Has the source of a queued encode read ahead, with --prefetch '''
+        if self.prefetcher is not None:
+            self.prefetcher.add(os.path.join(self.source_dir, rel_path), key, seq)
+
+    def prefetch_started(self, lossless_file, metrics=None):
+        '''
+            Tells the prefetcher an encode of lossless_file started,
+            noting in the metrics whether it was read ahead
+        '''
+        if self.prefetcher is None:
+            return
 
-        # Only ID3 tag if conversion successful and if not disabled
-        if conv_result == 0 and not self.disable_id3:
+        state = self.prefetcher.started(lossless_file)
+        if metrics is not None:
+            metrics['prefetch'] = state
+
+    def record_job_metrics(self, metrics, started, results):
+        if metrics is not None:
+            metrics['wall'] = time.time() - started
+            metrics['results'] = results
+            self.metrics.record(metrics)
+
+    def encode_and_tagging(self, lossless_file, targets, metrics=None):
+        '''
+            Encodes a source for one or more (output, lossy file)
+            targets, then tags each output that was encoded. Timings,
+            sizes and exit codes are added to the metrics dict if given.
+
+            Returns the conversion results (0 = success) matching targets
+        '''
+        self.logger.debug('Starting encode_and_tagging. Received: ' + ' ' + lossless_file + ' ' +
+                          ' '.join(lossy_file for output, lossy_file in targets))
+
+        # Stat before encoding so changes made during the encode
+        # are picked up on the next run
+        stat = None
+        if self.manifest is not None and not self.noop:
+            stat = os.stat(lossless_file)
+
+        if metrics is not None:
+            self.source_metrics(lossless_file, metrics)
+
+        stage = None
+        if not self.noop:
+            stage = self.stage_job(lossless_file, targets)
+
+        try:
             if not self.noop:
-                self.update_lossy_tags(lossless_file, lossy_file)
+                started = time.time()
+                conv_results = self.convert_to_lossy(lossless_file, targets, metrics, stage)
+                if metrics is not None and metrics.get('duration'):
+                    metrics['realtime_factor'] = metrics['duration'] / (time.time() - started)
             else:
-                self.logger.info('(noop) Would update ID3 file {}'.format(lossy_file))
+                for output, lossy_file in targets:
+                    self.logger.info('(noop) Would convert {} to {}'.format(lossless_file, lossy_file))
+                conv_results = [0] * len(targets)
+
+            # Staged outputs were tagged before being published
+            self.tag_outputs(lossless_file, targets, conv_results, stat, metrics,
+                             tagged=stage is not None)
+        finally:
+            if stage is not None:
+                self.scratch.release(stage)
 
-    def convert_to_lossy(self, lossless_file, lossy_file):
+        return conv_results
+
+    def stage_job(self, lossless_file, targets):
+        '''
+            Reserves scratch space to encode lossless_file in. Returns
+            the scratch.Stage, or None to encode in the destination
+            (no scratch space, or not enough of it left).
+        '''
+        if self.scratch is None:
+            return None
+
+        # Lossy outputs are smaller than their lossless source
+        stage = self.scratch.reserve(os.path.getsize(lossless_file) * len(targets))
+        if stage is None:
+            self.logger.debug('Scratch space full, encoding {} in the destination'.format(lossless_file))
+
+        return stage
+
+    def tag_outputs(self, lossless_file, targets, conv_results, stat=None, metrics=None, tagged=False):
+        '''
+            Tags each target that was encoded (result 0), unless tagged
+            already, and records it in the manifest with the source's
+            stat from before the encode
+        '''
+        for (output, lossy_file), conv_result in zip(targets, conv_results):
+            # Only ID3 tag if conversion successful and if not disabled
+            if conv_result == 0 and not self.disable_id3 and not tagged:
+                if not self.noop:
+                    started = time.time()
+                    self.update_lossy_tags(lossless_file, lossy_file)
+                    if metrics is not None:
+                        metrics['tag_wall'] = metrics.get('tag_wall', 0.0) + time.time() - started
+                else:
+                    self.logger.info('(noop) Would update ID3 file {}'.format(lossy_file))
+
+            if conv_result == 0 and self.manifest is not None and not self.noop:
+                self.record_manifest(lossless_file, stat, output, lossy_file)
+
+    def retag(self, lossless_file, targets):
+        '''
+            Copies the tags of lossless_file to already encoded
+            (output, lossy file) targets without re-encoding them.
 
+            Returns the results (0 = success) matching targets
+        '''
+        if self.noop:
+            for output, lossy_file in targets:
+                self.logger.info('(noop) Would retag {}'.format(lossy_file))
+            return [0] * len(targets)
+
+        stat = os.stat(lossless_file)
+        results = []
+
+        for output, lossy_file in targets:
+            if not self.update_lossy_tags(lossless_file, lossy_file):
+                results.append(1)
+                continue
+
+            self.record_retagged()
+            if self.manifest is not None:
+                self.record_manifest(lossless_file, stat, output, lossy_file)
+            results.append(0)
+
+        return results
+
+    def copy_moved(self, lossless_file, targets, metrics=None):
+        '''
+            Copies the outputs of a moved source from their old paths
+            (see find_moved_output()) to the new ones and retags them.
+            The old outputs are left in place. Targets whose old output
+            can't be found or copied any more are encoded.
+
+            Returns the results (0 = success) matching targets
+        '''
+        if self.noop:
+            for output, lossy_file in targets:
+                self.logger.info('(noop) Would copy the output of a moved source to {}'.format(lossy_file))
+            return [0] * len(targets)
+
+        stat = os.stat(lossless_file)
+        results = [1] * len(targets)
+        to_encode = []
+
+        for i, (output, lossy_file) in enumerate(targets):
+            old_file = None
+            if self.manifest is not None:
+                old_file = self.find_moved_output(lossless_file, output)
+
+            try:
+                if old_file is None:
+                    raise IOError('no earlier output found')
+
+                # Hardlinks only while nothing writes tags into the outputs
+                lossy_file_tmp = self.tmp_file(lossy_file, output.encoder)
+                file_ops.clone_file(old_file, lossy_file_tmp, 'hardlink' if self.disable_id3 else 'auto')
+                os.rename(lossy_file_tmp, lossy_file)
+
+            except (IOError, OSError) as e:
+                self.logger.info('Encoding moved source {} instead: {}'.format(lossless_file, e))
+                if old_file is not None:
+                    self.remove_tmp(lossy_file_tmp)
+                to_encode.append(i)
+                continue
+
+            self.logger.debug('Copied {} to {}'.format(old_file, lossy_file))
+            if not self.disable_id3 and not self.update_lossy_tags(lossless_file, lossy_file):
+                continue
+
+            self.record_moved()
+            if self.manifest is not None:
+                self.record_manifest(lossless_file, stat, output, lossy_file)
+            results[i] = 0
+
+        if to_encode:
+            encoded = self.encode_and_tagging(lossless_file, [targets[i] for i in to_encode], metrics)
+            for i, result in zip(to_encode, encoded):
+                results[i] = result
+
+        return results
+
+    def source_metrics(self, lossless_file, metrics):
+        ''' Adds the source's size and audio duration to a metrics dict '''
+        metrics['decoder'] = self.Decoder.name
+        try:
+            metrics['bytes_read'] = os.path.getsize(lossless_file)
+            info = self.Decoder.read_stream_info(lossless_file)
+        except (IOError, OSError):
+            info = None
+
+        if info is not None and info.duration is not None:
+            metrics['duration'] = info.duration
+
+    def limit_process(self, codec, proc):
+        ''' Applies codec's process limits to proc, a codec process just started '''
+        if self.governor is None:
+            return
+
+        try:
+            self.governor.apply(codec, proc.pid)
+        except OSError as e:
+            if e.errno != errno.ESRCH:  # Not if it exited already
+                self.logger.warning('Could not limit {} process {}: {}'.format(codec.name, proc.pid, e))
+
+    def job_timeout(self, lossless_file):
+        ''' Seconds a conversion of lossless_file may take, or None for no limit '''
+        if not self.timeout_factor:
+            return None
+
+        try:
+            info = self.Decoder.read_stream_info(lossless_file)
+        except (IOError, OSError):
+            info = None
+
+        if info is None or info.duration is None:
+            return None
+
+        return self.timeout_base + self.timeout_factor * info.duration
+
+    def convert_to_lossy(self, lossless_file, targets, metrics=None, stage=None):
+        '''
+            Decodes lossless_file once and encodes it for every
+            (output, lossy file) target. With several targets the decoded
+            stream is copied to each encoder, and each one succeeds or
+            fails on its own. Failed targets are tried again up to
+            retries times, unless the watchdog killed the pipeline.
+            Targets found in the encode cache are cloned from it
+            instead, and a long source may be encoded in segments (see
+            segment_count()).
+
+            Process timings, CPU usage and exit codes and output sizes
+            are added to the metrics dict if given. With a scratch.Stage
+            the outputs are encoded and tagged there, then published.
+
+            Returns a list of results (0 = success) matching targets
+        '''
+        results = [1] * len(targets)
+        pending = self.fetch_cached(lossless_file, targets, results, metrics, stage)
+        pending = self.encode_segmented(lossless_file, targets, pending, results, self.waiting_jobs(),
+                                        metrics, stage)
+        attempts = 0
+
+        while pending and attempts <= self.retries:
+            if attempts:
+                self.logger.info('Retrying {} (attempt {} of {})'.format(
+                    lossless_file, attempts + 1, self.retries + 1))
+                time.sleep(self.retry_delay)
+
+            attempt_results, expired = self.run_pipeline(lossless_file, [targets[i] for i in pending],
+                                                         metrics, stage)
+            for i, result in zip(pending, attempt_results):
+                results[i] = result
+
+            pending = [i for i in pending if results[i]]
+            attempts += 1
+            if expired:
+                break   # It would most likely time out or stall again
+
+        if metrics is not None:
+            metrics['attempts'] = attempts
+
+        self.record_results(lossless_file, targets, results)
+
+        return results
+
+    def cache_stream_info(self, lossless_file):
+        ''' The source's StreamInfo if it has an audio MD5 to cache by, or None '''
         try:
-            # avconv complains when .m4a.tmp files are used as output.
-            # Therefore we need to make extension: .tmp.m4a
-            # lossy_file_tmp = lossy_file + '.tmp'
-            lossy_file_tmp = os.path.splitext(lossy_file)[0] + '.tmp' + self.Encoder.ext
+            info = self.Decoder.read_stream_info(lossless_file)
+        except (IOError, OSError):
+            return None
 
-            exe = self.Decoder.found_exe
-            input_file = lossless_file
-            flags = self.Decoder.flags
+        return info if info is not None and info.md5 else None
 
-            source_cmd = self.Decoder.cmd_seq.format(
-                exe=exe,
-                input_file=input_file,
-                flags=flags)
+    def fetch_cached(self, lossless_file, targets, results, metrics=None, stage=None):
+        '''
+            Moves the targets found in the encode cache into place like
+            fresh encodes, setting their results. Returns the indexes of
+            the targets left to encode.
+        '''
+        pending = list(range(len(targets)))
+        if self.encode_cache is None:
+            return pending
+
+        info = self.cache_stream_info(lossless_file)
+        if info is None:
+            return pending
 
-            self.logger.debug('INPUT command: ' + source_cmd)
+        for i, (output, lossy_file) in enumerate(targets):
+            if stage is not None:
+                lossy_file_tmp = self.tmp_file(stage.staged_file(lossy_file), output.encoder)
+            else:
+                lossy_file_tmp = self.tmp_file(lossy_file, output.encoder)
+
+            # Hardlinks only while nothing writes tags into the outputs
+            fetched = self.encode_cache.fetch(info, output.encoder, lossy_file_tmp,
+                                              link=self.disable_id3)
+            if not fetched and self.split_long and output.encoder.segment_flags is not None:
+                # A split encode (see segment_count()) will do when splitting is on
+                fetched = self.encode_cache.fetch(info, output.encoder, lossy_file_tmp,
+                                                  link=self.disable_id3,
+                                                  flags=self.segment_flags(output.encoder))
+            if not fetched:
+                continue
 
-            exe = self.Encoder.found_exe
-            output_file = lossy_file_tmp
-            flags = self.Encoder.flags
+            self.logger.debug('Using cached encode for {}'.format(lossy_file))
+            results[i] = self.finish_output(lossy_file_tmp, lossy_file, None, None, lossless_file, stage)
+            if metrics is not None and results[i] == 0:
+                metrics['cache_hits'] = metrics.get('cache_hits', 0) + 1
 
-            dest_cmd = self.Encoder.cmd_seq.format(
-                exe=exe,
-                output_file=output_file,
-                flags=flags)
+        return [i for i in pending if results[i]]
 
-            self.logger.debug('OUTPUT command: ' + dest_cmd)
+    def waiting_jobs(self):
+        ''' Jobs queued and not started yet, or None without a work queue '''
+        if self.work_queue is None:
+            return None
 
-            src_args = shlex.split(source_cmd)
-            dest_args = shlex.split(dest_cmd)
+        # The stop markers are sorted after every job
+        return max(0, self.work_queue.qsize() - self.stop_markers)
 
-            p1 = subprocess.Popen(src_args, stdout=subprocess.PIPE)
-            p2 = subprocess.Popen(dest_args, stdin=p1.stdout)
+    def segment_count(self, lossless_file, targets, queued):
+        '''
+            Returns how many segments to encode lossless_file's single
+            target in, or 0 to encode it whole. Only sources longer than
+            split_long seconds are split, for encoders whose segments
+            can be joined, and only into as many segments as there are
+            places in the limiter that neither running jobs nor the
+            queued jobs (queued, None if unknown) will take, plus this
+            job's own: near the end of a run, when workers sit idle.
+        '''
+        if not self.split_long or queued is None or self.limiter is None or len(targets) != 1:
+            return 0
 
-            output = p2.communicate()[0]
+        spare = self.limiter.limit - self.limiter.active - queued
+        if spare < 1:
+            return 0
 
-            self.logger.debug('Encode output: ' + str(output))
+        if targets[0][0].encoder.segment_flags is None or self.Decoder.in_process \
+                or self.Decoder.range_flags(0) is None:
+            return 0
 
-            # Move .tmp after conversion
-            shutil.move(lossy_file_tmp, lossy_file)
+        try:
+            info = self.Decoder.read_stream_info(lossless_file)
+        except (IOError, OSError):
+            return 0
+
+        if info is None or info.duration is None or info.duration <= self.split_long \
+                or info.sample_rate not in mp3_segments.SAMPLE_RATES:
+            return 0
+
+        count = min(1 + spare, int(math.ceil(info.duration / self.split_long)))
+        return count if count >= 2 else 0
+
+    def encode_segmented(self, lossless_file, targets, pending, results, queued, metrics=None, stage=None):
+        '''
+            Encodes the pending target of a long source as segments
+            running at once (see mp3_segments), joins them and sets its
+            result. Returns the indexes of the targets left to encode,
+            which still include it if the segments failed, so it's
+            encoded whole instead.
+
+            The segments besides the first take places in the limiter
+            while they run, so other workers wait for them.
+        '''
+        count = self.segment_count(lossless_file, [targets[i] for i in pending], queued)
+        if not count:
+            return pending
+
+        # Another worker may have taken some places since
+        extra = self.limiter.try_acquire(count - 1)
+        if not extra:
+            return pending
+
+        try:
+            return self.encode_segments(lossless_file, targets, pending, results, extra + 1, metrics, stage)
+        finally:
+            self.limiter.release(extra)
+
+    def encode_segments(self, lossless_file, targets, pending, results, count, metrics=None, stage=None):
+        ''' Runs encode_segmented() in count segments '''
+        output, lossy_file = targets[pending[0]]
+        if stage is not None:
+            lossy_file_tmp = self.tmp_file(stage.staged_file(lossy_file), output.encoder)
+        else:
+            lossy_file_tmp = self.tmp_file(lossy_file, output.encoder)
+        info = self.Decoder.read_stream_info(lossless_file)
+        plan = mp3_segments.plan_segments(info.total_samples, count)
+        self.logger.debug('Encoding {} in {} segments'.format(lossless_file, count))
+
+        segment_files = []
+        procs = []      # (decoder, encoder) for each segment
+        watchdog = pipeline_watchdog.PipelineWatchdog(self.job_timeout(lossless_file),
+                                                      self.stall_timeout)
+
+        try:
+            started = time.time()
+            for n, segment in enumerate(plan):
+                args, segment_file = self.encoder_command(output, lossy_file, stage, n)
+                segment_files.append(segment_file)
+                watchdog.watch_file(segment_file)
+
+                p1 = subprocess.Popen(self.decoder_command(lossless_file, segment), stdout=subprocess.PIPE)
+                self.limit_process(self.Decoder, p1)
+                p2 = subprocess.Popen(args, stdin=p1.stdout)
+                self.limit_process(output.encoder, p2)
+                p1.stdout.close()
+                procs.append((p1, p2))
+                watchdog.watch(p1)
+                watchdog.watch(p2)
+
+            watchdog.start()
+            usage = [(conversion_metrics.wait_process(p1), conversion_metrics.wait_process(p2))
+                     for p1, p2 in procs]
+            wall = time.time() - started
+            watchdog.stop()
+
+            for p1, p2 in procs:
+                failure = self.pipeline_failure(watchdog.reason, p1.returncode, p2.returncode, False)
+                if failure is not None:
+                    raise IOError(failure)
+
+            mp3_segments.join(segment_files, plan, lossy_file_tmp, info.total_samples, info.sample_rate)
+
+        except Exception as ex:
+            watchdog.kill('failed')
+            for p in [p for pair in procs for p in pair]:
+                p.wait()
+            self.remove_tmp(lossy_file_tmp)
+            self.logger.warning('Could not encode {} in segments, encoding it whole: {}'.format(
+                lossless_file, ex))
+            return pending
+
+        finally:
+            watchdog.stop()
+            for segment_file in segment_files:
+                self.remove_tmp(segment_file)
+
+        output_metrics = None
+        if metrics is not None:
+            metrics['segments'] = count
+            metrics['decode_user_cpu'] = sum(u[0].ru_utime for u in usage if u[0] is not None)
+            metrics['decode_sys_cpu'] = sum(u[0].ru_stime for u in usage if u[0] is not None)
+            output_metrics = self.output_metrics(metrics, output, lossy_file, 0, wall)
+            output_metrics['user_cpu'] = sum(u[1].ru_utime for u in usage if u[1] is not None)
+            output_metrics['sys_cpu'] = sum(u[1].ru_stime for u in usage if u[1] is not None)
+
+        results[pending[0]] = self.finish_output(lossy_file_tmp, lossy_file, None, output_metrics,
+                                                 lossless_file, stage, output,
+                                                 self.segment_flags(output.encoder))
+
+        return [i for i in pending if results[i]]
+
+    def record_results(self, lossless_file, targets, results):
+        ''' Counts the final conversion result of each target '''
+        for (output, lossy_file), result in zip(targets, results):
+            if result == 0:
+                self.record_success()
+            else:
+                self.record_conv_error(lossless_file, output)
+
+    @staticmethod
+    def tmp_file(lossy_file, encoder):
+        ''' The file encoder writes before it's renamed to lossy_file '''
+        # avconv complains when .m4a.tmp files are used as output.
+        # Therefore we need to make extension: .tmp.m4a
+        # lossy_file_tmp = lossy_file + '.tmp'
+        return os.path.splitext(lossy_file)[0] + '.tmp' + encoder.ext
+
+    @staticmethod
+    def segment_flags(encoder):
+        ''' The encoder flags segments of a split encode are encoded with '''
+        return '{} {}'.format(encoder.flags, encoder.segment_flags)
+
+    @staticmethod
+    def segment_file(lossy_file, encoder, segment):
+        ''' The file segment number segment of lossy_file is encoded to before they're joined '''
+        return '{}.tmp.{}{}'.format(os.path.splitext(lossy_file)[0], segment, encoder.ext)
+
+    def segment_files(self, lossy_file, encoder):
+        ''' The segment files of lossy_file found on disk '''
+        dest_dir = os.path.dirname(lossy_file)
+        # The names around the segment number (no globbing: the name may hold [, * or ?)
+        head, tail = os.path.basename(self.segment_file(lossy_file, encoder, '\0')).split('\0')
+
+        try:
+            names = os.listdir(dest_dir)
+        except OSError:
+            return []
+
+        return [os.path.join(dest_dir, name) for name in names
+                if name.startswith(head) and name.endswith(tail) and
+                name[len(head):len(name) - len(tail)].isdigit()]
+
+    def encoder_command(self, output, lossy_file, stage=None, segment=None):
+        '''
+            Returns the encoder arguments for a target and the tmp file
+            it writes, next to lossy_file or in the scratch stage. Given
+            a segment number, the arguments encode that segment.
+        '''
+        if stage is not None:
+            lossy_file = stage.staged_file(lossy_file)
+
+        lossy_file_tmp = self.tmp_file(lossy_file, output.encoder)
+
+        exe = output.encoder.found_exe
+        output_file = lossy_file_tmp
+        flags = output.encoder.flags
+
+        if segment is not None:
+            output_file = lossy_file_tmp = self.segment_file(lossy_file, output.encoder, segment)
+            flags = self.segment_flags(output.encoder)
+
+        dest_cmd = output.encoder.cmd_seq.format(
+            exe=exe,
+            output_file=output_file,
+            flags=flags)
+
+        self.logger.debug('OUTPUT command: ' + dest_cmd)
+
+        return shlex.split(dest_cmd), lossy_file_tmp
+
+    def decoder_command(self, lossless_file, segment=None):
+        '''
+            Returns the arguments of an external decoder writing
+            lossless_file, or only a mp3_segments.Segment of it, to stdout
+        '''
+        exe = self.Decoder.found_exe
+        input_file = lossless_file
+        flags = self.Decoder.flags
+
+        if segment is not None:
+            flags = '{} {}'.format(flags, self.Decoder.range_flags(segment.skip, segment.until))
+
+        source_cmd = self.Decoder.cmd_seq.format(
+            exe=exe,
+            input_file=input_file,
+            flags=flags)
+
+        self.logger.debug('INPUT command: ' + source_cmd)
+
+        return shlex.split(source_cmd)
+
+    def run_pipeline(self, lossless_file, targets, metrics=None, stage=None):
+        '''
+            One attempt of convert_to_lossy(), under a
+            pipeline_watchdog.PipelineWatchdog. A target fails if the
+            decoder or its encoder exits non-zero, stops reading or is
+            killed by the watchdog; its temporary file is then removed.
+
+            Returns a list of results (0 = success) matching targets,
+            and whether the watchdog killed the pipeline
+        '''
+        encoders = []   # (encoder command, tmp file) for each target
+        p1 = None
+        procs = []
+        watchdog = pipeline_watchdog.PipelineWatchdog(self.job_timeout(lossless_file),
+                                                      self.stall_timeout)
+
+        try:
+            for output, lossy_file in targets:
+                encoders.append(self.encoder_command(output, lossy_file, stage))
+                watchdog.watch_file(encoders[-1][1])
+
+            started = time.time()
+
+            if not self.Decoder.in_process:
+                p1 = subprocess.Popen(self.decoder_command(lossless_file), stdout=subprocess.PIPE)
+                self.limit_process(self.Decoder, p1)
+                watchdog.watch(p1)
+
+            if p1 is not None and len(encoders) == 1:
+                # Single output: connect the processes directly
+                procs = [subprocess.Popen(encoders[0][0], stdin=p1.stdout)]
+                self.limit_process(targets[0][0].encoder, procs[0])
+                p1.stdout.close()
+                watchdog.watch(procs[0])
+                watchdog.start()
+                stopped_reading = [False]
+            else:
+                for (args, tmp), (output, lossy_file) in zip(encoders, targets):
+                    procs.append(subprocess.Popen(args, stdin=subprocess.PIPE))
+                    self.limit_process(output.encoder, procs[-1])
+                    watchdog.watch(procs[-1])
+                watchdog.start()
+                stopped_reading = self.decode_to_pipes(lossless_file, [p.stdin for p in procs], p1)
+
+            # The decoder finishes first (or gets SIGPIPE if its encoder died)
+            decode_usage = None
+            if p1 is not None:
+                decode_usage = conversion_metrics.wait_process(p1)
+            decode_wall = time.time() - started
+
+            encode_usage = []   # (rusage, wall time) for each encoder
+            for p in procs:
+                encode_usage.append((conversion_metrics.wait_process(p), time.time() - started))
 
         except Exception as ex:
             self.logger.exception('Could not encode')
-            self.error_conv.append(lossless_file)
+            watchdog.kill('failed')
+            for p in [p1] + procs:
+                if p is not None:
+                    p.wait()
+            for args, lossy_file_tmp in encoders:
+                self.remove_tmp(lossy_file_tmp)
+
+            return [1] * len(targets), False
+
+        finally:
+            watchdog.stop()
+
+        decoder_exit = p1.returncode if p1 is not None else None
+        self.log_pipeline_failure(lossless_file, watchdog.reason, decoder_exit)
+
+        output_metrics = [None] * len(targets)
+        if metrics is not None:
+            self.pipeline_metrics(metrics, decode_wall, decoder_exit, watchdog.reason)
+            if decode_usage is not None:
+                metrics['decode_user_cpu'] = metrics.get('decode_user_cpu', 0.0) + decode_usage.ru_utime
+                metrics['decode_sys_cpu'] = metrics.get('decode_sys_cpu', 0.0) + decode_usage.ru_stime
+
+            output_metrics = []
+            for (output, lossy_file), p, (usage, wall) in zip(targets, procs, encode_usage):
+                output_metrics.append(self.output_metrics(metrics, output, lossy_file, p.returncode, wall))
+                if usage is not None:
+                    output_metrics[-1]['user_cpu'] = usage.ru_utime
+                    output_metrics[-1]['sys_cpu'] = usage.ru_stime
+
+        results = []
+        for i, (output, lossy_file) in enumerate(targets):
+            failure = self.pipeline_failure(watchdog.reason, decoder_exit, procs[i].returncode,
+                                            stopped_reading[i])
+            results.append(self.finish_output(encoders[i][1], lossy_file, failure, output_metrics[i],
+                                              lossless_file, stage, output))
+
+        return results, watchdog.expired
+
+    def decode_to_pipes(self, lossless_file, pipes, p1=None):
+        '''
+            Copies the audio of lossless_file to every pipe, decoding it
+            in this thread or reading it from the stdout of the external
+            decoder p1. A pipe whose reader goes away is dropped.
 
-            return 1
+            Returns which pipes stopped reading
+        '''
+        fanout = PipeFanout(pipes)
+
+        try:
+            if self.Decoder.in_process:
+                # Decode in this thread straight into the encoders' stdin
+                self.Decoder.decode(lossless_file, fanout)
+            else:
+                fanout.copy_from(p1.stdout)
+        except PipeFanout.AllPipesClosed:
+            self.logger.debug('Every encoder stopped reading {}'.format(lossless_file))
+        finally:
+            fanout.close()
+            if p1 is not None:
+                p1.stdout.close()
+
+        return fanout.failed
+
+    def log_pipeline_failure(self, lossless_file, killed, decoder_exit):
+        if killed is not None:
+            self.logger.error('Conversion of {} {}, killed'.format(lossless_file, killed))
+        elif decoder_exit:
+            self.logger.error('Decoder exited with {} on {}'.format(decoder_exit, lossless_file))
+
+    @staticmethod
+    def pipeline_failure(killed, decoder_exit, encoder_exit, stopped_reading):
+        '''
+            Returns why an output of a pipeline failed, or None if it
+            succeeded. decoder_exit is None for in-process decoders.
+        '''
+        if killed is not None:
+            return 'Pipeline {}'.format(killed)
+        if decoder_exit:
+            return 'Decoder exited with {}'.format(decoder_exit)
+        if stopped_reading:
+            return 'Encoder stopped reading its input'
+        if encoder_exit != 0:
+            return 'Encoder exited with {}'.format(encoder_exit)
+        return None
+
+    def pipeline_metrics(self, metrics, decode_wall, decoder_exit, killed):
+        ''' Adds one pipeline attempt's decoder results to a metrics dict '''
+        metrics['decode_wall'] = decode_wall
+        if decoder_exit is not None:
+            metrics['decode_exit_code'] = decoder_exit
+        if killed is not None:
+            metrics['killed'] = killed
+
+    def output_metrics(self, metrics, output, lossy_file, exit_code, wall):
+        '''
+            Adds an encoder run to a metrics dict and returns its entry.
+            Retries add entries.
+        '''
+        entry = {'encoder': output.encoder.name,
+                 'output': lossy_file,
+                 'exit_code': exit_code,
+                 'encode_wall': wall}
+        metrics.setdefault('outputs', []).append(entry)
+        return entry
+
+    def finish_output(self, lossy_file_tmp, lossy_file, failure, output_metrics=None,
+                      lossless_file=None, stage=None, output=None, flags=None):
+        '''
+            Moves an encoded temporary file into place (tagging and
+            publishing it if it was encoded in a scratch stage), or
+            removes it if failure (a reason) is set. Given the output it
+            was encoded for, it's added to the encode cache first, under
+            flags if it wasn't encoded with the encoder's own.
+
+            Returns the result (0 = success)
+        '''
+        try:
+            if failure is not None:
+                raise IOError(failure)
+
+            if output is not None and self.encode_cache is not None:
+                # Before tagging: cached encodes are untagged
+                info = self.cache_stream_info(lossless_file)
+                if info is not None:
+                    self.encode_cache.store(info, output.encoder, lossy_file_tmp, flags)
+
+            if stage is not None:
+                self.publish_staged(lossless_file, lossy_file_tmp, lossy_file, stage, output_metrics)
+            else:
+                # Move .tmp after conversion
+                shutil.move(lossy_file_tmp, lossy_file)
+
+        except Exception as ex:
+            self.logger.error('Could not encode {}: {}'.format(lossy_file, ex))
+            self.remove_tmp(lossy_file_tmp)
+            result = 1
 
         else:
+            result = 0
 
-            self.success += 1
+        if output_metrics is not None:
+            output_metrics['result'] = result
+            if result == 0:
+                output_metrics['bytes_written'] = os.path.getsize(lossy_file)
 
-            return 0
+        return result
+
+    def publish_staged(self, lossless_file, lossy_file_tmp, lossy_file, stage, output_metrics=None):
+        ''' Tags an output finished in the scratch space, then copies it to the destination '''
+        staged_file = stage.staged_file(lossy_file)
+        os.rename(lossy_file_tmp, staged_file)
+
+        if not self.disable_id3:
+            started = time.time()
+            self.update_lossy_tags(lossless_file, lossy_file, staged_file)
+            if output_metrics is not None:
+                output_metrics['tag_wall'] = time.time() - started
+
+        self.scratch.publish(staged_file, lossy_file)
+
+    def remove_tmp(self, path):
+        ''' Removes the temporary output of a failed encode, if any '''
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                self.logger.warning('Could not remove {}: {}'.format(path, e))
+
+    def update_lossy_tags(self, lossless_file, lossy_file, tag_file=None):
+        '''
+            Copies ID3 tags from lossless file to lossy file, and embeds
+            the album art if enabled. tag_file is the file to write if
+            not lossy_file itself (a staged copy).
+            Returns True on success.
+        '''
+        tag_file = tag_file or lossy_file
 
-    def update_lossy_tags(self, lossless_file, lossy_file):
-        ''' Copies ID3 tags from lossless file to lossy file. '''
         try:
             lossless_tags = mutagen.File(lossless_file, easy=True)
-            lossy_tags = mutagen.File(lossy_file, easy=True)
+            lossy_tags = mutagen.File(tag_file, easy=True)
 
             for k in lossless_tags:
                 if k in ('album', 'artist', 'title', 'performer', 'tracknumber', 'date', 'genre',):
                     lossy_tags[k] = lossless_tags[k]
 
             lossy_tags.save()
+
+            if self.artwork_cache is not None:
+                art = self.artwork_cache.get(lossless_file)
+                if art is not None:
+                    artwork.embed(tag_file, art)
         except Exception as e:
             self.logger.exception(e)
-            self.error_id3.append(lossy_file)
+            self.record_error(self.error_id3, lossy_file)
+            return False
+
+        return True
 
     def print_results(self):
         ''' Print a final summary of successful and/or failed conversions '''
@@ -382,6 +1854,12 @@ class LosslessToLossyConverter(object):
         else:
             output += '0 ID3 tag errors\n'
 
+        if self.retagged > 0:
+            output += '{} song(s) retagged\n'.format(self.retagged)
+
+        if self.moved > 0:
+            output += '{} song(s) copied from the old path of a moved source\n'.format(self.moved)
+
         if self.success > 0:
             output += '{} song(s) successfully converted'.format(self.success)
         else:
@@ -389,6 +1867,107 @@ class LosslessToLossyConverter(object):
 
         print(output)
 
+    def start_workers(self):
+        '''
+            Starts the pool of workers and the artwork copy threads.
+            Jobs are then added with queue_job() until stop_workers().
+        '''
+        # Each worker picks up the next job as soon as it finishes the
+        # previous one.
+        # Queue items are (stop, schedule key, sequence, job) where job is
+        # (kind, relative path, output indexes, time queued). FIFO jobs
+        # all have the same key, so they are taken in sequence.
+        if self.schedule == 'fifo':
+            self.work_queue = queue.PriorityQueue(self.queue_size)
+        else:
+            self.work_queue = queue.PriorityQueue()
+        self.workers = []
+        self.queued = 0
+        self.stop_markers = 0
+
+        # The limiter counts running jobs and the extra segments of split
+        # encodes (see segment_count()). With adaptive threads
+        # max_threads workers are started, and a controller changes how
+        # many of them may run jobs at once.
+        self.limiter = concurrency.WorkerLimiter(self.threads)
+        self.controller = None
+        worker_count = self.threads
+        if self.adaptive_threads:
+            self.controller = concurrency.AdaptiveController(self.limiter, self.min_threads, self.max_threads,
+                                                             concurrency.available_cpus())
+            self.controller.start(lambda: self.waiting_jobs() > 0)
+            worker_count = self.max_threads
+
+        for i in range(worker_count):
+            t = threading.Thread(target=self.worker, args=(self.work_queue, self.limiter))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+        # Artwork is copied alongside the encoding as the scan finds it
+        self.copy_executor = futures.ThreadPoolExecutor(self.copy_threads)
+
+        if self.prefetcher is not None:
+            self.prefetcher.start()
+
+    def queue_job(self, kind, rel_path, key, needed):
+        ''' Hands one result of scan_source() to the workers '''
+        if kind == self.SCAN_ARTWORK:
+            self.to_copy.append((rel_path, needed))
+            self.copy_executor.submit(self.copy_artwork_file, rel_path, needed)
+            return
+
+        if self.in_flight is not None:
+            with self.in_flight_lock:
+                if rel_path in self.in_flight:
+                    return
+                self.in_flight.add(rel_path)
+
+        if kind == self.SCAN_CONVERT:
+            self.prefetch_file(rel_path, key, self.queued)
+
+        self.work_queue.put((0, key, self.queued, (kind, rel_path, needed, time.time())))
+        self.queued += 1
+
+    def stop_workers(self):
+        ''' Waits for every queued job to finish, then stops the workers '''
+        # One stop marker per worker, sorted after every job
+        for t in self.workers:
+            self.work_queue.put((1, (), self.queued, None))
+            self.queued += 1
+            self.stop_markers += 1
+
+        for t in self.workers:
+            t.join()
+
+        if self.controller is not None:
+            self.controller.stop()
+
+        self.copy_executor.shutdown(wait=True)
+        if self.journal is not None:
+            self.journal.finish()
+        self.close()
+
+    def close(self):
+        ''' Saves the manifest and metrics at the end of a run '''
+        if self.manifest is not None:
+            self.manifest.close()
+
+        if self.metrics is not None:
+            self.metrics.close()
+
+        if self.scratch is not None:
+            self.scratch.close()
+
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+
+        if self.journal is not None:
+            self.journal.close()
+
+        if self.encode_cache is not None:
+            self.encode_cache.close()
+
     def start(self):
         '''
             Start the full conversion process
@@ -396,39 +1975,142 @@ class LosslessToLossyConverter(object):
 
         self.logger.debug('Starting Conversion')
 
-        self.get_convert_list()
+        assert(self.source_dir)
+        assert(self.dest_dir)
+        assert (self.Decoder.found_exe)
+        for output in self.outputs():
+            assert (output.encoder.found_exe)
+
+        if self.engine == 'asyncio':
+            async_engine.AsyncEngine(self).run()
+            return
+
+        self.start_workers()
+
+        # Feed the workers while the scan is still running
+        try:
+            for kind, rel_path, key, needed in self.planned_jobs():
+                self.queue_job(kind, rel_path, key, needed)
+
+        except Exception as ex:
+            self.logger.exception(ex)
+            raise SystemExit
+
+        self.logger.debug('Number of items queued for conversion: ' + str(self.queued))
+
+        self.stop_workers()
 
-        self.logger.debug('Number of items in convert list: ' + str(len(self.to_convert)))
+    def watch(self, settle_time=None):
+        '''
+            Daemon mode. Converts source_dir like start(), then keeps
+            following it with inotify and converts new files once their
+            directory has been quiet for settle_time seconds. Runs until
+            interrupted; jobs already queued are finished first.
+        '''
+        self.logger.debug('Starting watch')
 
+        assert(self.source_dir)
+        assert(self.dest_dir)
         assert (self.Decoder.found_exe)
-        assert (self.Encoder.found_exe)
+        for output in self.outputs():
+            assert (output.encoder.found_exe)
 
-        if not self.no_artwork:
-            self.logger.debug('Copying artwork')
-            self.copy_artwork()
+        # Watch before the first scan so nothing written during it is missed
+        source_watcher = watcher.SourceWatcher(self.source_dir, settle_time)
+        self.in_flight = set()
+        self.start_workers()
 
-        # Start Threaded Converting
-        while len(self.to_convert) > 0:
+        try:
+            for job in self.scan_source(sweep=True):
+                self.queue_job(*job)
+            self.logger.info('Initial scan done, watching {}'.format(self.source_dir))
 
-            # Get file from list and remove
-            lossless_file = self.to_convert.pop()
-            lossy_file = self.translate_src_to_dest(lossless_file)
+            while True:
+                for rel_dir in source_watcher.poll():
+                    self.logger.debug('Directory settled: {}'.format(rel_dir or '.'))
+                    try:
+                        jobs = self.scan_directory(rel_dir)[1]
+                    except OSError as e:
+                        # Renamed or deleted since its last event
+                        self.logger.error('Could not scan {}: {}'.format(rel_dir or '.', e))
+                        continue
 
-            t = threading.Thread(target=self.encode_and_tagging, args=(lossless_file, lossy_file))
+                    for job in jobs:
+                        self.queue_job(*job)
+
+                if source_watcher.overflowed:
+                    self.logger.warning('inotify queue overflowed, rescanning {}'.format(self.source_dir))
+                    source_watcher.overflowed = False
+                    for job in self.scan_source():
+                        self.queue_job(*job)
+
+                # Save progress whenever the workers run out of work
+                if self.work_queue.unfinished_tasks == 0 and self.manifest is not None:
+                    self.manifest.commit()
+
+        finally:
+            source_watcher.close()
+            self.stop_workers()
 
-            t.start()
 
-            # Don't allow more than max_cpu threads to run
-            while self.get_running_thread_count() >= self.threads:
-                # Check every second if more threads are needed
-                time.sleep(1)
-                # Wait for threads to complete
-        main_thread = threading.current_thread()
+class PipeFanout(object):
+    '''
+        File-like object copying everything written to it to several
+        pipes. A pipe whose reader goes away is dropped and marked in
+        failed; the others carry on.
+    '''
 
-        for t in threading.enumerate():
-            if t is main_thread:
+    class AllPipesClosed(IOError):
+        pass
+
+    chunk_size = 1 << 18
+
+    def __init__(self, pipes):
+        self.pipes = pipes
+        self.failed = [False] * len(pipes)
+
+    def write(self, data):
+        for i, p in enumerate(self.pipes):
+            if self.failed[i]:
                 continue
-            t.join()
+            try:
+                p.write(data)
+            except (IOError, OSError, ValueError):
+                self.failed[i] = True
+
+        if all(self.failed):
+            raise self.AllPipesClosed
+
+    def copy_from(self, f):
+        ''' Copies file object f to every pipe until EOF '''
+        while True:
+            data = f.read(self.chunk_size)
+            if not data:
+                break
+            self.write(data)
+
+    def close(self):
+        for i, p in enumerate(self.pipes):
+            try:
+                p.close()
+            except (IOError, OSError):
+                self.failed[i] = True
+
+
+def parse_shard(value):
+    '''
+        Parses a --shard value like '2/4'. Returns (2, 4).
+        Raises ValueError if it isn't shard K of N, 1 <= K <= N.
+    '''
+    try:
+        k, n = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise ValueError('expected K/N, like 1/4: {}'.format(value))
+
+    if not 1 <= k <= n:
+        raise ValueError('shard {} is not between 1 and {}'.format(k, n))
+
+    return k, n
 
 
 def setup_parsing(decoders, encoders):
@@ -439,19 +2121,97 @@ def setup_parsing(decoders, encoders):
                         help='Output (lossy) directory')
     parser.add_argument('-i',
                         '--input_codec',
-                        default='flac',
                         choices=decoders,
-                        help='Input (lossless) codec (default: flac)')
+                        help='Input (lossless) codec (default: flac, or pyflac if flac '
+                             'isn\'t installed)')
     parser.add_argument('-o',
                         '--output_codec',
-                        default='mp3',
-                        choices=encoders,
-                        help='Output (lossy) codec (default: mp3)')
+                        action='append',
+                        metavar='CODEC[=DIR]',
+                        help='Output (lossy) codec, one of {{{}}}. Repeat to encode to several '
+                             'codecs from a single decode; give each extra one its own '
+                             'destination as CODEC=DIR (default: mp3)'.format(','.join(encoders)))
     parser.add_argument('-t',
                         '--threads',
                         type=int,
                         default=0,
-                        help='Force specific number of threads (default: auto)')
+                        help='Force specific number of threads (default: auto, from the CPUs '
+                             'available to the process)')
+    parser.add_argument('--adaptive',
+                        action='store_true',
+                        help='Adjust the thread count during the run to the CPU use and iowait '
+                             '(default: fixed thread count)')
+    parser.add_argument('--min-threads',
+                        type=int,
+                        help='Lowest thread count --adaptive may go down to (default: 1)')
+    parser.add_argument('--max-threads',
+                        type=int,
+                        help='Highest thread count --adaptive may go up to '
+                             '(default: twice the starting count)')
+    limits = parser.add_argument_group('codec process limits',
+                                       'Each can be given once for every codec process and '
+                                       'again as CODEC=VALUE for one codec, e.g. --nice 10 '
+                                       '--nice mp3=15')
+    limits.add_argument('--nice',
+                        action='append',
+                        metavar='[CODEC=]N',
+                        help='CPU nice level (-20 to 19) of codec processes')
+    limits.add_argument('--ionice',
+                        action='append',
+                        metavar='[CODEC=]CLASS[:LEVEL]',
+                        help='I/O scheduling class (idle, best-effort or realtime) and level '
+                             '(0-7) of codec processes (Linux)')
+    limits.add_argument('--cpus',
+                        action='append',
+                        metavar='[CODEC=]LIST',
+                        help='Pin codec processes to a CPU list like 0-3,6 (Linux)')
+    limits.add_argument('--memory-limit',
+                        action='append',
+                        metavar='[CODEC=]SIZE',
+                        help='Address space limit of codec processes, like 512M')
+    parser.add_argument('--engine',
+                        default='threads',
+                        choices=LosslessToLossyConverter.engines,
+                        help='Run conversions from a pool of threads, or as asyncio tasks '
+                             'for high thread counts on slow storage (Python 3.7+) '
+                             '(default: threads)')
+    parser.add_argument('--timeout-factor',
+                        type=float,
+                        default=4.0,
+                        metavar='X',
+                        help='Kill a conversion taking longer than a minute plus X times the '
+                             'audio duration, 0 to disable (default: 4)')
+    parser.add_argument('--stall-timeout',
+                        type=float,
+                        default=120,
+                        metavar='SECONDS',
+                        help='Kill a conversion whose processes read and write nothing for '
+                             'SECONDS, 0 to disable (default: 120)')
+    parser.add_argument('--retries',
+                        type=int,
+                        default=1,
+                        help='Times to retry a failed conversion. Conversions killed for '
+                             'timing out or stalling are not retried (default: 1)')
+    parser.add_argument('--split-long',
+                        type=float,
+                        metavar='SECONDS',
+                        help='Encode MP3s of sources longer than SECONDS in gapless segments '
+                             'on idle workers, when fewer jobs are queued than there are threads. '
+                             'Split files are encoded without the bit reservoir, at some cost in '
+                             'quality (FLAC, single output only) (default: disabled)')
+    parser.add_argument('--scratch-dir',
+                        metavar='DIR',
+                        help='Encode and tag in DIR (e.g. a tmpfs or local SSD), then copy each '
+                             'finished file to the destination once (default: encode in the '
+                             'destination)')
+    parser.add_argument('--scratch-size',
+                        metavar='SIZE',
+                        help='Most space to use in --scratch-dir, like 2G. Jobs that don\'t fit '
+                             'are encoded in the destination (default: half its free space)')
+    parser.add_argument('--prefetch',
+                        metavar='SIZE',
+                        help='Read up to SIZE of upcoming sources ahead of the encoders, like '
+                             '256M, to warm the page cache on slow storage (default: off)')
     parser.add_argument('--noid3',
                         action='store_true',
                         default=False,
@@ -459,9 +2219,96 @@ def setup_parsing(decoders, encoders):
     parser.add_argument('--noartwork',
                         action='store_true',
                         help='Disable copy of artwork (default: copy artwork)')
+    parser.add_argument('--artwork-copy',
+                        default='auto',
+                        choices=file_ops.copy_modes,
+                        help='How to copy artwork: reflink or copy_file_range when possible, '
+                             'a plain copy, hardlinks, reflinks or copy_file_range. Falls back '
+                             'to a plain copy across filesystems (default: auto)')
+    parser.add_argument('--embed-artwork',
+                        action='store_true',
+                        help='Embed the source\'s FLAC picture or the album\'s cover image '
+                             'in each output (default: disabled)')
+    parser.add_argument('--artwork-size',
+                        type=int,
+                        default=500,
+                        metavar='PX',
+                        help='Scale embedded artwork down to fit PX x PX, 0 to keep the '
+                             'original size. Requires Pillow (default: 500)')
     parser.add_argument('--noop',
                         action='store_true',
                         help='Don\'t write files. Only show files that will be (default: write files)')
+    parser.add_argument('--schedule',
+                        default='fifo',
+                        choices=LosslessToLossyConverter.schedule_policies,
+                        help='Order to convert files in: scan order, longest audio first, '
+                             'newest source first or grouped by album (default: fifo)')
+    parser.add_argument('--manifest',
+                        metavar='FILE',
+                        help='Track finished conversions in a state database instead of '
+                             'checking the destination for every file. Changed sources '
+                             'are re-encoded (default: disabled)')
+    parser.add_argument('--metrics',
+                        metavar='FILE',
+                        help='Append a JSON record of timings, CPU usage and sizes of each '
+                             'converted file to FILE (default: disabled)')
+    parser.add_argument('--metrics-textfile',
+                        metavar='FILE',
+                        help='Write a summary of the run for the Prometheus node_exporter '
+                             'textfile collector to FILE (default: disabled)')
+    parser.add_argument('--encode-cache',
+                        metavar='DIR',
+                        help='Keep encodes in DIR by audio MD5 and encoder, and tag a copy '
+                             'instead of encoding identical audio again (FLAC only) (default: disabled)')
+    parser.add_argument('--journal',
+                        metavar='FILE',
+                        help='Record the jobs planned, started and finished in FILE, so the '
+                             'next run removes the temporary files of a killed run (default: disabled)')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Continue the killed run recorded in --journal with the jobs it '
+                             'didn\'t finish, instead of scanning source_dir (default: scan)')
+    parser.add_argument('--sync-tags',
+                        action='store_true',
+                        help='Retag outputs of sources whose tags alone changed instead of '
+                             're-encoding them. Requires --manifest (default: re-encode)')
+    parser.add_argument('--detect-moves',
+                        action='store_true',
+                        help='Copy the outputs of sources that were moved or renamed, found by '
+                             'audio MD5 and duration, instead of re-encoding them. Old outputs '
+                             'are kept. Requires --manifest (default: re-encode)')
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help='Keep running after the conversion and convert files as they are '
+                             'added to source_dir (inotify, Linux) (default: convert once)')
+    parser.add_argument('--settle',
+                        type=float,
+                        default=watcher.SourceWatcher.settle_time,
+                        metavar='SECONDS',
+                        help='With --watch, wait until a directory has had no changes for '
+                             'SECONDS before converting its new files (default: %(default)s)')
+    parser.add_argument('--shard',
+                        metavar='K/N',
+                        help='Only convert shard K of N, so N hosts can split one library '
+                             'without coordination. Run each host with the same N and a '
+                             'different K (default: everything)')
+    parser.add_argument('--shard-by',
+                        default='album',
+                        choices=LosslessToLossyConverter.shard_modes,
+                        help='Split the library by album directory, keeping its artwork and '
+                             'directories on one host, or by file (default: album)')
+    cluster = parser.add_mutually_exclusive_group()
+    cluster.add_argument('--coordinator',
+                         metavar='HOST:PORT',
+                         help='Scan source_dir and hand jobs to workers connecting on this '
+                              'address instead of converting locally. The protocol is '
+                              'unauthenticated: HOST defaults to localhost, only listen on '
+                              'trusted networks')
+    cluster.add_argument('--worker',
+                         metavar='HOST:PORT',
+                         help='Convert jobs from the coordinator at this address, running '
+                              'THREADS jobs at once. Use the same -i/-o options as the '
+                              'coordinator; source_dir and dest_dir are this host\'s mounts')
     parser.add_argument('--debug',
                         help='Enable debugging',
                         action='store_true')
@@ -482,6 +2329,21 @@ def setup_logging(debug=False):
     logging.getLogger('audio_codecs').setLevel(level)
     logging.getLogger('audio_converter').setLevel(level)
     logging.getLogger('config').setLevel(level)
+    logging.getLogger('conversion_manifest').setLevel(level)
+    logging.getLogger('conversion_cluster').setLevel(level)
+    logging.getLogger('artwork').setLevel(level)
+    logging.getLogger('file_ops').setLevel(level)
+    logging.getLogger('conversion_metrics').setLevel(level)
+    logging.getLogger('concurrency').setLevel(level)
+    logging.getLogger('process_limits').setLevel(level)
+    logging.getLogger('watcher').setLevel(level)
+    logging.getLogger('pipeline_watchdog').setLevel(level)
+    logging.getLogger('async_engine').setLevel(level)
+    logging.getLogger('scratch').setLevel(level)
+    logging.getLogger('prefetch').setLevel(level)
+    logging.getLogger('job_journal').setLevel(level)
+    logging.getLogger('encode_cache').setLevel(level)
+    logging.getLogger('mp3_segments').setLevel(level)
 
     return logger
 
@@ -491,7 +2353,7 @@ def main(import_args=None):
           .format(version=__version__, copyright=__copyright__, author=__author__, email=__author_email__))
 
     try:
-        CodecMgr = audio_codecs.CodecManager()
+        CodecMgr = audio_codecs.CodecManager(audio_codecs.CodecProbeCache())
     except Exception as ex:
         sys.exit('An unknown error has occurred: {}'.format(str(ex)))
 
@@ -508,36 +2370,126 @@ def main(import_args=None):
     logger = setup_logging(args.debug)
     logger.debug('Arguments: ' + str(args))
 
+    # Split -o CODEC[=DIR] values. The first output defaults to dest_dir.
+    outputs = []
+    for i, o in enumerate(args.output_codec or ['mp3']):
+        codec, sep, dest = o.partition('=')
+        if codec not in encoders:
+            setup_parsing(decoders, encoders).error(
+                'argument -o/--output_codec: invalid choice: {!r} (choose from {})'.format(
+                    codec, ', '.join(repr(e) for e in encoders)))
+        if not dest and i > 0:
+            setup_parsing(decoders, encoders).error(
+                'argument -o/--output_codec: {} needs a destination (CODEC=DIR)'.format(codec))
+        outputs.append((codec, dest or args.dest_dir))
+
     config.source_dir = args.source_dir
     config.dest_dir = args.dest_dir
     config.threads = args.threads
+    config.adaptive_threads = args.adaptive and not args.worker
+    config.min_threads = args.min_threads
+    config.max_threads = args.max_threads
+    config.timeout_factor = args.timeout_factor
+    config.stall_timeout = args.stall_timeout
+    config.retries = args.retries
+    config.engine = args.engine
+    if args.split_long is not None and args.split_long <= 0:
+        setup_parsing(decoders, encoders).error('argument --split-long: must be positive')
+    config.split_long = args.split_long
+
+    if args.scratch_size and not args.scratch_dir:
+        setup_parsing(decoders, encoders).error('argument --scratch-size: requires --scratch-dir')
+    config.scratch_dir = args.scratch_dir
+    if args.scratch_size:
+        try:
+            config.scratch_size = process_limits.parse_size(args.scratch_size)
+        except ValueError as e:
+            setup_parsing(decoders, encoders).error('argument --scratch-size: {}'.format(e))
+    if args.shard:
+        try:
+            config.shard = parse_shard(args.shard)
+        except ValueError as e:
+            setup_parsing(decoders, encoders).error('argument --shard: {}'.format(e))
+    config.shard_by = args.shard_by
+    if args.prefetch:
+        if args.coordinator or args.worker:
+            setup_parsing(decoders, encoders).error('argument --prefetch: not allowed with --coordinator or --worker')
+        try:
+            config.prefetch = process_limits.parse_size(args.prefetch)
+        except ValueError as e:
+            setup_parsing(decoders, encoders).error('argument --prefetch: {}'.format(e))
     config.no_artwork = args.noartwork
-
-    try:
-        CodecMgr.discover_codecs()
-    except audio_codecs.NoSystemDecodersFound:
-        sys.exit('Please install a valid decoder before running')
-    except audio_codecs.NoSystemEncodersFound:
-        sys.exit('Please install a valid encoder before running')
-
-    # Setup codecs
+    config.artwork_copy = args.artwork_copy
+
+    if args.sync_tags and not args.manifest:
+        setup_parsing(decoders, encoders).error('argument --sync-tags: requires --manifest')
+    if args.detect_moves and not args.manifest:
+        setup_parsing(decoders, encoders).error('argument --detect-moves: requires --manifest')
+    if args.watch and (args.coordinator or args.worker):
+        setup_parsing(decoders, encoders).error('argument --watch: not allowed with --coordinator or --worker')
+    if args.engine == 'asyncio':
+        if args.watch or args.coordinator or args.worker:
+            setup_parsing(decoders, encoders).error(
+                'argument --engine: asyncio not allowed with --watch, --coordinator or --worker')
+        if async_engine is None:
+            setup_parsing(decoders, encoders).error('argument --engine: asyncio requires Python 3.7+')
+
+    if args.resume and not args.journal:
+        setup_parsing(decoders, encoders).error('argument --resume: requires --journal')
+    if args.journal and (args.watch or args.coordinator or args.worker):
+        setup_parsing(decoders, encoders).error(
+            'argument --journal: not allowed with --watch, --coordinator or --worker')
+    config.encode_cache = args.encode_cache
+    config.journal = args.journal
+    config.resume = args.resume
+
+    config.manifest = args.manifest
+    config.metrics = args.metrics
+    config.metrics_textfile = args.metrics_textfile
+    config.schedule = args.schedule
+    config.sync_tags = args.sync_tags
+    config.detect_moves = args.detect_moves
+
+    # Setup codecs. Only the selected ones are probed.
     try:
-        config.decoder = CodecMgr.get_decoder(args.input_codec)
+        config.decoder = CodecMgr.find_decoder(args.input_codec)
         print('Using Decoder version: {}'.format(config.decoder.version))
     except audio_codecs.SelectedCodecNotValid as e:
-        # This should never trigger as parser will force a valid codec
-        raise audio_codecs.SelectedCodecNotValid('{} decoder not available'.format(args.input_codec))
+        # The parser only allows known codecs, so it isn't installed
+        logger.debug('{} decoder not available: {}'.format(args.input_codec or 'Default', e))
+        sys.exit('Please install a valid decoder before running')
 
-    try:
-        config.encoder = CodecMgr.get_encoder(args.output_codec)
-        print('Using Encoder version: {}'.format(config.encoder.version))
-    except audio_codecs.SelectedCodecNotValid as e:
-        # This should never trigger as parser will force a valid codec
-        raise audio_codecs.SelectedCodecNotValid('{} encoder not available'.format(args.output_codec))
+    for i, (codec, dest) in enumerate(outputs):
+        try:
+            encoder = CodecMgr.find_encoder(codec)
+            print('Using Encoder version: {}'.format(encoder.version))
+        except audio_codecs.SelectedCodecNotValid as e:
+            # The parser only allows known codecs, so it isn't installed
+            logger.debug('{} encoder not available: {}'.format(codec, e))
+            sys.exit('Please install a valid encoder before running')
+
+        if i == 0:
+            config.encoder = encoder
+            config.dest_dir = dest
+        else:
+            config.add_output(encoder, dest)
 
     config.noop = args.noop
 
+    if args.nice or args.ionice or args.cpus or args.memory_limit:
+        try:
+            config.governor = process_limits.ResourceGovernor.from_options(
+                [config.decoder.name] + [o.encoder.name for o in
+                                         [Output(config.encoder, None)] + config.extra_outputs],
+                args.nice, args.ionice, args.cpus, args.memory_limit)
+        except ValueError as e:
+            setup_parsing(decoders, encoders).error(str(e))
+
     config.disable_id3 = args.noid3
+    if args.embed_artwork and args.noid3:
+        setup_parsing(decoders, encoders).error('argument --embed-artwork: not allowed with --noid3')
+    config.embed_artwork = args.embed_artwork
+    config.artwork_size = args.artwork_size
     if not config.disable_id3:
         try:
             import mutagen
@@ -545,9 +2497,34 @@ def main(import_args=None):
             sys.exit('''You require the Mutagen Python module
                     install it from http://code.google.com/p/mutagen/''')
 
+    if args.worker:
+        # Only the coordinator keeps the manifest
+        config.manifest = None
+        logger.debug(config)
+        conversion_cluster.ClusterWorker(config, args.worker,
+                                         LosslessToLossyConverter).run(LosslessToLossyConverter.job_slots(config))
+        return 0
+
     logger.debug(config)
-    converter = LosslessToLossyConverter(config)
-    converter.start()
+    try:
+        converter = LosslessToLossyConverter(config)
+    except job_journal.JournalLocked as e:
+        sys.exit('Cannot use the journal: {}'.format(e))
+
+    if args.coordinator:
+        conversion_cluster.ClusterCoordinator(converter, args.coordinator).run()
+    elif args.watch:
+        # Let SIGTERM unwind like Ctrl-C so queued jobs finish and the
+        # manifest is saved
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            converter.watch(args.settle)
+        except watcher.InotifyUnavailable as e:
+            sys.exit('Cannot watch {}: {}'.format(config.source_dir, e))
+        except (KeyboardInterrupt, SystemExit):
+            logger.info('Stopping watch')
+    else:
+        converter.start()
     converter.print_results()
 
     return 0
@@ -0,0 +1,165 @@
+"""
+    Crash-safe journal of a run's jobs (--journal, --resume).
+
+    An append-only file of JSON lines recording the jobs a run planned
+    (as the scan found them), started and finished. A run that was
+    killed leaves a journal without its final 'done' record, which the
+    next run uses to remove the temporary files of the jobs that were
+    cut off and, with --resume, to continue with the jobs left instead
+    of scanning the source again.
+
+    Each record is flushed as it's written, so at most a partly written
+    last line is lost, which is ignored when reading.
+"""
+import os
+import json
+import time
+import socket
+import logging
+import threading
+import collections
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # Windows: no locking
+
+
+logger = logging.getLogger(__name__)
+
+
+class JournalLocked(Exception):
+    """ Another running process is using the journal """
+
+
+class JobJournal(object):
+    """
+        Reads the journal at path, as left by the previous run, then
+        records this run's jobs in it. Jobs are (kind, relative path,
+        schedule key, output indexes) as yielded by scan_source().
+
+        Shared by all converter threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+        # State of the previous run
+        self.plan = collections.OrderedDict()   # (kind, path) -> job, in scan order
+        self.started_jobs = set()               # (kind, path) started, not finished
+        self.finished_jobs = set()              # (kind, path) finished
+        self.scanned = False                    # Its scan completed
+        self.done = True                        # It ended normally (or there was none)
+
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        self._file = open(path, 'a+')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                self._file.close()
+                raise JournalLocked('{} is in use by another run'.format(path))
+
+        self._file.seek(0)
+        self.load(self._file)
+
+    def load(self, f):
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue    # Cut off by the crash
+
+            event = record.get('event')
+            job = (record.get('kind'), record.get('path'))
+
+            if event == 'run':
+                self._reset()
+            elif event == 'resume':
+                self.done = False
+            elif event == 'planned':
+                key = record['key']
+                self.plan[job] = (job[0], job[1], tuple(key) if key is not None else None,
+                                  tuple(record['needed']))
+            elif event == 'scanned':
+                self.scanned = True
+            elif event == 'started':
+                self.started_jobs.add(job)
+            elif event == 'finished':
+                self.started_jobs.discard(job)
+                self.finished_jobs.add(job)
+            elif event == 'done':
+                self.done = True
+
+    def _reset(self):
+        self.plan.clear()
+        self.started_jobs.clear()
+        self.finished_jobs.clear()
+        self.scanned = False
+        self.done = False
+
+    def resumable(self):
+        """ True if the previous run was cut off after its scan """
+        return not self.done and self.scanned
+
+    def pending(self):
+        """ The previous run's planned jobs that didn't finish, in scan order """
+        return [job for k, job in self.plan.items() if k not in self.finished_jobs]
+
+    def interrupted(self):
+        """ The previous run's jobs that were started but didn't finish """
+        if self.done:
+            return []
+        return [job for k, job in self.plan.items() if k in self.started_jobs]
+
+    def begin(self, resumed=False):
+        """
+            Starts recording this run. A resumed run appends to the
+            previous run's records, any other run replaces them.
+        """
+        if not resumed:
+            self._file.seek(0)
+            self._file.truncate()
+            self._reset()
+
+        self.done = False
+        self.write({'event': 'resume' if resumed else 'run', 'host': socket.gethostname(),
+                    'pid': os.getpid()})
+
+    def planned(self, kind, rel_path, key, needed):
+        self.plan[(kind, rel_path)] = (kind, rel_path, key, needed)
+        self.write({'event': 'planned', 'kind': kind, 'path': rel_path,
+                    'key': list(key) if key is not None else None, 'needed': list(needed)})
+
+    def scan_done(self):
+        self.scanned = True
+        self.write({'event': 'scanned'}, sync=True)
+
+    def started(self, kind, rel_path):
+        self.write({'event': 'started', 'kind': kind, 'path': rel_path})
+
+    def finished(self, kind, rel_path, results):
+        self.write({'event': 'finished', 'kind': kind, 'path': rel_path, 'results': list(results)})
+
+    def finish(self):
+        """ Records that the run ended normally """
+        self.done = True
+        self.write({'event': 'done'}, sync=True)
+
+    def write(self, record, sync=False):
+        record['time'] = round(time.time(), 3)
+        line = json.dumps(record, sort_keys=True) + '\n'
+
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,276 @@
+"""
+    Segmented MP3 encoding of long sources (--split-long).
+
+    A long source is cut into ranges on MP3 frame boundaries (1152
+    samples), each range is decoded and encoded by its own decoder and
+    encoder pair, and the frames are joined into one file.
+
+    LAME delays its output by the same number of samples in every
+    encode, so an encode started on a frame boundary produces frames on
+    the same grid as an encode of the whole source. Each range is
+    encoded with PRE_ROLL frames of the audio before it and POST_ROLL
+    frames after it, which are dropped again, so the frames kept were
+    encoded with the same surrounding audio as in a single encode and
+    the joins have no gaps or overlaps. The timing doesn't depend on
+    the pre-roll: it's fixed by the frame grid. The pre-roll covers the
+    filterbank and MDCT overlap and the psychoacoustic model's short-term
+    state, so the frames around a join sound like the single encode's.
+    Slower-adapting encoder state only changes bitrate decisions.
+
+    Encoding with --nores makes every frame self-contained (no bit
+    reservoir), so frames can be cut between any two. LAME has no way
+    to disable the reservoir for single frames only, so the whole file
+    is encoded without it. That costs some quality or bitrate over a
+    normal encode, and a split file never matches a normal encode byte
+    for byte, so split encodes are kept under their own encode cache
+    key.
+
+    The LAME tag frame of the first segment is kept, with its frame
+    count, byte count, seek table, end padding and CRCs updated for the
+    joined file, so players still trim the encoder delay and padding.
+"""
+import os
+import struct
+import logging
+import collections
+
+
+logger = logging.getLogger(__name__)
+
+SAMPLES_PER_FRAME = 1152    # MPEG-1 Layer III
+SAMPLE_RATES = (44100, 48000, 32000)
+BITRATES = (None, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, None)
+
+# Frames encoded before and after each range, then dropped
+PRE_ROLL = 4
+POST_ROLL = 4
+
+# A range of the source in samples (until None = to the end), and the
+# frames to drop from the start of its encode and to keep after them
+# (None = all)
+Segment = collections.namedtuple('Segment', 'skip until drop keep')
+
+
+def plan_segments(total_samples, count):
+    """
+        Splits total_samples into count ranges of whole frames. Returns
+        a list of Segments.
+    """
+    frames = -(-total_samples // SAMPLES_PER_FRAME)
+    bounds = [frames * i // count for i in range(count + 1)]
+    segments = []
+
+    for i in range(count):
+        first = max(0, bounds[i] - PRE_ROLL)
+        if i == count - 1:
+            until = keep = None
+        else:
+            until = min(total_samples, (bounds[i + 1] + POST_ROLL) * SAMPLES_PER_FRAME)
+            keep = bounds[i + 1] - bounds[i]
+        segments.append(Segment(first * SAMPLES_PER_FRAME, until, bounds[i] - first, keep))
+
+    return segments
+
+
+_crc16_table = []
+for _n in range(256):
+    _c = _n
+    for _k in range(8):
+        _c = (_c >> 1) ^ 0xa001 if _c & 1 else _c >> 1
+    _crc16_table.append(_c)
+
+
+def crc16(data, crc=0):
+    """ CRC-16 (ARC) of data, as used in the LAME tag """
+    table = _crc16_table
+    for b in bytearray(data):
+        crc = table[(crc ^ b) & 0xff] ^ (crc >> 8)
+    return crc
+
+
+def frame_length(header):
+    """
+        Length in bytes of the MPEG-1 Layer III frame starting with the
+        4 byte header. Raises ValueError for anything else.
+    """
+    b = bytearray(header)
+    if b[0] != 0xff or (b[1] & 0xfe) != 0xfa:
+        raise ValueError('Not an MPEG-1 Layer III frame header')
+
+    bitrate = BITRATES[b[2] >> 4]
+    sample_rate_index = (b[2] >> 2) & 3
+    if bitrate is None or sample_rate_index == 3:
+        raise ValueError('Unsupported bitrate or sample rate')
+
+    return 144000 * bitrate // SAMPLE_RATES[sample_rate_index] + ((b[2] >> 1) & 1)
+
+
+def frame_sample_rate(header):
+    return SAMPLE_RATES[(bytearray(header)[2] >> 2) & 3]
+
+
+def side_info_offset(header):
+    """ Offset of the side information in a frame: after the header and CRC """
+    return 4 if bytearray(header)[1] & 1 else 6
+
+
+def xing_offset(header):
+    """ Offset of a Xing/Info tag in a frame: after the side information """
+    mono = (bytearray(header)[3] >> 6) == 3
+    return side_info_offset(header) + (17 if mono else 32)
+
+
+def read_frames(f):
+    """
+        Returns the (offset, length, header) of every frame in the MP3
+        file f, after any ID3v2 tag
+    """
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+
+    offset = 0
+    head = f.read(10)
+    if head[:3] == b'ID3' and len(head) == 10:
+        b = bytearray(head)
+        offset = 10 + ((b[6] << 21) | (b[7] << 14) | (b[8] << 7) | b[9])
+        if b[5] & 0x10:
+            offset += 10    # Footer
+
+    frames = []
+    while offset < size:
+        f.seek(offset)
+        header = f.read(4)
+        if header[:3] == b'TAG':
+            break   # ID3v1
+
+        length = frame_length(header)
+        if offset + length > size:
+            raise ValueError('Truncated frame at {}'.format(offset))
+
+        frames.append((offset, length, header))
+        offset += length
+
+    return frames
+
+
+def read_frame(f, frame):
+    offset, length, header = frame
+    f.seek(offset)
+    return f.read(length)
+
+
+def is_tag_frame(data):
+    """ True for a frame holding a Xing/Info (LAME) tag instead of audio """
+    x = xing_offset(data[:4])
+    return data[x:x + 4] in (b'Xing', b'Info')
+
+
+def main_data_begin(data):
+    """ Bytes of earlier frames a frame's audio starts in (0 without bit reservoir) """
+    b = bytearray(data[side_info_offset(data[:4]):][:2])
+    return (b[0] << 1) | (b[1] >> 7)
+
+
+def join(segment_files, plan, output_file, total_samples, sample_rate):
+    """
+        Joins the encodes of the segments in plan into output_file,
+        keeping the LAME tag of the first one, if any, updated for the
+        joined file. Raises ValueError if an encode doesn't have the
+        frames expected or they can't be joined, e.g. because the
+        encoder resampled the source.
+    """
+    kept = []   # (path, frames) for each segment
+    tag = None
+    first_frames = first_size = 0
+
+    for i, (path, segment) in enumerate(zip(segment_files, plan)):
+        with open(path, 'rb') as f:
+            frames = read_frames(f)
+            if frames and is_tag_frame(read_frame(f, frames[0])):
+                if i == 0:
+                    tag = read_frame(f, frames[0])
+                    first_frames = len(frames) - 1
+                    first_size = frames[-1][0] + frames[-1][1] - frames[0][0]
+                frames = frames[1:]
+
+            if segment.keep is None:
+                frames = frames[segment.drop:]
+            else:
+                frames = frames[segment.drop:segment.drop + segment.keep]
+                if len(frames) < segment.keep:
+                    raise ValueError('Segment {} is {} frames short'.format(
+                        i + 1, segment.keep - len(frames)))
+
+            if frames and frame_sample_rate(frames[0][2]) != sample_rate:
+                raise ValueError('Segment {} was resampled to {} Hz'.format(
+                    i + 1, frame_sample_rate(frames[0][2])))
+            if i and frames and main_data_begin(read_frame(f, frames[0])):
+                raise ValueError('Segment {} was encoded with the bit reservoir'.format(i + 1))
+
+        kept.append((path, frames))
+
+    offsets = []
+    crc = 0
+    position = len(tag) if tag is not None else 0
+
+    with open(output_file, 'wb') as out:
+        if tag is not None:
+            out.write(tag)
+
+        for path, frames in kept:
+            with open(path, 'rb') as f:
+                for frame in frames:
+                    data = read_frame(f, frame)
+                    crc = crc16(data, crc)
+                    offsets.append(position)
+                    out.write(data)
+                    position += len(data)
+
+        if tag is not None:
+            first_samples = plan[0].until - plan[0].skip if plan[0].until is not None else total_samples
+            out.seek(0)
+            out.write(update_tag(tag, offsets, position, crc, total_samples,
+                                 first_frames, first_size, first_samples))
+
+
+def update_tag(tag, offsets, size, music_crc, total_samples, first_frames, first_size, first_samples):
+    """
+        Returns the LAME tag frame of the first segment's encode (which
+        had first_frames audio frames, first_size bytes with the tag and
+        first_samples samples) updated for the joined file of size bytes,
+        with audio frames at offsets
+    """
+    tag = bytearray(tag)
+    x = xing_offset(tag[:4])
+    flags = struct.unpack('>I', tag[x + 4:x + 8])[0]
+    if flags & 0x7 != 0x7:
+        raise ValueError('Xing tag without frame count, byte count and seek table')
+
+    frames = len(offsets)
+    old_frames, old_size = struct.unpack('>II', tag[x + 8:x + 16])
+    struct.pack_into('>II', tag, x + 8, old_frames - first_frames + frames, old_size - first_size + size)
+
+    # Seek table: position of each percent of the duration, in 1/256ths of the file
+    for i in range(100):
+        tag[x + 16 + i] = min(255, offsets[i * frames // 100] * 256 // size)
+
+    lame = x + 116 + (4 if flags & 0x8 else 0)
+    if tag[lame:lame + 4] != b'LAME':
+        return bytes(tag)
+
+    delay_padding = struct.unpack('>I', b'\0' + bytes(tag[lame + 21:lame + 24]))[0]
+    padding = (delay_padding & 0xfff) + (frames - first_frames) * SAMPLES_PER_FRAME - \
+        (total_samples - first_samples)
+    if not 0 <= padding < 0x1000:
+        raise ValueError('Encoder padding out of range: {}'.format(padding))
+    tag[lame + 21:lame + 24] = struct.pack('>I', (delay_padding & 0xfff000) | padding)[1:]
+
+    # The ReplayGain peak and gains were measured on the first segment only
+    tag[lame + 11:lame + 19] = b'\0' * 8
+
+    music_length = struct.unpack('>I', tag[lame + 28:lame + 32])[0]
+    struct.pack_into('>IH', tag, lame + 28, music_length - first_size + size, music_crc)
+    struct.pack_into('>H', tag, lame + 34, crc16(tag[:lame + 34]))
+
+    return bytes(tag)
@@ -0,0 +1,129 @@
+"""
+    Supervision of decoder/encoder pipelines.
+
+    A PipelineWatchdog thread kills every process of a conversion that
+    runs past its deadline, or that stops moving data for a while. Data
+    movement is the characters read and written by the processes
+    (/proc/PID/io, Linux) plus the size of the files being written.
+"""
+import os
+import time
+import signal
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+def process_io(pid):
+    """
+        Returns the bytes read plus written by process pid so far, or
+        None where /proc/PID/io can't be read
+    """
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['rchar']) + int(fields['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+class PipelineWatchdog(object):
+    """
+        Kills the processes given to watch() when the pipeline runs
+        longer than timeout seconds, or when no data has moved for
+        stall_timeout seconds. Either can be None to disable it.
+
+        reason is set to a description once the pipeline was killed,
+        and expired is True if the watchdog killed it itself. Such a
+        pipeline isn't retried: another attempt would most likely run
+        as long again.
+    """
+
+    interval = 1.0      # Seconds between checks
+
+    def __init__(self, timeout=None, stall_timeout=None):
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.procs = []
+        self.files = []
+        self.reason = None
+        self.expired = False
+        self.started = time.time()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_progress = None
+        self._last_change = self.started
+
+    def watch(self, proc):
+        self.procs.append(proc)
+
+    def watch_file(self, path):
+        self.files.append(path)
+
+    def progress(self):
+        """ Sum of the processes' I/O and the files' sizes """
+        counters = [process_io(p.pid) for p in self.procs if p.returncode is None]
+        counters += [file_size(path) for path in self.files]
+        return sum(c for c in counters if c is not None)
+
+    def check(self, now):
+        """
+            Returns why the pipeline should be killed at time now, or None
+        """
+        if self.timeout is not None and now - self.started > self.timeout:
+            return 'timed out after {:.0f} seconds'.format(now - self.started)
+
+        if self.stall_timeout is not None:
+            progress = self.progress()
+            if progress != self._last_progress:
+                self._last_progress = progress
+                self._last_change = now
+            elif now - self._last_change > self.stall_timeout:
+                return 'stalled for {:.0f} seconds'.format(now - self._last_change)
+
+        return None
+
+    def kill(self, reason):
+        self.reason = reason
+        for p in self.procs:
+            # Not p.kill(): it may reap the process, losing its rusage
+            if p.returncode is None:
+                try:
+                    os.kill(p.pid, getattr(signal, 'SIGKILL', signal.SIGTERM))
+                except OSError:
+                    pass
+
+    def expire(self, reason):
+        """ Kills the pipeline for running too long or stalling """
+        logger.debug('Killing pipeline: {}'.format(reason))
+        self.expired = True
+        self.kill(reason)
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            reason = self.check(time.time())
+            if reason is not None:
+                self.expire(reason)
+                return
+
+    def start(self):
+        if self.timeout is None and self.stall_timeout is None:
+            return
+
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
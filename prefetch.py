@@ -0,0 +1,165 @@
+"""
+    Read-ahead of source files (--prefetch).
+
+    A Prefetcher thread reads the sources of queued jobs ahead of the
+    workers, in the order they will be converted, so the page cache
+    already holds them when their decoder starts. It hints the kernel
+    with posix_fadvise(WILLNEED) where available, then reads the file
+    sequentially through one small buffer, which also works on network
+    filesystems that ignore the hint.
+
+    At most depth bytes are read ahead of the jobs that have started.
+    Each job start is counted as warm (fully read ahead), partial or
+    cold, to show whether the depth keeps up with the workers.
+"""
+import os
+import heapq
+import logging
+import threading
+import collections
+
+
+logger = logging.getLogger(__name__)
+
+WARM = 'warm'
+PARTIAL = 'partial'
+COLD = 'cold'
+
+
+class Prefetcher(object):
+    """
+        Reads the files given to add() ahead of started() being called
+        for them, lowest (key, seq) first, while less than depth bytes
+        are read ahead
+    """
+
+    # Bytes read at a time
+    chunk_size = 1 << 20
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.ahead = 0          # Bytes read for files not started yet
+        self.counts = collections.Counter()     # Job starts by state
+
+        self._queue = []        # Heap of (key, seq, path) to read
+        self._queued = collections.Counter()    # Paths in _queue
+        self._read = {}         # Path -> [bytes read, complete] for files not started yet
+        self._skip = set()      # Paths started while still in _queue
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def add(self, path, key=(), seq=0):
+        """ Queues path to be read ahead, in (key, seq) order """
+        with self._cond:
+            heapq.heappush(self._queue, (key, seq, path))
+            self._queued[path] += 1
+            self._cond.notify()
+
+    def started(self, path):
+        """
+            Tells that a job started reading path. Returns how much of
+            it was read ahead: WARM, PARTIAL or COLD.
+        """
+        with self._cond:
+            state = COLD
+            read = self._read.pop(path, None)
+            if read is not None:
+                self.ahead -= read[0]
+                state = WARM if read[1] else PARTIAL if read[0] else COLD
+            if self._queued[path]:
+                self._skip.add(path)
+
+            self.counts[state] += 1
+            self._cond.notify()
+
+        return state
+
+    def next_file(self):
+        """
+            Waits for a file to read and room to read it. Returns its
+            path and how many bytes were read already, or None to stop.
+        """
+        with self._cond:
+            while True:
+                while not self._stopped and (not self._queue or self.ahead >= self.depth):
+                    self._cond.wait()
+                if self._stopped:
+                    return None
+
+                key, seq, path = heapq.heappop(self._queue)
+                self._queued[path] -= 1
+                if not self._queued[path]:
+                    del self._queued[path]
+
+                if path in self._skip:
+                    if path not in self._queued:
+                        self._skip.discard(path)
+                    continue
+
+                read = self._read.setdefault(path, [0, False])
+                if read[1]:
+                    continue
+
+                return key, seq, path, read[0]
+
+    def read_file(self, key, seq, path, offset, buf):
+        """
+            Reads path from offset until it ends, its job starts or the
+            depth is reached, in which case it's queued again to finish
+        """
+        try:
+            with open(path, 'rb') as f:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f.fileno(), offset, max(len(buf), self.depth - self.ahead),
+                                     os.POSIX_FADV_WILLNEED)
+                f.seek(offset)
+
+                while True:
+                    n = f.readinto(buf)
+                    with self._cond:
+                        read = self._read.get(path)
+                        if read is None:
+                            return      # Its job started
+                        read[0] += n
+                        self.ahead += n
+
+                        if n < len(buf):
+                            read[1] = True
+                            return
+                        if self.ahead >= self.depth:
+                            heapq.heappush(self._queue, (key, seq, path))
+                            self._queued[path] += 1
+                            return
+
+        except (IOError, OSError) as e:
+            logger.debug('Could not read ahead {}: {}'.format(path, e))
+
+    def run(self):
+        buf = bytearray(self.chunk_size)
+
+        while True:
+            job = self.next_file()
+            if job is None:
+                return
+
+            key, seq, path, offset = job
+            self.read_file(key, seq, path, offset, buf)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        total = sum(self.counts.values())
+        if total:
+            logger.info('{} of {} jobs started on cold data, {} partly read ahead'.format(
+                self.counts[COLD], total, self.counts[PARTIAL]))
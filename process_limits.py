@@ -0,0 +1,256 @@
+"""
+    Scheduling and resource limits for decoder and encoder processes.
+
+    A ResourceGovernor holds the limits for the run and per codec, and
+    applies them by pid to a codec process right after it's started:
+
+        nice        CPU nice level (setpriority)
+        ionice      I/O scheduling class and level (ioprio_set, Linux)
+        cpus        CPU affinity (os.sched_setaffinity, Linux)
+        memory      address space limit in bytes (prlimit RLIMIT_AS, Linux)
+
+    They're set from the parent rather than in a preexec_fn, which
+    isn't safe in a process running threads: the child can deadlock
+    between fork and exec. The child runs unlimited for the moment
+    between its start and the limits being set.
+"""
+import os
+import re
+import sys
+import errno
+import logging
+import threading
+import platform
+import collections
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+
+logger = logging.getLogger(__name__)
+
+# I/O scheduling classes (linux/ioprio.h)
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+ioprio_classes = {'realtime': IOPRIO_CLASS_RT, 'rt': IOPRIO_CLASS_RT, '1': IOPRIO_CLASS_RT,
+                  'best-effort': IOPRIO_CLASS_BE, 'be': IOPRIO_CLASS_BE, '2': IOPRIO_CLASS_BE,
+                  'idle': IOPRIO_CLASS_IDLE, '3': IOPRIO_CLASS_IDLE}
+
+# ioprio_set system call numbers by machine
+ioprio_set_syscalls = {'x86_64': 251, 'amd64': 251, 'i386': 289, 'i686': 289,
+                       'aarch64': 30, 'arm64': 30, 'riscv64': 30,
+                       'armv7l': 314, 'armv6l': 314, 'ppc64le': 273, 'ppc64': 273, 's390x': 282}
+
+
+class ProcessLimits(collections.namedtuple('ProcessLimits', 'nice ionice cpus memory')):
+    """
+        Limits for one codec's processes. Unset limits are None.
+
+        ionice is a (class, level) tuple, cpus a set of CPU numbers and
+        memory a number of bytes.
+    """
+
+    def merged(self, overrides):
+        """
+            Returns these limits with the ones set in overrides replacing them
+        """
+        return ProcessLimits(*[o if o is not None else s for s, o in zip(self, overrides)])
+
+
+no_limits = ProcessLimits(None, None, None, None)
+
+
+def parse_nice(value):
+    nice = int(value)
+    if not -20 <= nice <= 19:
+        raise ValueError('nice level must be between -20 and 19, got {}'.format(value))
+    return nice
+
+
+def parse_ionice(value):
+    """
+        Parses CLASS[:LEVEL], e.g. idle, best-effort:7 or rt:0
+    """
+    cls, sep, level = value.partition(':')
+    if cls.lower() not in ioprio_classes:
+        raise ValueError('I/O class must be one of idle, best-effort or realtime, got {}'.format(cls))
+
+    cls = ioprio_classes[cls.lower()]
+    level = int(level) if level else (0 if cls == IOPRIO_CLASS_IDLE else 4)
+    if not 0 <= level <= 7:
+        raise ValueError('I/O level must be between 0 and 7, got {}'.format(level))
+
+    return cls, level
+
+
+def parse_cpus(value):
+    """
+        Parses a CPU list like 0-3,6 into a set
+    """
+    cpus = set()
+    for part in value.split(','):
+        first, sep, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+
+    if not cpus:
+        raise ValueError('Empty CPU list')
+
+    return cpus
+
+
+def parse_size(value):
+    """
+        Parses a size in bytes with an optional K, M, G or T suffix
+    """
+    match = re.match(r'^(\d+)([KMGT]?)B?$', value.strip().upper())
+    if match is None:
+        raise ValueError('Invalid size: {}'.format(value))
+
+    return int(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2) or ' ')
+
+
+class ResourceGovernor(object):
+    """
+        Limits for every codec's processes: defaults for the run and
+        overrides by codec name.
+    """
+
+    def __init__(self, defaults=no_limits, per_codec=None):
+        self.defaults = defaults
+        self.per_codec = dict(per_codec or {})
+        self._steps = {}
+        self._ioprio_set = self.find_ioprio_set()
+        self._denied = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_options(cls, codec_names, nice=(), ionice=(), cpus=(), memory=()):
+        """
+            Builds a governor from lists of [CODEC=]VALUE option values,
+            one list per limit. Raises ValueError for invalid values.
+        """
+        defaults = no_limits
+        per_codec = {}
+
+        for field, parse, values in (('nice', parse_nice, nice),
+                                     ('ionice', parse_ionice, ionice),
+                                     ('cpus', parse_cpus, cpus),
+                                     ('memory', parse_size, memory)):
+            for value in values or ():
+                codec, sep, setting = value.rpartition('=')
+                limit = no_limits._replace(**{field: parse(setting)})
+
+                if not sep:
+                    defaults = defaults.merged(limit)
+                elif codec in codec_names:
+                    per_codec[codec] = per_codec.get(codec, no_limits).merged(limit)
+                else:
+                    raise ValueError('Unknown codec {} (choose from {})'.format(
+                        codec, ', '.join(codec_names)))
+
+        return cls(defaults, per_codec)
+
+    def limits_for(self, codec):
+        return self.defaults.merged(self.per_codec.get(codec.name, no_limits))
+
+    @staticmethod
+    def find_ioprio_set():
+        """
+            Returns a function calling ioprio_set(), or None if it isn't
+            available here
+        """
+        nr = ioprio_set_syscalls.get(platform.machine().lower())
+        if ctypes is None or nr is None or not sys.platform.startswith('linux'):
+            return None
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            syscall = libc.syscall
+        except (OSError, AttributeError):
+            return None
+
+        def ioprio_set(pid, cls, level):
+            if syscall(nr, IOPRIO_WHO_PROCESS, pid, (cls << IOPRIO_CLASS_SHIFT) | level) == -1:
+                e = ctypes.get_errno()
+                raise OSError(e, 'ioprio_set: {}'.format(os.strerror(e)))
+
+        return ioprio_set
+
+    def steps(self, codec):
+        """
+            Returns (limit name, function setting it on a pid) pairs for
+            codec's limits
+        """
+        if codec.name in self._steps:
+            return self._steps[codec.name]
+
+        limits = self.limits_for(codec)
+        steps = []
+
+        if limits.nice is not None:
+            if hasattr(os, 'setpriority'):
+                steps.append(('nice', lambda pid: os.setpriority(os.PRIO_PROCESS, pid, limits.nice)))
+            else:
+                logger.warning('Nice levels are not supported here, ignoring --nice')
+
+        if limits.ionice is not None:
+            if self._ioprio_set is not None:
+                ioprio_set = self._ioprio_set
+                steps.append(('ionice', lambda pid: ioprio_set(pid, *limits.ionice)))
+            else:
+                logger.warning('I/O priorities are not supported here, ignoring --ionice')
+
+        if limits.cpus is not None:
+            if hasattr(os, 'sched_setaffinity'):
+                steps.append(('cpus', lambda pid: os.sched_setaffinity(pid, limits.cpus)))
+            else:
+                logger.warning('CPU affinity is not supported here, ignoring --cpus')
+
+        if limits.memory is not None:
+            if hasattr(resource, 'prlimit'):
+                steps.append(('memory', lambda pid: resource.prlimit(pid, resource.RLIMIT_AS,
+                                                                     (limits.memory, limits.memory))))
+            else:
+                logger.warning('Memory limits are not supported here, ignoring --memory-limit')
+
+        self._steps[codec.name] = steps
+        return steps
+
+    def apply(self, codec, pid):
+        """
+            Sets codec's limits on the running process pid. Raises
+            OSError if one can't be set.
+
+            A limit that isn't permitted, e.g. a negative nice level in
+            an unprivileged run, is skipped instead: with a warning the
+            first time, as it would fail the same way for every process.
+        """
+        for name, step in self.steps(codec):
+            try:
+                step(pid)
+            except OSError as e:
+                if e.errno not in (errno.EPERM, errno.EACCES):
+                    raise
+
+                with self._lock:
+                    first = name not in self._denied
+                    self._denied.add(name)
+
+                log = logger.warning if first else logger.debug
+                log('Could not set {} limit on {} process {}: {}'.format(name, codec.name, pid, e))
+
+    def __str__(self):
+        return ', '.join(['{}'.format(self.defaults)] +
+                         ['{}: {}'.format(k, v) for k, v in sorted(self.per_codec.items())])
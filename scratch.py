@@ -0,0 +1,185 @@
+"""
+    Local scratch space for encodes (--scratch-dir).
+
+    Encoders write, and tags are written, on fast local storage such as
+    a tmpfs or a local SSD. Each finished output is then copied once to
+    the destination under a temporary name and renamed into place, so
+    a network destination only sees one sequential write per file.
+
+    The space in use is capped by a byte budget. A job that doesn't fit
+    is encoded in the destination as if there was no scratch space.
+
+    Each run's directory holds the host name and pid of its owner, so a
+    later run can remove the directories of runs that were killed.
+"""
+import os
+import errno
+import socket
+import shutil
+import logging
+import tempfile
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+DIR_PREFIX = 'flacthis-'
+PID_FILE = 'pid'        # "<host name> <pid>" of the run owning a directory
+
+
+def free_space(path):
+    """ Bytes available to us on path's filesystem, or None if unknown """
+    try:
+        st = os.statvfs(path)
+    except (AttributeError, OSError):
+        return None
+
+    return st.f_bavail * st.f_frsize
+
+
+def process_exists(pid):
+    """ False if no process pid is running on this host """
+    if os.name == 'nt':
+        return True     # os.kill() would terminate it
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+
+    return True
+
+
+def remove_stale(path):
+    """
+        Removes the run directories under path whose owner ran on this
+        host and is no longer running. Directories without a readable
+        pid file are left alone.
+    """
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return
+
+    hostname = socket.gethostname()
+    for name in names:
+        run_dir = os.path.join(path, name)
+        if not name.startswith(DIR_PREFIX) or not os.path.isdir(run_dir):
+            continue
+
+        try:
+            with open(os.path.join(run_dir, PID_FILE)) as f:
+                host, pid = f.read().split()
+            pid = int(pid)
+        except (IOError, OSError, ValueError):
+            continue
+
+        if host == hostname and not process_exists(pid):
+            logger.info('Removing scratch space {} of stopped run {}'.format(run_dir, pid))
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+
+class ScratchSpace(object):
+    """
+        A per-run directory under path, handing out a Stage per job
+        while the reserved sizes fit in budget bytes. Without a budget,
+        half the free space of path at start is used. Directories left
+        under path by killed runs are removed first.
+
+        Shared by all converter threads.
+    """
+
+    def __init__(self, path, budget=None):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        if budget is None:
+            free = free_space(path)
+            budget = free // 2 if free is not None else None
+
+        self.budget = budget
+        self.used = 0
+        remove_stale(path)
+        self.path = tempfile.mkdtemp(prefix=DIR_PREFIX, dir=path)
+        with open(os.path.join(self.path, PID_FILE), 'w') as f:
+            f.write('{} {}\n'.format(socket.gethostname(), os.getpid()))
+        self._lock = threading.Lock()
+        self._jobs = 0
+
+        logger.debug('Scratch space {} ({} bytes)'.format(self.path, budget))
+
+    def reserve(self, size):
+        """
+            Returns a Stage for a job expected to write size bytes, or
+            None if that would exceed the budget
+        """
+        with self._lock:
+            if self.budget is not None and self.used + size > self.budget:
+                return None
+            self.used += size
+            self._jobs += 1
+            job = self._jobs
+
+        path = os.path.join(self.path, str(job))
+        try:
+            os.mkdir(path)
+        except OSError:
+            with self._lock:
+                self.used -= size
+            raise
+
+        return Stage(path, size)
+
+    def release(self, stage):
+        """ Removes a job's files and returns its space to the budget """
+        shutil.rmtree(stage.path, ignore_errors=True)
+
+        with self._lock:
+            self.used -= stage.size
+
+    @staticmethod
+    def publish(staged_file, lossy_file):
+        """
+            Copies a finished file from the scratch space to the
+            destination under a temporary name, then renames it into
+            place so readers never see a partial file
+        """
+        name, ext = os.path.splitext(lossy_file)
+        tmp = name + '.tmp' + ext
+
+        try:
+            shutil.copyfile(staged_file, tmp)
+            os.rename(tmp, lossy_file)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    logger.warning('Could not remove {}: {}'.format(tmp, e))
+            raise
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class Stage(object):
+    """
+        One job's directory in the scratch space
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._files = {}
+
+    def staged_file(self, lossy_file):
+        """
+            Returns where the output for lossy_file is finished and
+            tagged before being published. Outputs with the same name
+            (in different destinations) get different files.
+        """
+        if lossy_file not in self._files:
+            self._files[lossy_file] = os.path.join(
+                self.path, '{}-{}'.format(len(self._files), os.path.basename(lossy_file)))
+
+        return self._files[lossy_file]
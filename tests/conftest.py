@@ -120,3 +120,17 @@ def wav_converter(converter_config, create_mock_source_dir, codec_manager):
     conv = LosslessToLossyConverter(conf)
 
     return conv
+
+@pytest.fixture
+def unprobed_converter(converter_config, tmpdir):
+    ''' Converter using codec objects that were never located on the system '''
+    tmpdir.mkdir('src')
+    conf = converter_config
+    conf.source_dir = str(tmpdir.join('src'))
+    conf.dest_dir = str(tmpdir.join('dest'))
+    conf.decoder = audio_codecs.FLACDecoder()
+    conf.encoder = audio_codecs.MP3Encoder()
+    conv = LosslessToLossyConverter(conf)
+    conv.retry_delay = 0
+
+    return conv
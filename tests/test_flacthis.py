@@ -4,12 +4,38 @@ import pytest
 import os
 import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import flacthis
 from flacthis import ConverterConfig, LosslessToLossyConverter
+from conversion_manifest import ConversionManifest
+import conversion_cluster
+import artwork
+import file_ops
+import conversion_metrics
+import concurrency
+import process_limits
+import watcher
+import scratch
+import prefetch
+import job_journal
+import encode_cache
+import mp3_segments
 import audio_codecs
 import multiprocessing
+import struct
 import tempfile
+import time
+import errno
+import logging
 from distutils import spawn
 
+def flac_header(total_samples, sample_rate=44100, channels=2, bps=16, md5=b'\x00' * 16):
+    ''' Returns the fLaC marker and a STREAMINFO block '''
+    packed = (sample_rate << 44) | ((channels - 1) << 41) | ((bps - 1) << 36) | total_samples
+    streaminfo = struct.pack('>HH', 4096, 4096) + b'\x00' * 6 + struct.pack('>Q', packed) + md5
+    return b'fLaC' + struct.pack('>I', (1 << 31) | len(streaminfo))[0:1] + \
+        struct.pack('>I', len(streaminfo))[1:] + streaminfo
+
+
 class TestConverterConfig(object):
     # Source dir tests
     def test_source_dir_missing(self, converter_config):
@@ -54,9 +80,10 @@ class TestConverterConfig(object):
 
     def test_auto_thread_detection(self, converter_config):
         converter_config.threads = 0
-        cpu_count = multiprocessing.cpu_count()
+        cpu_count = concurrency.available_cpus()
 
         assert converter_config._threads == cpu_count
+        assert cpu_count <= multiprocessing.cpu_count()
 
     def test_invalid_thread_count(self, converter_config):
         with pytest.raises(OSError, match='Cannot set thread count to less than 0'):
@@ -145,3 +172,1544 @@ class TestConverter(object):
             flac_converter.dest_dir = None
             flac_converter.Encoder = codec_manager.get_encoder('mp3')
             flac_converter.start()
+
+class TestConversionManifest(object):
+    def test_unknown_source(self, tmpdir):
+        m = ConversionManifest(str(tmpdir.join('state.sqlite')))
+        st = os.stat(str(tmpdir))
+        assert m.check('a.flac', st, audio_codecs.MP3Encoder(), '/dest/a.mp3') == \
+            ConversionManifest.UNKNOWN
+
+    def test_recorded_source_is_current(self, tmpdir):
+        m = ConversionManifest(str(tmpdir.join('state.sqlite')))
+        enc = audio_codecs.MP3Encoder()
+        st = os.stat(str(tmpdir))
+        m.record('a.flac', st, enc, '/dest/a.mp3')
+        assert m.check('a.flac', st, enc, '/dest/a.mp3') == ConversionManifest.CURRENT
+
+    def test_changed_flags(self, tmpdir):
+        m = ConversionManifest(str(tmpdir.join('state.sqlite')))
+        enc = audio_codecs.MP3Encoder()
+        st = os.stat(str(tmpdir))
+        m.record('a.flac', st, enc, '/dest/a.mp3')
+        enc.override_codec_flags('-V 2')
+        assert m.check('a.flac', st, enc, '/dest/a.mp3') == ConversionManifest.CHANGED
+
+    def test_persists_after_close(self, tmpdir):
+        path = str(tmpdir.join('state.sqlite'))
+        enc = audio_codecs.MP3Encoder()
+        st = os.stat(str(tmpdir))
+        m = ConversionManifest(path)
+        m.record('a.flac', st, enc, '/dest/a.mp3')
+        m.close()
+        assert len(ConversionManifest(path)) == 1
+
+    def test_changed_source_is_reconverted(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        conv.manifest = ConversionManifest(str(tmpdir.join('state.sqlite')))
+        src = tmpdir.join('src', 'a.flac')
+        src.write('one')
+        os.makedirs(conv.dest_dir)
+        tmpdir.join('dest', 'a.mp3').write('')
+
+        # Existing output gets adopted into the manifest
+        assert not conv.needs_conversion(str(src))
+        assert len(conv.manifest) == 1
+
+        src.write('changed')
+        assert conv.needs_conversion(str(src))
+
+    def test_old_manifest_is_migrated(self, tmpdir):
+        import sqlite3
+        path = str(tmpdir.join('state.sqlite'))
+        db = sqlite3.connect(path)
+        db.execute('CREATE TABLE conversions (source TEXT NOT NULL, output TEXT NOT NULL, '
+                   'encoder TEXT NOT NULL, flags TEXT NOT NULL, size INTEGER NOT NULL, '
+                   'mtime REAL NOT NULL, PRIMARY KEY (source, output))')
+        db.commit()
+        db.close()
+
+        m = ConversionManifest(path)
+        m.record('a.flac', os.stat(path), audio_codecs.MP3Encoder(), '/dest/a.mp3', 'ab', 'cd')
+        entry = m.get('a.flac', '/dest/a.mp3')
+        assert (entry['audio_md5'], entry['tags_hash']) == ('ab', 'cd')
+
+
+class TestSyncTags(object):
+    @staticmethod
+    def write_flac(path, comment, md5=b'\x01' * 16):
+        ''' FLAC header followed by a VORBIS_COMMENT block and fake audio '''
+        header = flac_header(44100, md5=md5)
+        header = header[:4] + b'\x00' + header[5:]     # STREAMINFO is no longer last
+        block = b'\x84' + struct.pack('>I', len(comment))[1:] + comment
+        path.write_binary(header + block + b'audio')
+
+    @pytest.fixture
+    def conv(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        conv.manifest = ConversionManifest(str(tmpdir.join('state.sqlite')))
+        conv.sync_tags = True
+        os.makedirs(conv.dest_dir)
+        tmpdir.join('dest', 'a.mp3').write('')
+        return conv
+
+    def test_tags_hash_ignores_audio(self, tmpdir):
+        a, b = tmpdir.join('a.flac'), tmpdir.join('b.flac')
+        self.write_flac(a, b'artist=x')
+        self.write_flac(b, b'artist=x', md5=b'\x02' * 16)
+        assert audio_codecs.read_flac_tags_hash(str(a)) == audio_codecs.read_flac_tags_hash(str(b))
+
+        self.write_flac(b, b'artist=y')
+        assert audio_codecs.read_flac_tags_hash(str(a)) != audio_codecs.read_flac_tags_hash(str(b))
+
+    def test_changed_tags_are_retagged(self, conv, tmpdir):
+        src = tmpdir.join('src', 'a.flac')
+        self.write_flac(src, b'artist=x')
+        assert conv.check_source(str(src)) is None
+
+        self.write_flac(src, b'artist=somebody else')
+        assert conv.check_source(str(src)) == conv.SCAN_RETAG
+        assert not conv.needs_conversion(str(src))
+
+    def test_changed_audio_is_reconverted(self, conv, tmpdir):
+        src = tmpdir.join('src', 'a.flac')
+        self.write_flac(src, b'artist=x')
+        assert conv.check_source(str(src)) is None
+
+        self.write_flac(src, b'artist=somebody else', md5=b'\x02' * 16)
+        assert conv.check_source(str(src)) == conv.SCAN_CONVERT
+
+    def test_touched_source_is_current(self, conv, tmpdir):
+        src = tmpdir.join('src', 'a.flac')
+        self.write_flac(src, b'artist=x')
+        assert conv.check_source(str(src)) is None
+
+        os.utime(str(src), (0, 0))
+        assert conv.check_source(str(src)) is None
+        assert conv.manifest.check('a.flac', os.stat(str(src)), conv.Encoder,
+                                   str(tmpdir.join('dest', 'a.mp3'))) == ConversionManifest.CURRENT
+
+    def test_retag_jobs_dispatched(self, conv, tmpdir, monkeypatch):
+        conv.no_artwork = True
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/true'
+        src = tmpdir.join('src', 'a.flac')
+        self.write_flac(src, b'artist=x')
+        conv.check_source(str(src))
+        self.write_flac(src, b'artist=somebody else')
+
+        monkeypatch.setattr(conv, 'update_lossy_tags', lambda lossless, lossy: True)
+        monkeypatch.setattr(conv, 'encode_and_tagging', lambda lossless, targets, metrics=None: pytest.fail())
+        conv.start()
+
+        assert conv.retagged == 1
+        assert conv.success == 0
+
+
+class TestMovedSources(object):
+    @pytest.fixture
+    def conv(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        conv.manifest = ConversionManifest(str(tmpdir.join('state.sqlite')))
+        conv.detect_moves = True
+        tmpdir.mkdir('dest').mkdir('a').join('1.mp3').write('encoded')
+
+        # Adopt the existing output of a/1.flac into the manifest
+        src = tmpdir.join('src').mkdir('a').join('1.flac')
+        TestSyncTags.write_flac(src, b'album=a')
+        assert conv.check_source(str(src)) is None
+        return conv
+
+    def test_moves_detected(self, conv, tmpdir):
+        old = tmpdir.join('src', 'a', '1.flac')
+        new = tmpdir.join('src').mkdir('b').join('1.flac')
+        TestSyncTags.write_flac(new, b'album=b with a longer title')
+        assert conv.check_source(str(new)) == conv.SCAN_CONVERT    # Copied, not moved
+
+        old.remove()
+        assert conv.check_source(str(new)) == conv.SCAN_MOVE
+        conv.detect_moves = False
+        assert conv.check_source(str(new)) == conv.SCAN_CONVERT
+        conv.detect_moves = True
+
+        TestSyncTags.write_flac(new, b'album=b', md5=b'\x02' * 16)
+        assert conv.check_source(str(new)) == conv.SCAN_CONVERT
+
+        TestSyncTags.write_flac(new, b'album=b')
+        tmpdir.join('dest', 'a', '1.mp3').remove()
+        assert conv.check_source(str(new)) == conv.SCAN_CONVERT
+
+    def test_outputs_copied(self, conv, tmpdir, monkeypatch):
+        conv.no_artwork = True
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/true'
+        tmpdir.join('src', 'a').rename(tmpdir.join('src', 'b'))
+
+        tagged = []
+        monkeypatch.setattr(conv, 'update_lossy_tags', lambda lossless, lossy: tagged.append(lossy) or True)
+        monkeypatch.setattr(conv, 'encode_and_tagging', lambda lossless, targets, metrics=None: pytest.fail())
+        conv.start()
+
+        assert conv.moved == 1
+        assert tagged == [str(tmpdir.join('dest', 'b', '1.mp3'))]
+        assert tmpdir.join('dest', 'b', '1.mp3').read() == 'encoded'
+        assert tmpdir.join('dest', 'a', '1.mp3').read() == 'encoded'
+
+
+class TestArtwork(object):
+    def test_cover_name_preferred(self, tmpdir):
+        for name in ('a.jpg', 'Folder.png', 'cover.jpg', 'notes.txt'):
+            tmpdir.join(name).write('')
+        assert artwork.find_cover_image(str(tmpdir)) == str(tmpdir.join('cover.jpg'))
+
+    def test_art_prepared_once_per_album(self, monkeypatch):
+        calls = []
+
+        def fake_find_cover(album_dir):
+            calls.append(album_dir)
+            return b'data', 'image/jpeg'
+
+        monkeypatch.setattr(artwork, 'read_flac_picture', lambda path: None)
+        monkeypatch.setattr(artwork, 'find_cover', fake_find_cover)
+        cache = artwork.ArtworkCache(max_size=0, max_entries=1)
+
+        for i in range(5):
+            assert cache.get(os.path.join('album1', '{}.flac'.format(i))).data == b'data'
+        assert len(calls) == 1
+
+        # Least recently used album is evicted
+        cache.get(os.path.join('album2', '1.flac'))
+        cache.get(os.path.join('album1', '1.flac'))
+        assert len(calls) == 3
+        assert len(cache) == 1
+
+    def test_embedded_art_prepared_once(self, monkeypatch):
+        prepared = []
+
+        def fake_prepare(data, mime, max_size):
+            prepared.append(data)
+            return artwork.Artwork(data, mime, 0, 0)
+
+        pictures = {'1.flac': b'cover', '2.flac': b'cover', '3.flac': b'other'}
+        monkeypatch.setattr(artwork, 'read_flac_picture',
+                            lambda path: (pictures[os.path.basename(path)], 'image/jpeg'))
+        monkeypatch.setattr(artwork, 'prepare', fake_prepare)
+        cache = artwork.ArtworkCache(max_size=0)
+
+        for name in ('1.flac', '2.flac', '3.flac'):
+            assert cache.get(os.path.join('album', name)).data == pictures[name]
+        assert sorted(prepared) == [b'cover', b'other']
+
+    def test_unconvertible_art_skipped(self, monkeypatch):
+        monkeypatch.setattr(artwork, 'Image', None)
+        assert artwork.prepare(b'BM', 'image/bmp', 500) is None
+        assert artwork.prepare(b'png', 'image/png', 500).mime == 'image/png'
+
+    def test_embed_mp3(self, tmpdir):
+        mutagen = pytest.importorskip('mutagen')
+        mp3 = tmpdir.join('a.mp3')
+        mp3.write_binary((b'\xff\xfb\x90\x00' + b'\x00' * 413) * 10)
+
+        artwork.embed(str(mp3), artwork.Artwork(b'image', 'image/jpeg', 0, 0))
+
+        apic = mutagen.File(str(mp3)).tags.getall('APIC')
+        assert [(a.type, a.data) for a in apic] == [(artwork.FRONT_COVER, b'image')]
+
+
+class TestFileOps(object):
+    @pytest.mark.parametrize('mode', file_ops.copy_modes)
+    def test_clone_file(self, tmpdir, mode):
+        src = tmpdir.join('src.jpg')
+        src.write('image')
+        os.utime(str(src), (1000, 1000))
+        dst = tmpdir.join('dst.jpg')
+
+        file_ops.clone_file(str(src), str(dst), mode)
+
+        assert dst.read() == 'image'
+        assert os.stat(str(dst)).st_mtime == 1000
+        assert (os.stat(str(dst)).st_ino == os.stat(str(src)).st_ino) == (mode == 'hardlink')
+
+    def test_unsupported_method_falls_back(self, tmpdir, monkeypatch):
+        import errno
+
+        def no_reflink(src, dst):
+            open(dst, 'wb').close()
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+        monkeypatch.setitem(file_ops.mode_methods, 'reflink', (no_reflink,))
+        tmpdir.join('src.jpg').write('image')
+
+        assert file_ops.clone_file(str(tmpdir.join('src.jpg')), str(tmpdir.join('dst.jpg')),
+                                   'reflink') == 'copy'
+        assert tmpdir.join('dst.jpg').read() == 'image'
+
+    def test_artwork_copied_during_run(self, unprobed_converter, tmpdir, monkeypatch):
+        conv = unprobed_converter
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/true'
+        album = tmpdir.join('src').mkdir('a')
+        album.join('1.flac').write('')
+        album.join('cover.jpg').write('image')
+
+        monkeypatch.setattr(conv, 'encode_and_tagging', lambda lossless, targets, metrics=None: [0])
+        conv.start()
+
+        assert tmpdir.join('dest', 'a', 'cover.jpg').read() == 'image'
+
+
+class TestMetrics(object):
+    def test_wait_process_sets_returncode(self):
+        import subprocess
+        p = subprocess.Popen(['sh', '-c', 'exit 3'])
+        usage = conversion_metrics.wait_process(p)
+
+        assert p.returncode == 3
+        assert p.wait() == 3
+        if hasattr(os, 'wait4'):
+            assert usage.ru_utime >= 0
+
+    def test_records_and_textfile(self, tmpdir):
+        import json
+        recorder = conversion_metrics.MetricsRecorder(str(tmpdir.join('m.jsonl')),
+                                                      str(tmpdir.join('m.prom')))
+        recorder.record({'source': 'a.flac', 'kind': 'encode', 'results': [0], 'duration': 60.0,
+                         'bytes_read': 100, 'queue_time': 2.0,
+                         'outputs': [{'encoder': 'mp3', 'result': 0, 'bytes_written': 10}]})
+        recorder.record({'source': 'b.flac', 'kind': 'encode', 'results': [1],
+                         'outputs': [{'encoder': 'mp3', 'result': 1}]})
+        recorder.close()
+
+        records = [json.loads(l) for l in tmpdir.join('m.jsonl').readlines()]
+        assert [r['source'] for r in records] == ['a.flac', 'b.flac']
+
+        prom = tmpdir.join('m.prom').read()
+        assert 'flacthis_jobs_total{kind="encode",result="failure"} 1.0' in prom
+        assert 'flacthis_encoder_jobs_total{encoder="mp3",result="success"} 1.0' in prom
+        assert 'flacthis_audio_seconds_total 60.0' in prom
+        assert 'flacthis_queue_seconds_max 2.0' in prom
+
+    def test_jobs_recorded(self, unprobed_converter, tmpdir, monkeypatch):
+        conv = unprobed_converter
+        conv.no_artwork = True
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/true'
+        conv.metrics = conversion_metrics.MetricsRecorder(str(tmpdir.join('m.jsonl')))
+        tmpdir.join('src', 'a.flac').write('')
+
+        monkeypatch.setattr(conv, 'encode_and_tagging', lambda lossless, targets, metrics=None: [0])
+        conv.start()
+
+        assert conv.metrics.jobs == {('encode', 'success'): 1}
+        assert 'queue_time' in tmpdir.join('m.jsonl').read()
+
+
+class TestConcurrency(object):
+    def test_read_quota(self, tmpdir):
+        tmpdir.join('cpu.max').write('150000 100000\n')
+        assert concurrency.read_quota(str(tmpdir.join('cpu.max'))) == 1.5
+        tmpdir.join('cpu.max').write('max 100000\n')
+        assert concurrency.read_quota(str(tmpdir.join('cpu.max'))) is None
+
+        tmpdir.join('cpu.cfs_quota_us').write('-1\n')
+        tmpdir.join('cpu.cfs_period_us').write('100000\n')
+        assert concurrency.read_quota(str(tmpdir.join('cpu.cfs_quota_us')),
+                                      str(tmpdir.join('cpu.cfs_period_us'))) is None
+
+    def test_cgroup_v2_limit_of_ancestor(self, tmpdir):
+        root = tmpdir.mkdir('cgroup')
+        group = root.mkdir('parent').mkdir('child')
+        for d in (root, group):
+            d.join('cgroup.controllers').write('cpu\n')
+        root.join('parent', 'cpu.max').write('200000 100000\n')
+        group.join('cpu.max').write('max 100000\n')
+        tmpdir.join('proc_cgroup').write('0::/parent/child\n')
+
+        assert concurrency.cgroup_cpu_limit(str(root), str(tmpdir.join('proc_cgroup'))) == 2.0
+
+    def test_auto_threads_leave_room_for_threaded_encoders(self, unprobed_converter):
+        config = unprobed_converter.config
+        config.threads = 0
+        config.encoder = audio_codecs.FfmpegLibFdkEncoder()
+
+        conv = LosslessToLossyConverter(config)
+        assert conv.threads == max(1, config.threads // 2)
+
+    def test_limiter_and_controller(self):
+        limiter = concurrency.WorkerLimiter(2)
+        controller = concurrency.AdaptiveController(limiter, 1, 4, cpus=2)
+
+        assert controller.adjust(0.5, 0.0, True) == 3
+        assert controller.adjust(0.5, 0.0, False) == 3
+        assert controller.adjust(1.0, 0.0, True) == 2
+        assert controller.adjust(1.0, 0.0, True) == 2
+        assert controller.adjust(0.5, 0.5, True) == 1
+        assert controller.adjust(0.5, 0.5, True) == 1
+
+        calls = []
+        limiter.listeners.append(lambda: calls.append(limiter.active))
+        limiter.acquire()
+        assert limiter.active == 1
+        assert limiter.try_acquire(3) == limiter.limit - 1
+        limiter.release(limiter.limit)
+        assert limiter.active == 0
+        controller.adjust(0.5, 0.0, True)
+        assert calls == [0, 0]
+
+    def test_adaptive_pool_runs_every_job(self, unprobed_converter, tmpdir, monkeypatch):
+        conv = unprobed_converter
+        conv.adaptive_threads = True
+        conv.no_artwork = True
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/true'
+        for i in range(20):
+            tmpdir.join('src', '{}.flac'.format(i)).write('')
+
+        monkeypatch.setattr(conv, 'encode_and_tagging',
+                            lambda s, d, metrics=None: conv.record_success())
+        conv.start()
+
+        assert conv.success == 20
+
+    def test_jobs_wait_in_queue(self, unprobed_converter, monkeypatch):
+        import time
+        import threading
+        conv = unprobed_converter
+        conv.threads = 1
+        conv.adaptive_threads = True
+        conv.max_threads = 4
+        monkeypatch.setattr(concurrency.AdaptiveController, 'start', lambda self, jobs_waiting: None)
+        release = threading.Event()
+        started = []
+
+        def blocked_job(kind, rel_path, needed, queued_at=None):
+            started.append(rel_path)
+            release.wait(10)
+
+        monkeypatch.setattr(conv, 'run_job', blocked_job)
+        conv.start_workers()
+        try:
+            for i in range(4):
+                conv.queue_job(conv.SCAN_CONVERT, '{}.flac'.format(i), (), [0])
+            time.sleep(0.3)
+
+            # One place: the other jobs wait in the queue, in order
+            assert started == ['0.flac']
+            assert conv.waiting_jobs() == 3
+        finally:
+            release.set()
+            conv.stop_workers()
+
+        assert started == ['0.flac', '1.flac', '2.flac', '3.flac']
+
+
+class TestProcessLimits(object):
+    def test_parse(self):
+        assert process_limits.parse_ionice('idle') == (process_limits.IOPRIO_CLASS_IDLE, 0)
+        assert process_limits.parse_ionice('best-effort:7') == (process_limits.IOPRIO_CLASS_BE, 7)
+        assert process_limits.parse_cpus('0-2,5') == {0, 1, 2, 5}
+        assert process_limits.parse_size('512M') == 512 * 1024 ** 2
+        with pytest.raises(ValueError):
+            process_limits.parse_ionice('fast')
+        with pytest.raises(ValueError):
+            process_limits.parse_nice('25')
+
+    def test_codec_overrides(self):
+        governor = process_limits.ResourceGovernor.from_options(
+            ['flac', 'mp3'], nice=['5', 'mp3=15'], memory=['mp3=1G'])
+
+        assert governor.limits_for(audio_codecs.FLACDecoder()) == \
+            process_limits.ProcessLimits(5, None, None, None)
+        assert governor.limits_for(audio_codecs.MP3Encoder()) == \
+            process_limits.ProcessLimits(15, None, None, 1024 ** 3)
+
+        with pytest.raises(ValueError):
+            process_limits.ResourceGovernor.from_options(['flac', 'mp3'], nice=['ogg=5'])
+
+    @pytest.mark.skipif(not sys.platform.startswith('linux'), reason='Linux only')
+    def test_limits_applied_to_child(self):
+        import subprocess
+        cpu = sorted(os.sched_getaffinity(0))[0]
+        governor = process_limits.ResourceGovernor.from_options(
+            ['mp3'], nice=['mp3=12'], cpus=['mp3={}'.format(cpu)], memory=['mp3=2G'])
+
+        # The child waits for its input, so the limits are set before it reports them
+        p = subprocess.Popen(
+            [sys.executable, '-c', 'import os, sys, resource; sys.stdin.read(); '
+                                   'print(os.getpriority(os.PRIO_PROCESS, 0), '
+                                   'resource.getrlimit(resource.RLIMIT_AS)[0], '
+                                   'sorted(os.sched_getaffinity(0)))'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        governor.apply(audio_codecs.MP3Encoder(), p.pid)
+        output = p.communicate(b'')[0]
+
+        assert output.decode().strip().split(None, 2) == ['12', str(2 * 1024 ** 3), '[{}]'.format(cpu)]
+
+    @pytest.mark.skipif(process_limits.ResourceGovernor.find_ioprio_set() is None,
+                        reason='Needs ioprio_set')
+    def test_ioprio_set_failure_raises(self):
+        import subprocess
+        governor = process_limits.ResourceGovernor.from_options(['mp3'], ionice=['idle'])
+        p = subprocess.Popen([sys.executable, '-c', 'pass'])
+        p.wait()
+
+        with pytest.raises(OSError):
+            governor.apply(audio_codecs.MP3Encoder(), p.pid)
+
+    def test_denied_limit_warned_once(self, caplog):
+        def denied(pid):
+            raise OSError(errno.EPERM, 'Operation not permitted')
+
+        set_pids = []
+        governor = process_limits.ResourceGovernor()
+        governor._steps['mp3'] = [('nice', denied), ('cpus', set_pids.append)]
+
+        with caplog.at_level(logging.DEBUG, logger='process_limits'):
+            for pid in (100, 101, 102):
+                governor.apply(audio_codecs.MP3Encoder(), pid)
+
+        assert set_pids == [100, 101, 102]
+        assert [r.levelno for r in caplog.records] == [logging.WARNING, logging.DEBUG, logging.DEBUG]
+        assert 'nice' in caplog.records[0].getMessage()
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='Linux only')
+class TestWatcher(object):
+    def test_settled_directory_reported(self, tmpdir):
+        source_watcher = watcher.SourceWatcher(str(tmpdir), settle_time=0)
+        source_watcher.max_wait = 1
+        try:
+            tmpdir.mkdir('album')
+            assert 'album' in source_watcher.poll()
+
+            tmpdir.join('album', '01.flac').write('')
+            assert source_watcher.poll() == ['album']
+            assert source_watcher.poll() == []
+        finally:
+            source_watcher.close()
+
+    def test_renamed_before_settling(self, tmpdir):
+        source_watcher = watcher.SourceWatcher(str(tmpdir), settle_time=0.5)
+        try:
+            tmpdir.mkdir('album').mkdir('cd1').join('01.flac').write('')
+            source_watcher.handle(source_watcher.inotify.read_events())
+            assert 'album' in source_watcher.dirty
+
+            tmpdir.join('album').rename(tmpdir.join('renamed'))
+            tmpdir.join('renamed', 'cd1').remove()
+            source_watcher.handle(source_watcher.inotify.read_events())
+
+            assert sorted(source_watcher.dirty) == ['renamed']
+        finally:
+            source_watcher.close()
+
+    def test_vanished_directory_skipped(self, unprobed_converter, tmpdir, monkeypatch):
+        conv = unprobed_converter
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/true'
+
+        class FakeWatcher(object):
+            overflowed = False
+            polls = [['gone']]
+
+            def __init__(self, source_dir, settle_time=None):
+                pass
+
+            def poll(self):
+                if not self.polls:
+                    raise KeyboardInterrupt
+                return self.polls.pop()
+
+            def close(self):
+                pass
+
+        monkeypatch.setattr(watcher, 'SourceWatcher', FakeWatcher)
+        with pytest.raises(KeyboardInterrupt):
+            conv.watch()
+
+    def test_in_flight_not_queued_twice(self, unprobed_converter):
+        conv = unprobed_converter
+        conv.in_flight = set()
+        conv.work_queue = flacthis.queue.Queue()
+        conv.queued = 0
+
+        conv.queue_job(conv.SCAN_CONVERT, 'a.flac', (), [0])
+        conv.queue_job(conv.SCAN_CONVERT, 'a.flac', (), [0])
+
+        assert conv.work_queue.qsize() == 1
+
+
+class TestWorkerPool(object):
+    def test_all_jobs_dispatched(self, unprobed_converter, tmpdir, monkeypatch):
+        conv = unprobed_converter
+        conv.threads = 4
+        conv.no_artwork = True
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/true'
+
+        for i in range(50):
+            tmpdir.join('src', '{}.flac'.format(i)).write('')
+
+        seen = []
+
+        def fake_encode(lossless_file, targets, metrics=None):
+            seen.append(lossless_file)
+            conv.record_success()
+
+        monkeypatch.setattr(conv, 'encode_and_tagging', fake_encode)
+        conv.start()
+
+        assert conv.success == 50
+        assert len(set(seen)) == 50
+
+    def test_worker_exception_recorded(self, unprobed_converter, tmpdir, monkeypatch):
+        conv = unprobed_converter
+        conv.no_artwork = True
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/true'
+        tmpdir.join('src', 'a.flac').write('')
+
+        def broken_encode(lossless_file, targets, metrics=None):
+            raise RuntimeError('boom')
+
+        monkeypatch.setattr(conv, 'encode_and_tagging', broken_encode)
+        conv.start()
+
+        assert conv.error_conv == [str(tmpdir.join('src', 'a.flac'))]
+
+class TestSourceScan(object):
+    def test_scan_finds_nested_files(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        src = tmpdir.join('src')
+        src.mkdir('a').mkdir('b').join('1.flac').write('')
+        src.join('a', '2.flac').write('')
+        src.join('a', 'cover.jpg').write('')
+        src.join('a', 'notes.txt').write('')
+        os.symlink(str(src.join('a')), str(src.join('link')))
+
+        found = sorted(conv.scan_source())
+
+        assert found == [(conv.SCAN_CONVERT, os.path.join('a', '2.flac'), (), (0,)),
+                         (conv.SCAN_CONVERT, os.path.join('a', 'b', '1.flac'), (), (0,)),
+                         (conv.SCAN_ARTWORK, os.path.join('a', 'cover.jpg'), None, (0,))]
+
+    def test_dest_dirs_created_lazily(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        tmpdir.join('src').mkdir('a').join('1.flac').write('')
+
+        conv.get_convert_list()
+
+        assert conv.to_convert == [(os.path.join('a', '1.flac'), (0,))]
+        assert not tmpdir.join('dest').check()
+
+    @pytest.mark.parametrize('shard_by', LosslessToLossyConverter.shard_modes)
+    def test_shards_split_library(self, unprobed_converter, tmpdir, shard_by):
+        conv = unprobed_converter
+        conv.shard_by = shard_by
+        src = tmpdir.join('src')
+        for album in range(8):
+            d = src.mkdir('album{}'.format(album))
+            d.join('cover.jpg').write('')
+            for track in range(4):
+                d.join('{}.flac'.format(track)).write('')
+
+        shards = []
+        for k in range(1, 4):
+            conv.shard = (k, 3)
+            shards.append(set(rel_path for kind, rel_path, key, needed in conv.scan_source()))
+
+        assert sum(len(s) for s in shards) == 8 * 5
+        assert len(set.union(*shards)) == 8 * 5
+        if shard_by == 'album':
+            for s in shards:
+                assert len(s) % 5 == 0
+
+    def test_parse_shard(self):
+        assert flacthis.parse_shard('2/4') == (2, 4)
+        for value in ('0/4', '5/4', '4', 'a/b'):
+            with pytest.raises(ValueError):
+                flacthis.parse_shard(value)
+
+
+class TestStreamInfo(object):
+    def test_flac_streaminfo(self, tmpdir):
+        f = tmpdir.join('a.flac')
+        f.write_binary(flac_header(441000, md5=b'\x01' * 16))
+        info = audio_codecs.read_flac_streaminfo(str(f))
+
+        assert info.sample_rate == 44100
+        assert info.channels == 2
+        assert info.bits_per_sample == 16
+        assert info.duration == 10.0
+        assert info.md5 == '01' * 16
+
+    def test_flac_streaminfo_without_md5(self, tmpdir):
+        f = tmpdir.join('a.flac')
+        f.write_binary(flac_header(441000))
+        assert audio_codecs.read_flac_streaminfo(str(f)).md5 is None
+
+    def test_not_flac(self, tmpdir):
+        f = tmpdir.join('a.flac')
+        f.write('not a flac file at all, but long enough to hold a header')
+        assert audio_codecs.read_flac_streaminfo(str(f)) is None
+
+    def test_wav_streaminfo(self, tmpdir):
+        import wave
+        f = str(tmpdir.join('a.wav'))
+        w = wave.open(f, 'w')
+        w.setparams((2, 2, 22050, 0, 'NONE', 'not compressed'))
+        w.writeframes(b'\x00' * 4 * 22050)
+        w.close()
+
+        info = audio_codecs.read_wav_streaminfo(f)
+        assert info.total_samples == 22050
+        assert info.duration == 1.0
+
+    @pytest.mark.parametrize('fmt', [b'fmt \x10\x00\x00\x00\x01\x00\x02\x00',
+                                     b'fmt \x08\x00\x00\x00\x01\x00\x02\x00\x44\xac\x00\x00'])
+    def test_wav_truncated_fmt(self, tmpdir, fmt):
+        f = tmpdir.join('a.wav')
+        f.write_binary(b'RIFF\x24\x00\x00\x00WAVE' + fmt)
+        assert audio_codecs.read_wav_streaminfo(str(f)) is None
+
+
+class TestSchedule(object):
+    def scan_order(self, conv):
+        jobs = [(key, rel_path) for kind, rel_path, key, needed in conv.scan_source()]
+        return [os.path.splitext(rel_path)[0] for key, rel_path in sorted(jobs)]
+
+    def test_longest_first(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        conv.schedule = 'longest'
+        for name, length in (('short', 10), ('long', 1000), ('mid', 100)):
+            tmpdir.join('src', name + '.flac').write_binary(flac_header(length * 44100))
+
+        assert self.scan_order(conv) == ['long', 'mid', 'short']
+
+    def test_newest_first(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        conv.schedule = 'newest'
+        for i, name in enumerate(('old', 'new')):
+            f = tmpdir.join('src', name + '.flac')
+            f.write('')
+            os.utime(str(f), (1000 * i, 1000 * i))
+
+        assert self.scan_order(conv) == ['new', 'old']
+
+    def test_album_key_groups_directories(self, unprobed_converter):
+        conv = unprobed_converter
+        conv.schedule = 'album'
+        keys = sorted([conv.schedule_key(os.path.join('b', '1.flac'), None),
+                       conv.schedule_key(os.path.join('a', '2.flac'), None),
+                       conv.schedule_key(os.path.join('a', '1.flac'), None)])
+        assert keys == [('a', '1.flac'), ('a', '2.flac'), ('b', '1.flac')]
+
+    def test_priority_queue_runs_every_job(self, unprobed_converter, tmpdir, monkeypatch):
+        conv = unprobed_converter
+        conv.schedule = 'album'
+        conv.no_artwork = True
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/true'
+        for i in range(20):
+            tmpdir.join('src', '{}.flac'.format(i)).write('')
+
+        monkeypatch.setattr(conv, 'encode_and_tagging', lambda s, d, metrics=None: conv.record_success())
+        conv.start()
+
+        assert conv.success == 20
+
+
+class TestInProcessDecoders(object):
+    def make_wav(self, path, frames=1000):
+        import wave
+        w = wave.open(path, 'w')
+        w.setparams((2, 2, 44100, 0, 'NONE', 'not compressed'))
+        w.writeframes(os.urandom(4 * frames))
+        w.close()
+
+    def test_pywav_streams_file_unchanged(self, tmpdir):
+        import io
+        f = str(tmpdir.join('a.wav'))
+        self.make_wav(f)
+        d = audio_codecs.PyWAVDecoder()
+        d.find_exe()
+
+        out = io.BytesIO()
+        d.decode(f, out)
+
+        with open(f, 'rb') as src:
+            assert out.getvalue() == src.read()
+
+    def test_soundfile_flac_to_wav(self, tmpdir):
+        import io
+        soundfile = pytest.importorskip('soundfile')
+        wav = str(tmpdir.join('a.wav'))
+        flac = str(tmpdir.join('a.flac'))
+        self.make_wav(wav)
+        data, rate = soundfile.read(wav, dtype='int16')
+        soundfile.write(flac, data, rate, subtype='PCM_16')
+
+        d = audio_codecs.SoundFileFLACDecoder()
+        d.find_exe()
+        out = io.BytesIO()
+        d.decode(flac, out)
+
+        with open(wav, 'rb') as src:
+            assert out.getvalue() == src.read()
+
+    def test_in_process_decoders_listed(self):
+        names = audio_codecs.CodecManager().list_all_decoders()
+        assert 'pyflac' in names and 'pywav' in names
+
+
+class TestMultipleOutputs(object):
+    def shell_encoder(self, name, ext, script):
+        e = audio_codecs.Codec(name, 'sh', ext, '{exe} -c \'' + script + '\' {flags}', '')
+        e.found_exe = '/bin/sh'
+        return e
+
+    def test_fanout_drops_closed_pipe(self):
+        import io
+
+        class Closed(object):
+            def write(self, data):
+                raise IOError('Broken pipe')
+
+        good = io.BytesIO()
+        f = flacthis.PipeFanout([Closed(), good])
+        f.write(b'abc')
+        f.write(b'def')
+
+        assert f.failed == [True, False]
+        assert good.getvalue() == b'abcdef'
+
+    def test_outputs_succeed_independently(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        conv.Decoder = audio_codecs.PyWAVDecoder()
+        src = tmpdir.join('src', 'a.wav')
+        src.write_binary(os.urandom(1 << 20))
+        os.makedirs(conv.dest_dir)
+
+        good = self.shell_encoder('good', '.mp3', 'cat > "{output_file}"')
+        bad = self.shell_encoder('bad', '.ogg', 'exit 1')
+        conv.Encoder = good
+        conv.extra_outputs = [flacthis.Output(bad, conv.dest_dir)]
+        targets = [(o, conv.translate_src_to_dest(str(src), o)) for o in conv.outputs()]
+
+        assert conv.convert_to_lossy(str(src), targets) == [0, 1]
+        assert tmpdir.join('dest', 'a.mp3').read_binary() == src.read_binary()
+        assert conv.success == 1
+        assert conv.error_conv == ['{} (bad)'.format(src)]
+
+
+class TestPipelineSupervision(object):
+    def shell_codec(self, name, ext, cmd_seq):
+        c = audio_codecs.Codec(name, 'sh', ext, cmd_seq, '')
+        c.found_exe = '/bin/sh'
+        return c
+
+    def setup_converter(self, conv, tmpdir, decoder_script, encoder_script):
+        conv.Decoder = self.shell_codec('dec', '.flac', '{exe} -c \'' + decoder_script + '\' - "{input_file}"')
+        conv.Encoder = self.shell_codec('enc', '.mp3', '{exe} -c \'' + encoder_script + '\'')
+        conv.retry_delay = 0
+        src = tmpdir.join('src', 'a.flac')
+        src.write_binary(os.urandom(4096))
+        os.makedirs(conv.dest_dir)
+        return str(src), [(conv.outputs()[0], conv.translate_src_to_dest(str(src)))]
+
+    def test_decoder_failure_fails_job(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        conv.retries = 0
+        src, targets = self.setup_converter(conv, tmpdir, 'head -c 100 "$1"; exit 3', 'cat > "{output_file}"')
+
+        assert conv.convert_to_lossy(src, targets) == [1]
+        assert conv.error_conv == [src]
+        assert tmpdir.join('dest').listdir() == []
+
+    def test_stalled_encoder_killed(self, unprobed_converter, tmpdir, monkeypatch):
+        import time
+        monkeypatch.setattr(flacthis.pipeline_watchdog.PipelineWatchdog, 'interval', 0.1)
+        conv = unprobed_converter
+        conv.retries = 0
+        conv.stall_timeout = 0.5
+        src, targets = self.setup_converter(conv, tmpdir, 'cat "$1"', 'sleep 30')
+
+        started = time.time()
+        assert conv.convert_to_lossy(src, targets) == [1]
+        assert time.time() - started < 10
+
+    def test_killed_pipeline_not_retried(self, unprobed_converter, tmpdir, monkeypatch):
+        monkeypatch.setattr(flacthis.pipeline_watchdog.PipelineWatchdog, 'interval', 0.1)
+        conv = unprobed_converter
+        conv.retries = 2
+        conv.stall_timeout = 0.5
+        src, targets = self.setup_converter(conv, tmpdir, 'cat "$1"', 'sleep 30')
+
+        metrics = {}
+        assert conv.convert_to_lossy(src, targets, metrics) == [1]
+        assert metrics['attempts'] == 1
+        assert metrics['killed'].startswith('stalled')
+
+    def test_failure_retried(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        conv.retries = 2
+        marker = str(tmpdir.join('failed-once'))
+        src, targets = self.setup_converter(
+            conv, tmpdir, 'cat "$1"',
+            'if [ -e {} ]; then cat > "{{output_file}}"; else touch {}; exit 1; fi'.format(marker, marker))
+
+        assert conv.convert_to_lossy(src, targets) == [0]
+        assert conv.success == 1 and conv.error_conv == []
+        assert tmpdir.join('dest', 'a.mp3').read_binary() == tmpdir.join('src', 'a.flac').read_binary()
+
+
+class TestScratch(object):
+    def test_budget(self, tmpdir):
+        space = scratch.ScratchSpace(str(tmpdir), budget=100)
+        first = space.reserve(60)
+        assert first is not None
+        assert space.reserve(60) is None
+
+        tmpdir.join(os.path.relpath(first.staged_file('/dest/a.mp3'), str(tmpdir))).write('x')
+        space.release(first)
+        assert not os.path.exists(first.path)
+        assert space.reserve(60) is not None
+
+        space.close()
+        assert tmpdir.listdir() == []
+
+    def test_stale_runs_removed(self, tmpdir):
+        import socket
+        import subprocess
+        dead = subprocess.Popen([sys.executable, '-c', ''])
+        dead.wait()
+        for name, pid in (('flacthis-dead', dead.pid), ('flacthis-live', os.getpid())):
+            tmpdir.mkdir(name).join(scratch.PID_FILE).write(
+                '{} {}\n'.format(socket.gethostname(), pid))
+        tmpdir.mkdir('flacthis-unknown')
+
+        space = scratch.ScratchSpace(str(tmpdir))
+
+        names = sorted(p.basename for p in tmpdir.listdir())
+        assert 'flacthis-dead' not in names
+        assert 'flacthis-live' in names and 'flacthis-unknown' in names
+        assert os.path.basename(space.path) in names
+
+    def test_staged_file_names(self, tmpdir):
+        stage = scratch.ScratchSpace(str(tmpdir)).reserve(1)
+        a = stage.staged_file('/mp3/a.mp3')
+        assert stage.staged_file('/other/a.mp3') != a
+        assert stage.staged_file('/mp3/a.mp3') == a
+
+    def test_encoded_and_tagged_in_scratch(self, unprobed_converter, tmpdir, monkeypatch):
+        conv = unprobed_converter
+        conv.no_artwork = True
+        conv.Decoder = audio_codecs.Codec('dec', 'sh', '.flac', '{exe} -c \'cat "$1"\' - "{input_file}"', '')
+        conv.Encoder = audio_codecs.Codec('enc', 'sh', '.mp3', '{exe} -c \'cat > "{output_file}"\'', '')
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/sh'
+        conv.scratch = scratch.ScratchSpace(str(tmpdir.mkdir('scratch')))
+        tmpdir.join('src', 'a.flac').write('audio')
+
+        tagged = []
+        monkeypatch.setattr(conv, 'update_lossy_tags',
+                            lambda src, lossy, tag_file=None: tagged.append((lossy, tag_file, open(tag_file).read())))
+        conv.start()
+
+        assert conv.success == 1
+        assert tagged == [(str(tmpdir.join('dest', 'a.mp3')), tagged[0][1], 'audio')]
+        assert tagged[0][1].startswith(str(tmpdir.join('scratch')))
+        assert tmpdir.join('dest').listdir() == [tmpdir.join('dest', 'a.mp3')]
+        assert tmpdir.join('dest', 'a.mp3').read() == 'audio'
+        assert tmpdir.join('scratch').listdir() == []
+
+
+class TestPrefetch(object):
+    def test_read_ahead_within_depth(self, tmpdir):
+        tmpdir.join('a.flac').write('x' * 6)
+        tmpdir.join('b.flac').write('x' * 20)
+        a, b = str(tmpdir.join('a.flac')), str(tmpdir.join('b.flac'))
+
+        p = prefetch.Prefetcher(8)
+        p.chunk_size = 4
+        buf = bytearray(p.chunk_size)
+        p.add(b, (1,), 0)
+        p.add(a, (0,), 1)
+
+        # Lowest key first; b stops once depth bytes are read ahead
+        job = p.next_file()
+        assert job[2] == a
+        p.read_file(*job, buf=buf)
+        job = p.next_file()
+        assert job[2] == b
+        p.read_file(*job, buf=buf)
+        assert p.ahead >= p.depth
+
+        assert p.started(a) == prefetch.WARM
+        assert p.started(b) == prefetch.PARTIAL
+        assert p.started(str(tmpdir.join('c.flac'))) == prefetch.COLD
+        assert p.ahead == 0
+        assert p.counts == {prefetch.WARM: 1, prefetch.PARTIAL: 1, prefetch.COLD: 1}
+
+    def test_skips_started_files(self, tmpdir):
+        tmpdir.join('a.flac').write('audio')
+        p = prefetch.Prefetcher(100)
+        p.add(str(tmpdir.join('a.flac')))
+        assert p.started(str(tmpdir.join('a.flac'))) == prefetch.COLD
+
+        p.start()
+        p.stop()
+        assert p.ahead == 0
+
+    def test_conversion_records_state(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        conv.no_artwork = True
+        conv.Decoder = audio_codecs.Codec('dec', 'sh', '.flac', '{exe} -c \'cat "$1"\' - "{input_file}"', '')
+        conv.Encoder = audio_codecs.Codec('enc', 'sh', '.mp3', '{exe} -c \'cat > "{output_file}"\'', '')
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/sh'
+        conv.disable_id3 = True
+        conv.metrics = conversion_metrics.MetricsRecorder()
+        conv.prefetcher = prefetch.Prefetcher(1 << 20)
+        tmpdir.join('src', 'a.flac').write('audio')
+
+        conv.start()
+
+        assert conv.success == 1
+        assert sum(conv.prefetcher.counts.values()) == 1
+        assert sum(conv.metrics.prefetch.values()) == 1
+        assert 'flacthis_prefetch_jobs_total{state=' in conv.metrics.prometheus_text()
+
+
+class TestJournal(object):
+    def test_interrupted_run(self, tmpdir):
+        path = str(tmpdir.join('journal'))
+        journal = job_journal.JobJournal(path)
+        assert not journal.resumable()
+        journal.begin()
+        journal.planned(0, 'a.flac', ('a', 'a.flac'), (0,))
+        journal.planned(0, 'b.flac', ('b', 'b.flac'), (0, 1))
+        journal.scan_done()
+        journal.started(0, 'a.flac')
+        journal.finished(0, 'a.flac', [0])
+        journal.started(0, 'b.flac')
+        journal.close()
+        with open(path, 'a') as f:
+            f.write('{"event": "fini')
+
+        journal = job_journal.JobJournal(path)
+        assert journal.resumable()
+        assert journal.pending() == [(0, 'b.flac', ('b', 'b.flac'), (0, 1))]
+        assert journal.interrupted() == journal.pending()
+
+        journal.begin(resumed=True)
+        journal.finish()
+        journal.close()
+        assert not job_journal.JobJournal(path).resumable()
+
+    def test_locked(self, tmpdir):
+        journal = job_journal.JobJournal(str(tmpdir.join('journal')))
+        with pytest.raises(job_journal.JournalLocked):
+            job_journal.JobJournal(str(tmpdir.join('journal')))
+        journal.close()
+
+    @pytest.mark.parametrize('engine', LosslessToLossyConverter.engines)
+    def test_resume(self, unprobed_converter, tmpdir, engine):
+        conv = unprobed_converter
+        conv.no_artwork = True
+        conv.disable_id3 = True
+        conv.engine = engine
+        conv.Decoder = audio_codecs.Codec('dec', 'sh', '.flac', '{exe} -c \'cat "$1"\' - "{input_file}"', '')
+        conv.Encoder = audio_codecs.Codec('enc', 'sh', '.mp3', '{exe} -c \'cat > "{output_file}"\'', '')
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/sh'
+        for name in ('a', 'b', 'c'):
+            tmpdir.join('src', name + '.flac').write(name)
+        tmpdir.mkdir('dest').join('b.tmp.mp3').write('partial')
+
+        journal = job_journal.JobJournal(str(tmpdir.join('journal')))
+        journal.begin()
+        for name in ('a', 'b'):
+            journal.planned(conv.SCAN_CONVERT, name + '.flac', (), (0,))
+        journal.scan_done()
+        journal.started(conv.SCAN_CONVERT, 'a.flac')
+        journal.finished(conv.SCAN_CONVERT, 'a.flac', [0])
+        journal.started(conv.SCAN_CONVERT, 'b.flac')
+        journal.close()
+
+        conv.journal = job_journal.JobJournal(str(tmpdir.join('journal')))
+        conv.resume = True
+        conv.start()
+
+        # Only the unfinished job runs; c.flac wasn't planned so isn't scanned for
+        assert conv.success == 1
+        assert sorted(f.basename for f in tmpdir.join('dest').listdir()) == ['b.mp3']
+        assert tmpdir.join('dest', 'b.mp3').read() == 'b'
+        assert not job_journal.JobJournal(str(tmpdir.join('journal'))).resumable()
+
+    def test_dropped_outputs_skipped(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        conv.disable_id3 = True
+        conv.Decoder = audio_codecs.Codec('dec', 'sh', '.flac', '{exe} -c \'cat "$1"\' - "{input_file}"', '')
+        conv.Encoder = audio_codecs.Codec('enc', 'sh', '.mp3', '{exe} -c \'cat > "{output_file}"\'', '')
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/sh'
+        tmpdir.join('src', 'a.flac').write('a')
+
+        # Resumed from a run with two outputs
+        assert conv.run_job(conv.SCAN_CONVERT, 'a.flac', (1,)) == ()
+        assert conv.run_job(conv.SCAN_CONVERT, 'a.flac', (0, 1)) == [0]
+        assert tmpdir.join('dest', 'a.mp3').read() == 'a'
+
+    def test_stale_tmp_swept(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        conv.no_artwork = True
+        tmpdir.join('src').mkdir('album')
+        dest = tmpdir.mkdir('dest').mkdir('album')
+        old = time.time() - 2 * conv.stale_tmp_age
+        for name in ('a.tmp.mp3', 'b.tmp.2.mp3', 'c.mp3', 'd.tmp.flac', 'fresh.tmp.mp3'):
+            dest.join(name).write('x')
+            if name != 'fresh.tmp.mp3':
+                os.utime(str(dest.join(name)), (old, old))
+
+        list(conv.scan_source())
+        assert len(dest.listdir()) == 5
+
+        list(conv.scan_source(sweep=True))
+        assert sorted(f.basename for f in dest.listdir()) == ['c.mp3', 'd.tmp.flac', 'fresh.tmp.mp3']
+
+
+class TestEncodeCache(object):
+    def test_entries(self, tmpdir):
+        cache = encode_cache.EncodeCache(str(tmpdir.join('cache')))
+        encoder = audio_codecs.MP3Encoder()
+        encoder.version = 'LAME 3.100'
+        tmpdir.join('a.mp3').write('encoded')
+        info = audio_codecs.StreamInfo(44100, 2, 16, 441000, 'ab' * 16)
+
+        assert not cache.fetch(info, encoder, str(tmpdir.join('b.mp3')))
+        cache.store(info, encoder, str(tmpdir.join('a.mp3')))
+        assert cache.fetch(info, encoder, str(tmpdir.join('b.mp3')))
+        assert tmpdir.join('b.mp3').read() == 'encoded'
+        assert (cache.hits, cache.stored) == (1, 1)
+
+        other = audio_codecs.MP3Encoder()
+        other.version = 'LAME 3.99'
+        assert cache.entry(info, other) != cache.entry(info, encoder)
+        other.version = encoder.version
+        other.override_codec_flags('-V 2')
+        assert cache.entry(info, other) != cache.entry(info, encoder)
+        assert cache.entry(info, encoder, '-V 0 --nores') != cache.entry(info, encoder)
+
+        # Same samples in another stream format
+        for other_info in (info._replace(sample_rate=48000), info._replace(channels=1),
+                           info._replace(bits_per_sample=24)):
+            assert cache.entry(other_info, encoder) != cache.entry(info, encoder)
+
+    @pytest.mark.parametrize('engine', LosslessToLossyConverter.engines)
+    def test_identical_audio_encoded_once(self, unprobed_converter, tmpdir, monkeypatch, engine):
+        conv = unprobed_converter
+        conv.no_artwork = True
+        conv.engine = engine
+        conv.threads = 1
+        counter = str(tmpdir.join('encodes'))
+        conv.Decoder = audio_codecs.Codec('dec', 'sh', '.flac', '{exe} -c \'cat "$1"\' - "{input_file}"', '')
+        conv.Encoder = audio_codecs.Codec('enc', 'sh', '.mp3',
+                                          '{exe} -c \'echo >> ' + counter + '; cat > "{output_file}"\'', '')
+        conv.Decoder.found_exe = conv.Encoder.found_exe = '/bin/sh'
+        monkeypatch.setattr(conv.Decoder, 'read_stream_info', audio_codecs.read_flac_streaminfo)
+        conv.encode_cache = encode_cache.EncodeCache(str(tmpdir.join('cache')))
+
+        tagged = []
+        monkeypatch.setattr(conv, 'update_lossy_tags',
+                            lambda src, lossy, tag_file=None: tagged.append(os.path.basename(lossy)))
+        for album in ('a', 'b'):
+            tmpdir.join('src').mkdir(album).join('1.flac').write_binary(flac_header(44100, md5=b'\x07' * 16))
+
+        conv.start()
+
+        assert conv.success == 2
+        assert len(open(counter).readlines()) == 1
+        assert tmpdir.join('dest', 'a', '1.mp3').read_binary() == tmpdir.join('dest', 'b', '1.mp3').read_binary()
+        assert tagged == ['1.mp3', '1.mp3']
+        assert conv.encode_cache.hits == 1
+
+
+class TestSegments(object):
+    def test_segment_files(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        for name in ('a [1].tmp.0.mp3', 'a [1].tmp.12.mp3', 'a [1].tmp.x.mp3', 'a [1].mp3', 'a 1.tmp.0.mp3'):
+            tmpdir.join(name).write('')
+
+        found = conv.segment_files(str(tmpdir.join('a [1].mp3')), conv.Encoder)
+
+        assert sorted(os.path.basename(f) for f in found) == ['a [1].tmp.0.mp3', 'a [1].tmp.12.mp3']
+
+    # 128 kbps, 44100 Hz, stereo, no CRC: 417 byte frames
+    header = b'\xff\xfb\x90\x00'
+    delay = 576
+
+    def frame(self, index):
+        return self.header + b'\x00' * 32 + struct.pack('>I', index) + b'\x00' * 377
+
+    def tag_frame(self, frames, size, toc, padding, music_crc):
+        lame = 36 + 120
+        tag = bytearray(self.header + b'\x00' * 32 + b'Info' + struct.pack('>III', 0xf, frames + 1, size)
+                        + bytes(toc) + b'\x00' * 4 + b'LAME3.100' + b'\x00' * 252)
+        tag[lame + 21:lame + 24] = struct.pack('>I', (self.delay << 12) | padding)[1:]
+        struct.pack_into('>IH', tag, lame + 28, size - 417, music_crc)
+        struct.pack_into('>H', tag, lame + 34, mp3_segments.crc16(tag[:lame + 34]))
+        return bytes(tag)
+
+    def encode(self, path, total_samples, skip=0, until=None):
+        ''' Writes frames like LAME encoding samples skip to until would '''
+        samples = (until or total_samples) - skip
+        count = -(-(samples + self.delay) // 1152)
+        audio = b''.join(self.frame(skip // 1152 + i) for i in range(count))
+        size = 417 * (count + 1)
+        toc = [417 * (1 + i * count // 100) * 256 // size for i in range(100)]
+        tag = self.tag_frame(count, size, toc, count * 1152 - self.delay - samples,
+                             mp3_segments.crc16(audio))
+        with open(path, 'wb') as f:
+            f.write(tag + audio)
+
+    def test_plan(self):
+        plan = mp3_segments.plan_segments(1152 * 1000 + 100, 3)
+
+        assert [s.skip for s in plan] == [0, 1152 * 329, 1152 * 663]
+        assert [s.drop for s in plan] == [0, 4, 4]
+        assert [s.keep for s in plan] == [333, 334, None]
+        assert [s.until for s in plan] == [1152 * 337, 1152 * 671, None]
+
+    @pytest.mark.parametrize('count', [2, 3, 5])
+    def test_join_matches_whole_encode(self, tmpdir, count):
+        total = 1152 * 500 + 777
+        self.encode(str(tmpdir.join('whole.mp3')), total)
+
+        plan = mp3_segments.plan_segments(total, count)
+        segments = []
+        for i, segment in enumerate(plan):
+            segments.append(str(tmpdir.join('{}.mp3'.format(i))))
+            self.encode(segments[-1], total, segment.skip, segment.until)
+        mp3_segments.join(segments, plan, str(tmpdir.join('joined.mp3')), total, 44100)
+
+        assert tmpdir.join('joined.mp3').read_binary() == tmpdir.join('whole.mp3').read_binary()
+
+    @pytest.mark.skipif(not spawn.find_executable('lame'), reason='Needs lame')
+    def test_join_matches_real_lame(self, tmpdir):
+        import math
+        import wave
+        import subprocess
+        rate = 44100
+        total = rate * 20 + 123
+        samples = [int(12000 * math.sin(2 * math.pi * 440 * n / rate) +
+                       4000 * math.sin(2 * math.pi * 3100 * n / rate)) for n in range(total)]
+
+        def encode(name, skip=0, until=None):
+            w = wave.open(str(tmpdir.join(name + '.wav')), 'wb')
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(rate)
+            w.writeframes(struct.pack('<{}h'.format(len(samples[skip:until])), *samples[skip:until]))
+            w.close()
+            subprocess.check_call(['lame', '--silent', '-V', '2', '--nores',
+                                   str(tmpdir.join(name + '.wav')), str(tmpdir.join(name + '.mp3'))])
+            return str(tmpdir.join(name + '.mp3'))
+
+        def decode(path):
+            subprocess.check_call(['lame', '--silent', '--decode', path, path + '.wav'])
+            w = wave.open(path + '.wav', 'rb')
+            data = w.readframes(w.getnframes())
+            w.close()
+            return struct.unpack('<{}h'.format(len(data) // 2), data)
+
+        plan = mp3_segments.plan_segments(total, 3)
+        segments = [encode(str(i), s.skip, s.until) for i, s in enumerate(plan)]
+        mp3_segments.join(segments, plan, str(tmpdir.join('joined.mp3')), total, rate)
+
+        whole = decode(encode('whole'))
+        joined = decode(str(tmpdir.join('joined.mp3')))
+
+        # Same length, and no offset at the joins: a shifted 3100 Hz tone
+        # would differ by about as much as the signal itself
+        assert len(joined) == len(whole)
+        diff = math.sqrt(sum((a - b) ** 2 for a, b in zip(joined, whole)) / len(whole))
+        signal = math.sqrt(sum(a ** 2 for a in whole) / len(whole))
+        assert diff < 0.05 * signal
+
+    def test_bit_reservoir_rejected(self, tmpdir):
+        total = 1152 * 100
+        plan = mp3_segments.plan_segments(total, 2)
+        segments = []
+        for i, segment in enumerate(plan):
+            segments.append(str(tmpdir.join('{}.mp3'.format(i))))
+            self.encode(segments[-1], total, segment.skip, segment.until)
+
+        data = bytearray(tmpdir.join('1.mp3').read_binary())
+        data[417 * (1 + plan[1].drop) + 4] = 0x80     # main_data_begin of its first kept frame
+        tmpdir.join('1.mp3').write_binary(bytes(data))
+
+        with pytest.raises(ValueError, match='bit reservoir'):
+            mp3_segments.join(segments, plan, str(tmpdir.join('joined.mp3')), total, 44100)
+
+    def test_segment_count(self, unprobed_converter, tmpdir):
+        conv = unprobed_converter
+        conv.threads = 4
+        tmpdir.join('src', 'mix.flac').write_binary(flac_header(44100 * 600))
+        src = str(tmpdir.join('src', 'mix.flac'))
+        targets = [(conv.outputs()[0], str(tmpdir.join('dest', 'mix.mp3')))]
+        conv.split_long = 120
+
+        assert conv.segment_count(src, targets, 0) == 0     # No workers
+        conv.limiter = concurrency.WorkerLimiter(4)
+        conv.limiter.acquire()      # This job
+        assert conv.segment_count(src, targets, 0) == 4
+        assert conv.segment_count(src, targets, 2) == 2
+        assert conv.segment_count(src, targets, 3) == 0
+        assert conv.segment_count(src, targets, None) == 0
+        assert conv.segment_count(src, targets * 2, 0) == 0
+
+        conv.limiter.acquire()      # Another worker's job
+        assert conv.segment_count(src, targets, 0) == 3
+        conv.limiter.try_acquire(2)     # Its segments
+        assert conv.segment_count(src, targets, 0) == 0
+
+        conv.limiter = concurrency.WorkerLimiter(4)
+        conv.limiter.acquire()
+        conv.split_long = 600
+        assert conv.segment_count(src, targets, 0) == 0
+        conv.split_long = None
+        assert conv.segment_count(src, targets, 0) == 0
+
+
+@pytest.mark.skipif(flacthis.async_engine is None, reason='Python 3.7+ only')
+class TestAsyncEngine(object):
+    def shell_codec(self, name, ext, cmd_seq):
+        c = audio_codecs.Codec(name, 'sh', ext, cmd_seq, '')
+        c.found_exe = '/bin/sh'
+        return c
+
+    def run(self, conv, tmpdir, engine, decoder):
+        conv.engine = engine
+        conv.no_artwork = True
+        conv.retries = 0
+        conv.Decoder = decoder
+        conv.Encoder = self.shell_codec('good', '.mp3', '{exe} -c \'cat > "{output_file}"\'')
+        conv.extra_outputs = [flacthis.Output(self.shell_codec('bad', '.ogg', '{exe} -c \'exit 1\''),
+                                              str(tmpdir.join('dest-' + engine)))]
+        conv.start()
+
+        return (conv.success, sorted(os.path.relpath(p, conv.source_dir) for p in conv.error_conv),
+                sorted(os.listdir(conv.dest_dir)))
+
+    @pytest.mark.parametrize('decoder', ['external', 'in_process'])
+    def test_same_results_as_threads(self, converter_config, tmpdir, decoder):
+        tmpdir.mkdir('src')
+        for i in range(6):
+            tmpdir.join('src', '{}.wav'.format(i)).write_binary(os.urandom(100000))
+
+        results = {}
+        for engine in LosslessToLossyConverter.engines:
+            converter_config.source_dir = str(tmpdir.join('src'))
+            converter_config.dest_dir = str(tmpdir.join(engine))
+            converter_config.decoder = audio_codecs.WAVDecoder()
+            converter_config.encoder = audio_codecs.MP3Encoder()
+            conv = LosslessToLossyConverter(converter_config)
+            conv.threads = 3
+
+            if decoder == 'external':
+                dec = self.shell_codec('dec', '.wav', '{exe} -c \'cat "$1"\' - "{input_file}"')
+            else:
+                dec = audio_codecs.PyWAVDecoder()
+                dec.find_exe()
+            results[engine] = self.run(conv, tmpdir, engine, dec)
+
+        assert results['asyncio'] == results['threads']
+        assert results['asyncio'][0] == 6
+        assert tmpdir.join('asyncio', '0.mp3').read_binary() == tmpdir.join('src', '0.wav').read_binary()
+
+    def test_stalled_pipeline_killed(self, unprobed_converter, tmpdir, monkeypatch):
+        import time
+        monkeypatch.setattr(flacthis.pipeline_watchdog.PipelineWatchdog, 'interval', 0.1)
+        conv = unprobed_converter
+        conv.engine = 'asyncio'
+        conv.no_artwork = True
+        conv.retries = 0
+        conv.stall_timeout = 0.5
+        conv.Decoder = self.shell_codec('dec', '.flac', '{exe} -c \'cat "$1"\' - "{input_file}"')
+        conv.Encoder = self.shell_codec('enc', '.mp3', '{exe} -c \'sleep 30\'')
+        tmpdir.join('src', 'a.flac').write('x')
+
+        started = time.time()
+        conv.start()
+
+        assert time.time() - started < 10
+        assert conv.error_conv == [str(tmpdir.join('src', 'a.flac'))]
+        assert tmpdir.join('dest').listdir() == []
+
+    @pytest.mark.parametrize('outputs', [1, 2])
+    def test_same_metrics_as_threads(self, converter_config, tmpdir, outputs):
+        tmpdir.mkdir('src').join('a.wav').write('x')
+
+        keys = {}
+        for engine in LosslessToLossyConverter.engines:
+            converter_config.source_dir = str(tmpdir.join('src'))
+            converter_config.dest_dir = str(tmpdir.join(engine))
+            converter_config.decoder = audio_codecs.WAVDecoder()
+            converter_config.encoder = audio_codecs.MP3Encoder()
+            conv = LosslessToLossyConverter(converter_config)
+            conv.engine = engine
+            conv.no_artwork = True
+            conv.Decoder = self.shell_codec('dec', '.wav', '{exe} -c \'cat "$1"\' - "{input_file}"')
+            conv.Encoder = self.shell_codec('enc', '.mp3', '{exe} -c \'cat > "{output_file}"\'')
+            if outputs == 2:
+                conv.extra_outputs = [flacthis.Output(conv.Encoder, str(tmpdir.join(engine + '-2')))]
+            conv.metrics = conversion_metrics.MetricsRecorder()
+            records = []
+            conv.metrics.record = records.append
+            conv.start()
+            keys[engine] = (sorted(records[0]), [sorted(o) for o in records[0]['outputs']])
+
+        assert keys['asyncio'] == keys['threads']
+        assert 'decode_user_cpu' in keys['asyncio'][0]
+        assert all('user_cpu' in o for o in keys['asyncio'][1])
+
+    def test_waiting_worker_woken_by_release(self, unprobed_converter):
+        import time
+        import asyncio
+        import threading
+        conv = unprobed_converter
+        conv.limiter = concurrency.WorkerLimiter(1)
+        conv.limiter.try_acquire()
+        engine = flacthis.async_engine.AsyncEngine(conv)
+
+        async def wait_for_place():
+            engine.watch_limiter(asyncio.get_running_loop())
+            threading.Timer(0.05, conv.limiter.release).start()
+            started = time.time()
+            await asyncio.wait_for(engine.wait_for_place(), 5)
+            return time.time() - started
+
+        assert asyncio.run(wait_for_place()) < 0.3
+        assert conv.limiter.active == 0
+
+
+class TestCluster(object):
+    def test_lost_job_is_requeued(self, unprobed_converter, tmpdir):
+        import socket
+        import threading
+        conv = unprobed_converter
+        conv.no_artwork = True
+        for name in ('a', 'b'):
+            tmpdir.join('src', name + '.flac').write('')
+
+        coord = conversion_cluster.ClusterCoordinator(conv, '127.0.0.1:0')
+        t = threading.Thread(target=coord.run)
+        t.start()
+        assert coord.listening.wait(10)
+
+        # First worker takes a job and dies
+        dead = socket.create_connection(coord.server_address)
+        f = dead.makefile('rwb')
+        conversion_cluster.send_message(f, {'hello': 'dead'})
+        lost = conversion_cluster.read_message(f)['path']
+        f.close()
+        dead.close()
+
+        # Second worker finishes everything
+        sock = socket.create_connection(coord.server_address)
+        f = sock.makefile('rwb')
+        conversion_cluster.send_message(f, {'hello': 'alive'})
+        done = []
+        while True:
+            message = conversion_cluster.read_message(f)
+            if message.get('done'):
+                break
+            done.append(message['path'])
+            conversion_cluster.send_message(f, {'result': message['job'], 'results': [0],
+                                                'success': 1, 'error_conv': [],
+                                                'error_id3': []})
+        f.close()
+        sock.close()
+        t.join(10)
+
+        assert lost in done
+        assert sorted(done) == ['a.flac', 'b.flac']
+        assert conv.success == 2
+
+    def test_parse_address(self):
+        assert conversion_cluster.parse_address('host:123') == ('host', 123)
+        assert conversion_cluster.parse_address(':123') == ('localhost', 123)
+        with pytest.raises(ValueError):
+            conversion_cluster.parse_address('host')
+
+    def test_check_job(self):
+        kinds = (1, 2)
+        conversion_cluster.check_job({'kind': 1, 'path': 'a/../b.flac', 'outputs': [0]}, kinds, 1)
+        # As received: text from json
+        conversion_cluster.check_job(conversion_cluster.json.loads('{"kind": 1, "path": "a.flac", "outputs": [0]}'),
+                                     kinds, 1)
+        for path in ('/etc/passwd', '..', '../b.flac', 'a/../../b.flac', '', None):
+            with pytest.raises(ValueError):
+                conversion_cluster.check_job({'kind': 1, 'path': path, 'outputs': [0]}, kinds, 1)
+        with pytest.raises(ValueError):
+            conversion_cluster.check_job({'kind': 3, 'path': 'a.flac', 'outputs': [0]}, kinds, 1)
+        with pytest.raises(ValueError):
+            conversion_cluster.check_job({'kind': 1, 'path': 'a.flac', 'outputs': [1]}, kinds, 1)
+
+    def test_moved_is_counted(self, unprobed_converter):
+        conv = unprobed_converter
+        coord = conversion_cluster.ClusterCoordinator(conv, '127.0.0.1:0')
+        job = conversion_cluster.ClusterJob(1, conv.SCAN_MOVE, 'a.flac', None, [0], None)
+        coord.record_result(job, {'results': [0], 'success': 0, 'moved': 1, 'error_conv': [], 'error_id3': []})
+        assert conv.moved == 1
+
+
+class TestCodecProbing(object):
+    def fake_lame(self, tmpdir):
+        exe = tmpdir.join('lame')
+        exe.write('#!/bin/sh\necho "LAME version 3.100"\n')
+        exe.chmod(0o755)
+        return exe
+
+    def test_probe_cache_skips_version_check(self, tmpdir, monkeypatch):
+        exe = self.fake_lame(tmpdir)
+        monkeypatch.setenv('PATH', str(tmpdir))
+        cache = audio_codecs.CodecProbeCache(str(tmpdir.join('cache.json')))
+
+        e = audio_codecs.MP3Encoder()
+        e.find_exe(cache)
+        assert e.version == 'LAME version 3.100'
+
+        def no_subprocess(*args):
+            raise AssertionError('version probed again')
+
+        monkeypatch.setattr(audio_codecs.MP3Encoder, '_find_exe_version', no_subprocess)
+        e = audio_codecs.MP3Encoder()
+        e.find_exe(audio_codecs.CodecProbeCache(cache.path))
+        assert e.version == 'LAME version 3.100'
+
+    def test_probe_cache_invalidated_by_new_exe(self, tmpdir):
+        exe = self.fake_lame(tmpdir)
+        cache = audio_codecs.CodecProbeCache(str(tmpdir.join('cache.json')))
+        e = audio_codecs.MP3Encoder()
+        cache.put(e, str(exe), 'old', True)
+
+        exe.write('#!/bin/sh\necho "LAME version 3.101 (rebuilt)"\n')
+        assert cache.get(e, str(exe)) is None
+
+    def test_find_only_probes_selected(self, monkeypatch):
+        probed = []
+
+        def fake_find_exe(self, cache=None):
+            probed.append(self.name)
+            self.found_exe = '/bin/true'
+
+        monkeypatch.setattr(audio_codecs.Codec, 'find_exe', fake_find_exe)
+        m = audio_codecs.CodecManager()
+
+        assert m.find_encoder('ogg').name == 'ogg'
+        assert m.find_decoder('flac').name == 'flac'
+        assert probed == ['ogg', 'flac']
+
+    def test_find_named_codec_only(self, monkeypatch):
+        def fake_find_exe(self, cache=None):
+            if self.name in ('flac', 'wav'):
+                raise audio_codecs.CodecNotFound
+            self.found_exe = '/bin/true'
+
+        monkeypatch.setattr(audio_codecs.Codec, 'find_exe', fake_find_exe)
+        monkeypatch.setattr(audio_codecs.InProcessDecoder, 'find_exe', fake_find_exe)
+        m = audio_codecs.CodecManager()
+
+        for name in ('flac', 'wav'):
+            with pytest.raises(audio_codecs.SelectedCodecNotValid):
+                m.find_decoder(name)
+        assert m.find_decoder().name == 'pyflac'
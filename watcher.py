@@ -0,0 +1,233 @@
+"""
+    Follows changes under source_dir with inotify (Linux).
+
+    Every directory of the tree is watched for files finishing being
+    written (IN_CLOSE_WRITE) or moved in (IN_MOVED_TO) and for new
+    subdirectories, which are watched in turn. Subdirectories renamed
+    or deleted before they settle are forgotten. A directory is reported
+    by SourceWatcher.poll() once it has had no events for settle_time
+    seconds, so a whole album being copied in is picked up in one go.
+"""
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import logging
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+
+logger = logging.getLogger(__name__)
+
+# linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+watch_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name
+event_header = struct.Struct('iIII')
+
+fsencode = getattr(os, 'fsencode', lambda path: path)
+fsdecode = getattr(os, 'fsdecode', lambda path: path)
+
+
+class InotifyUnavailable(Exception):
+    pass
+
+
+class Inotify(object):
+    """
+        Minimal ctypes binding of the inotify system calls
+    """
+
+    def __init__(self):
+        if ctypes is None or not sys.platform.startswith('linux'):
+            raise InotifyUnavailable('inotify is only available on Linux')
+
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            init = self._libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise InotifyUnavailable(str(e))
+
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path, mask):
+        """
+            Returns the watch descriptor. Watching an already watched
+            directory returns its existing descriptor.
+        """
+        wd = self._libc.inotify_add_watch(self.fd, fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def read_events(self):
+        """
+            Returns the pending events as (wd, mask, cookie, name) tuples
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, fsdecode(name)))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SourceWatcher(object):
+    """
+        Watches every directory under source_dir and reports directories
+        (relative to source_dir, '' for source_dir itself) once they have
+        been quiet for settle_time seconds.
+
+        overflowed is set when the kernel dropped events; the caller
+        should then rescan everything and reset it.
+    """
+
+    settle_time = 30.0
+
+    # Longest time poll() blocks
+    max_wait = 60.0
+
+    def __init__(self, source_dir, settle_time=None):
+        self.source_dir = source_dir
+        if settle_time is not None:
+            self.settle_time = settle_time
+
+        self.inotify = Inotify()
+        self.dirs = {}          # Watch descriptor -> relative directory
+        self.dirty = {}         # Relative directory -> time of its last event
+        self.overflowed = False
+
+        self.add_tree('')
+
+    def add_tree(self, rel_dir, mark=False):
+        """
+            Watches rel_dir and its subdirectories. With mark they are
+            reported too, for directories created or moved in after the
+            watch started, whose files may predate their watch.
+        """
+        now = time.time()
+        top = os.path.join(self.source_dir, rel_dir)
+
+        for path, subdirs, files in os.walk(top):
+            rel = os.path.relpath(path, self.source_dir)
+            rel = '' if rel == os.curdir else rel
+
+            try:
+                self.dirs[self.inotify.add_watch(path, watch_mask)] = rel
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    logger.error('Out of inotify watches, raise fs.inotify.max_user_watches')
+                elif e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    logger.warning('Could not watch {}: {}'.format(path, e))
+                continue
+
+            if mark:
+                self.dirty[rel] = now
+
+    def forget(self, rel_dir):
+        """
+            Stops reporting rel_dir and its subdirectories, which were
+            deleted or moved away. A directory moved within the tree is
+            added again under its new name by its IN_MOVED_TO event.
+        """
+        def inside(d):
+            return d == rel_dir or d.startswith(os.path.join(rel_dir, ''))
+
+        for d in [d for d in self.dirty if inside(d)]:
+            del self.dirty[d]
+        for wd in [wd for wd, d in self.dirs.items() if inside(d)]:
+            del self.dirs[wd]
+
+    def handle(self, events):
+        now = time.time()
+
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+
+            if mask & IN_IGNORED:
+                # Directory deleted
+                rel_dir = self.dirs.get(wd)
+                if rel_dir is not None:
+                    self.forget(rel_dir)
+                continue
+
+            rel_dir = self.dirs.get(wd)
+            if rel_dir is None:
+                continue
+
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self.forget(os.path.join(rel_dir, name))
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(os.path.join(rel_dir, name), mark=True)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.dirty[rel_dir] = now
+
+    def poll(self):
+        """
+            Waits for events until a directory settles (or max_wait).
+
+            Returns the list of settled directories
+        """
+        now = time.time()
+        if self.dirty:
+            timeout = max(0, min(self.dirty.values()) + self.settle_time - now)
+        else:
+            timeout = self.max_wait
+
+        try:
+            readable = select.select([self.inotify.fd], [], [], timeout)[0]
+        except (OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+
+        if readable:
+            self.handle(self.inotify.read_events())
+
+        now = time.time()
+        settled = [d for d, t in self.dirty.items() if now - t >= self.settle_time]
+        for d in settled:
+            del self.dirty[d]
+
+        return sorted(settled)
+
+    def close(self):
+        self.inotify.close()